@@ -77,6 +77,48 @@ def benchmark_viterbi( model, sample ):
 		logp, path = model.viterbi( sample )
 	print("{:16}: time: {:5.5}, logp: {:5.5}".format( "VITERBI", time.time() - tic, logp ))
 
+def benchmark_numerics( model, sample, samples ):
+	"""Compare the log space and scaled probability space kernels.
+	"""
+
+	for numerics in 'log', 'scaled':
+		model.numerics = numerics
+
+		tic = time.time()
+		for i in xrange(25000):
+			model.forward_backward( sample )
+		print("{:16}: time: {:5.5} ({})".format( "FORWARD-BACKWARD", time.time() - tic, numerics ))
+
+		trained = model.copy()
+		trained.numerics = numerics
+
+		tic = time.time()
+		improvement = trained.fit( samples, max_iterations=10, verbose=False )
+		print("{:16}: time: {:5.5}, improvement: {:5.5} ({})".format( "BW TRAINING", time.time() - tic, improvement, numerics ))
+
+	model.numerics = 'log'
+
+def benchmark_bake( match_distributions, insert_distribution, n_states ):
+	"""Time bake on a large sparse alignment model, and from_matrix, which
+	bakes as well, on a densely connected model.
+	"""
+
+	model = global_alignment( match_distributions, insert_distribution )
+
+	tic = time.time()
+	for i in xrange(10):
+		model.bake()
+	print("{:16}: time: {:5.5}, edges: {} (sparse)".format( "BAKE", time.time() - tic, model.edge_count() ))
+
+	transitions = np.abs( np.random.randn(n_states, n_states) )
+	transitions /= transitions.sum(axis=1)[:, np.newaxis]
+	distributions = [ NormalDistribution(i, 1) for i in range(n_states) ]
+	starts = np.ones(n_states) / n_states
+
+	tic = time.time()
+	model = HiddenMarkovModel.from_matrix( transitions, distributions, starts )
+	print("{:16}: time: {:5.5}, edges: {} (dense)".format( "FROM MATRIX", time.time() - tic, model.edge_count() ))
+
 def benchmark_training( model, samples, n_jobs ):
 	tic = time.time()
 	improvement = model.train( samples, max_iterations=10, verbose=False, n_jobs=n_jobs )
@@ -86,6 +128,11 @@ def main():
 	n = 15
 
 	print("HIDDEN MARKOV MODEL BENCHMARKS")
+	print("model construction")
+	means = np.random.randn(1000)*20
+	benchmark_bake( [ NormalDistribution(mean, 1) for mean in means ], NormalDistribution(0, 10), 300 )
+
+	print
 	print("gaussian emissions")
 	sigma = 3
 	means = np.random.randn(n)*20
@@ -99,6 +146,7 @@ def main():
 	benchmark_viterbi( gaussian_model, gaussian_sample )
 	benchmark_forward_backward( gaussian_model, gaussian_sample )
 	benchmark_training( gaussian_model, gaussian_batch, 1 )
+	benchmark_numerics( gaussian_model, gaussian_sample, gaussian_batch )
 
 	# Reset the model
 	gaussian_dists = [ NormalDistribution(mean, 1) for mean in means ]
@@ -121,6 +169,7 @@ def main():
 	benchmark_viterbi( multivariate_gaussian_model, multivariate_gaussian_sample  )
 	benchmark_forward_backward( multivariate_gaussian_model, multivariate_gaussian_sample  )
 	benchmark_training( multivariate_gaussian_model, multivariate_gaussian_batch, 1 )
+	benchmark_numerics( multivariate_gaussian_model, multivariate_gaussian_sample, multivariate_gaussian_batch )
 
 	# Reset the model
 	multivariate_gaussian_dists = [ mgd( mean, np.eye(m) ) for mean in means ]
@@ -142,6 +191,7 @@ def main():
 	benchmark_viterbi( discrete_model, discrete_sample  )
 	benchmark_forward_backward( discrete_model, discrete_sample  )
 	benchmark_training( discrete_model, discrete_batch, 1 )
+	benchmark_numerics( discrete_model, discrete_sample, discrete_batch )
 
 	# Reset the model
 	discrete_dists = [ DiscreteDistribution({ char: prob for char, prob in zip('ACGT', row)}) for row in probs ]
@@ -10,6 +10,62 @@ import itertools as it
 from .distributions import Distribution
 from .distributions import DiscreteDistribution
 from .distributions import ConditionalProbabilityTable
+from .io import RaggedSequences
+
+
+def _packed_ngrams(X, width, first):
+	"""Find the n-grams of width symbols in a collection of encoded discrete
+	sequences by reading the packed codes and offsets directly.
+
+	Each n-gram is numbered from its codes, so only the distinct n-grams are
+	decoded into symbols. If first is True only the n-gram at the start of
+	each sequence is taken, otherwise every n-gram is.
+
+	Returns the keys of the distinct n-grams, a symbol if width is 1 and a
+	tuple otherwise, the index of the key of each n-gram, and the sequence
+	each n-gram comes from.
+	"""
+
+	data, offsets = X.data, X.offsets
+	lengths = numpy.diff(offsets)
+	sequence_idxs = numpy.arange(lengths.shape[0])
+	m = len(X.keymap[0])
+
+	if first:
+		keep = lengths >= width
+		starts, sequence_idxs = offsets[:-1][keep], sequence_idxs[keep]
+	else:
+		counts = numpy.maximum(lengths - width + 1, 0)
+		sequence_idxs = numpy.repeat(sequence_idxs, counts)
+		starts = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts)
+			- counts - offsets[:-1], counts)
+
+	ids = numpy.zeros(starts.shape[0], dtype='int64')
+	for t in range(width):
+		ids = ids * m + data[starts + t].astype('int64')
+
+	ids, inverse = numpy.unique(ids, return_inverse=True)
+
+	symbols = numpy.empty(m, dtype=object)
+	for symbol, code in X.keymap[0].items():
+		symbols[code] = symbol
+
+	columns = [symbols[ids // m ** (width-t-1) % m] for t in range(width)]
+	if width == 1:
+		keys = list(columns[0])
+	else:
+		keys = list(zip(*columns))
+
+	return keys, inverse, sequence_idxs
+
+def _is_packed(X, k):
+	"""Return whether the n-grams of a RaggedSequences collection can be
+	read from its codes: it must hold encoded univariate symbols with no
+	missing values, and every n-gram of k+1 codes must fit in an int64."""
+
+	return X.keymap is not None and X.data.ndim == 1 and len(X.keymap) == 1 \
+		and len(X.keymap[0]) > 0 and len(X.keymap[0]) ** (k+1) < 2 ** 62 \
+		and not numpy.isnan(X.data).any()
 
 
 cdef class MarkovChain(object):
@@ -64,15 +120,34 @@ cdef class MarkovChain(object):
 
 		Parameters
 		----------
-		sequence : array-like
-			An array of observations
+		sequence : array-like or RaggedSequences
+			An array of observations. If a RaggedSequences collection is
+			given, the log probability of each sequence in it is returned.
+			Encoded symbols are read from the packed codes, and each
+			distinct n-gram is only scored once.
 
 		Returns
 		-------
-		logp : double
+		logp : double or numpy.ndarray
 			The log probability of the sequence under the model.
 		"""
 
+		if isinstance(sequence, RaggedSequences):
+			if not _is_packed(sequence, self.k):
+				return numpy.array([self.log_probability(symbols)
+					for symbols in sequence.symbols()])
+
+			logp = numpy.zeros(len(sequence))
+			for i in range(self.k+1):
+				keys, inverse, sequence_idxs = _packed_ngrams(sequence, i+1,
+					i < self.k)
+				values = numpy.array([self.distributions[i].log_probability(key)
+					for key in keys], dtype='float64')
+				logp += numpy.bincount(sequence_idxs, weights=values[inverse],
+					minlength=len(sequence))
+
+			return logp
+
 		n, k = len(sequence), self.k
 		l = min(k, n)
 		logp = 0.0
@@ -132,7 +207,8 @@ cdef class MarkovChain(object):
 		----------
 		sequences : array-like, shape (n_samples, variable)
 			This is the data to train on. Each row is a sample which contains
-			a sequence of variable length
+			a sequence of variable length. A RaggedSequences
+			collection can also be given.
 
 		weights : array-like, shape (n_samples,), optional
 			The initial weights of each sample. If nothing is passed in then
@@ -163,7 +239,10 @@ cdef class MarkovChain(object):
 		----------
 		sequences : array-like, shape (n_samples, variable)
 			This is the data to train on. Each row is a sample which contains
-			a sequence of variable length
+			a sequence of variable length. A RaggedSequences
+			collection can also be given, in which case encoded symbols are
+			counted from the packed codes and each distinct n-gram is passed
+			to the distributions once, weighted by its total weight.
 
 		weights : array-like, shape (n_samples,), optional
 			The initial weights of each sample. If nothing is passed in then
@@ -179,6 +258,19 @@ cdef class MarkovChain(object):
 		else:
 			weights = numpy.array(weights)
 
+		if isinstance(sequences, RaggedSequences):
+			if _is_packed(sequences, self.k):
+				for i in range(self.k+1):
+					keys, inverse, sequence_idxs = _packed_ngrams(sequences, 
+						i+1, i < self.k)
+					if len(keys) > 0:
+						self.distributions[i].summarize(keys, numpy.bincount(
+							inverse, weights=weights[sequence_idxs], 
+							minlength=len(keys)))
+				return
+
+			sequences = sequences.symbols()
+
 		n = max( map(len, sequences) )
 		for i in range(self.k):
 			if i == 0:
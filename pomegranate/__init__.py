@@ -15,7 +15,10 @@ from .gmm import GeneralMixtureModel
 from .NaiveBayes import NaiveBayes
 from .BayesClassifier import BayesClassifier
 from .MarkovChain import MarkovChain
+from .io import RaggedSequences
+from .io import SequenceShards
 from .hmm import HiddenMarkovModel
+from .hmm import HiddenMarkovModelFilter
 from .BayesianNetwork import BayesianNetwork
 from .FactorGraph import FactorGraph
 
@@ -106,7 +106,7 @@ cdef class Model(object):
 
 		return self.__class__(*self.parameters)
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
 		"""Return a random item sampled from this distribution.
 
 		Parameters
@@ -115,6 +115,10 @@ cdef class Model(object):
 			The number of samples to return. Default is None, which is to
 			generate a single sample.
 
+		random_state : None, int or numpy.random.RandomState, optional
+			The random number generator to draw from, or a seed for one. If
+			None, numpy.random is used. Default is None.
+
 		Returns
 		-------
 		sample : double or object
@@ -173,7 +177,7 @@ cdef class Model(object):
 		return (self.predict(X) == y).mean() 
 
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
 		"""Return a random item sampled from this distribution.
 
 		Parameters
@@ -182,6 +186,10 @@ cdef class Model(object):
 			The number of samples to return. Default is None, which is to
 			generate a single sample.
 
+		random_state : None, int or numpy.random.RandomState, optional
+			The random number generator to draw from, or a seed for one. If
+			None, numpy.random is used. Default is None.
+
 		Returns
 		-------
 		sample : double or object
@@ -3,6 +3,8 @@
 
 cimport numpy
 
+from cpython.pythread cimport PyThread_type_lock
+
 from .base cimport Model
 
 ctypedef numpy.npy_float64 DOUBLE_t 
@@ -37,6 +39,7 @@ cdef class GammaDistribution(Distribution):
 cdef class DiscreteDistribution(Distribution):
 	cdef bint encoded_summary
 	cdef int n
+	cdef long version
 	cdef dict dist, log_dist
 	cdef tuple encoded_keys
 	cdef double* encoded_counts
@@ -51,13 +54,22 @@ cdef class LambdaDistribution(Distribution):
 
 cdef class KernelDensity(Distribution):
 	cdef numpy.ndarray points_ndarray, weights_ndarray
+	cdef numpy.ndarray sorted_points_ndarray, sorted_weights_ndarray
+	cdef numpy.ndarray cumulative_weights_ndarray
 	cdef double* points
 	cdef double* weights
+	cdef double* sorted_points
+	cdef double* sorted_weights
+	cdef double* cumulative_weights
 	cdef int n
 	cdef double bandwidth
+	cdef public object max_points
+	cdef void _build_index(self)
+	cdef void _copy_summaries(self, double* items, double* weights, int n,
+		int column_idx, int d)
 
 cdef class GaussianKernelDensity(KernelDensity):
-	pass
+	cdef double _tolerance
 
 cdef class UniformKernelDensity(KernelDensity):
 	pass
@@ -79,6 +91,16 @@ cdef class IndependentComponentsDistribution(MultivariateDistribution):
 	cdef double* weights_ptr
 	cdef void** distributions_ptr
 
+cdef struct MissingPattern:
+	# The marginal of a multivariate Gaussian over the k dimensions which are
+	# observed in rows with a given pattern of missing values, stored as the
+	# transpose of the inverse of its Cholesky factor and its log determinant.
+	char* mask
+	double* factor
+	double log_det
+	int k
+	unsigned long long last_used
+
 cdef class MultivariateGaussianDistribution(MultivariateDistribution):
 	cdef public numpy.ndarray mu, cov, inv_cov
 	cdef double* _mu
@@ -92,7 +114,20 @@ cdef class MultivariateGaussianDistribution(MultivariateDistribution):
 	cdef double* chol_dot_mu
 	cdef double* _inv_cov
 	cdef double* _inv_dot_mu
-	cdef double _log_probability_missing(self, double* X) nogil
+	cdef MissingPattern* patterns
+	cdef int n_patterns
+	cdef unsigned long long pattern_clock
+	cdef double** scratch
+	cdef int n_scratch, tile
+	cdef PyThread_type_lock lock
+	cdef double* _acquire_scratch(self) nogil
+	cdef void _release_scratch(self, double* z) nogil
+	cdef void _log_probability_float32(self, float* X, double* logp, int n) nogil
+	cdef void _log_probability_missing(self, double* X, double* logp, int* rows,
+		int n) nogil
+	cdef int _marginal(self, char* mask, int k, int* idx, double* factor,
+		double* log_det) nogil
+	cdef void _clear_patterns(self)
 
 cdef class DirichletDistribution(MultivariateDistribution):
 	cdef public numpy.ndarray alphas
@@ -5,15 +5,29 @@
 # Contact: Jacob Schreiber (jmschreiber91@gmail.com)
 
 from libc.stdlib cimport calloc
+from libc.stdlib cimport malloc
 from libc.stdlib cimport free
+from libc.stdlib cimport qsort
+from libc.string cimport memcmp
+from libc.string cimport memcpy
 from libc.string cimport memset
 from libc.math cimport exp as cexp
 from libc.math cimport fabs
 from libc.math cimport sqrt as csqrt
+from libc.math cimport NAN
 
 import time
 import scipy
 from scipy.linalg.cython_blas cimport dgemm
+from scipy.linalg.cython_blas cimport dtrmm
+from scipy.linalg.cython_lapack cimport dpotrf
+from scipy.linalg.cython_lapack cimport dtrtri
+
+from cpython.pythread cimport PyThread_allocate_lock
+from cpython.pythread cimport PyThread_free_lock
+from cpython.pythread cimport PyThread_acquire_lock
+from cpython.pythread cimport PyThread_release_lock
+from cpython.pythread cimport WAIT_LOCK
 
 import itertools as it
 import json
@@ -30,6 +44,7 @@ from .utils cimport mdot
 from .utils cimport ndarray_wrap_cpointer
 from .utils cimport _is_gpu_enabled
 from .utils cimport isnan
+from .utils import check_random_state
 
 from collections import OrderedDict
 
@@ -54,6 +69,9 @@ DEF NEGINF = float("-inf")
 DEF INF = float("inf")
 DEF SQRT_2_PI = 2.50662827463
 DEF LOG_2_PI = 1.83787706641
+DEF MISSING_PATTERN_CACHE_SIZE = 64
+DEF MVG_TILE_SIZE = 65536
+DEF MVG_SCRATCH_POOL_SIZE = 16
 eps = numpy.finfo(numpy.float64).eps
 
 
@@ -83,6 +101,66 @@ def weight_set(items, weights):
 
 	return items, weights
 
+def log_probability_out(out, shape):
+	"""Return an array to write the log probabilities of an input of the
+	given shape into, checking the one given by the caller if there is one."""
+
+	if out is None:
+		return numpy.empty(shape, dtype='float64')
+
+	if not isinstance(out, numpy.ndarray) or out.dtype != numpy.float64 or \
+		not out.flags['C_CONTIGUOUS'] or not out.flags['WRITEABLE']:
+		raise ValueError("out must be a writeable C-contiguous float64 array")
+
+	if out.shape != shape:
+		raise ValueError("out has shape {} but the input has shape {}".format(
+			out.shape, shape))
+
+	return out
+
+cdef inline int _lower_bound(double* X, int n, double x) nogil:
+	"""Return the index of the first of n sorted values which is not below x."""
+
+	cdef int lo = 0, hi = n, mid
+
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if X[mid] < x:
+			lo = mid + 1
+		else:
+			hi = mid
+
+	return lo
+
+cdef inline int _upper_bound(double* X, int n, double x) nogil:
+	"""Return the index of the first of n sorted values which is above x."""
+
+	cdef int lo = 0, hi = n, mid
+
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if X[mid] <= x:
+			lo = mid + 1
+		else:
+			hi = mid
+
+	return lo
+
+cdef struct PatternRow:
+	# A row with missing values and a hash of which of its values are missing.
+	unsigned long long hash
+	int row
+
+cdef int _compare_pattern_rows(const void* a, const void* b) nogil:
+	"""Order rows by the hash of their missing values, then by position."""
+
+	cdef PatternRow* x = <PatternRow*> a
+	cdef PatternRow* y = <PatternRow*> b
+
+	if x.hash != y.hash:
+		return -1 if x.hash < y.hash else 1
+	return x.row - y.row
+
 cdef class Distribution(Model):
 	"""A probability distribution.
 
@@ -154,42 +232,46 @@ cdef class Distribution(Model):
 
 		return self.__class__(*self.parameters)
 
-	def log_probability(self, X):
+	def log_probability(self, X, out=None):
 		"""Return the log probability of the given X under this distribution.
 
+		A C-contiguous float64 array is passed to the underlying kernel
+		without being copied, and the kernel runs without the GIL.
+
 		Parameters
 		----------
-		X : double
+		X : double or array-like
 			The X to calculate the log probability of (overridden for
-			DiscreteDistributions)
+			DiscreteDistributions). An array of any shape gives the log
+			probability of each of its elements.
+
+		out : numpy.ndarray or None, optional
+			A C-contiguous float64 array with the same shape as X to write
+			the log probabilities into instead of allocating a new array.
+			Default is None.
 
 		Returns
 		-------
-		logp : double
-			The log probability of that point under the distribution.
+		logp : double or numpy.ndarray
+			The log probability of that point under the distribution, or an
+			array of the same shape as X holding the log probability of each
+			element. If out is given, out is returned.
 		"""
 
-		cdef int i, n
-		cdef double logp
-		cdef numpy.ndarray logp_array
-		cdef numpy.ndarray X_ndarray
-		cdef double* X_ptr
-		cdef double* logp_ptr
+		cdef numpy.ndarray X_ndarray = numpy.asarray(X, dtype='float64', 
+			order='C')
+		cdef numpy.ndarray logp_ndarray = log_probability_out(out, 
+			numpy.shape(X_ndarray))
+		cdef double* X_ptr = <double*> X_ndarray.data
+		cdef double* logp_ptr = <double*> logp_ndarray.data
+		cdef int n = X_ndarray.size
 
-		n = 1 if isinstance(X, (int, float)) else len(X)
-
-		logp_array = numpy.empty(n, dtype='float64')
-		logp_ptr = <double*> logp_array.data
-
-		X_ndarray = numpy.array(X, dtype='float64')
-		X_ptr = <double*> X_ndarray.data
+		with nogil:
+			self._log_probability(X_ptr, logp_ptr, n)
 
-		self._log_probability(X_ptr, logp_ptr, n)
-
-		if n == 1:
-			return logp_array[0]
-		else:
-			return logp_array
+		if X_ndarray.ndim == 0 and out is None:
+			return logp_ndarray[()]
+		return logp_ndarray
 
 	def fit(self, items, weights=None, inertia=0.0, column_idx=0):
 		"""
@@ -264,6 +346,25 @@ cdef class Distribution(Model):
 
 		self.summaries = []
 
+	def _get_summaries(self):
+		"""Return a picklable copy of the stored sufficient statistics.
+
+		These can be sent to another process holding a copy of the
+		distribution and added to its statistics using `_merge_summaries`.
+		"""
+
+		return [numpy.array(summary) if isinstance(summary, numpy.ndarray) 
+			else summary for summary in self.summaries]
+
+	def _merge_summaries(self, summaries):
+		"""Add sufficient statistics returned by `_get_summaries` on a copy of
+		this distribution to the stored sufficient statistics."""
+
+		if len(self.summaries) == 0:
+			self.summaries = list(summaries)
+		else:
+			self.summaries = [a + b for a, b in zip(self.summaries, summaries)]
+
 	def plot(self, n=1000, **kwargs):
 		"""Plot the distribution by sampling from it.
 
@@ -361,6 +462,10 @@ cdef class Distribution(Model):
 			elif d['name'] == 'ConditionalProbabilityTable':
 				return ConditionalProbabilityTable(table, parents)
 
+		elif 'KernelDensity' in d['name']:
+			return eval(d['name'])(*d['parameters'], frozen=d['frozen'],
+				**d.get('settings', {}))
+
 		else:
 			dist = eval("{}({}, frozen={})".format(d['name'],
 			                                    ','.join(map(str, d['parameters'])),
@@ -413,9 +518,10 @@ cdef class UniformDistribution(Distribution):
 				log_probability[i] = NEGINF
 
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
 		"""Sample from this uniform distribution and return the value sampled."""
-		return numpy.random.uniform(self.start, self.end, n)
+		random_state = check_random_state(random_state)
+		return random_state.uniform(self.start, self.end, n)
 
 	cdef double _summarize(self, double* items, double* weights, int n, 
 		int column_idx, int d) nogil:
@@ -464,6 +570,11 @@ cdef class UniformDistribution(Distribution):
 
 		self.summaries = [INF, NEGINF, 0]
 
+	def _merge_summaries(self, summaries):
+		self.summaries = [min(self.summaries[0], summaries[0]), 
+			max(self.summaries[1], summaries[1]), 
+			self.summaries[2] + summaries[2]]
+
 	@classmethod
 	def blank(cls):
 		return UniformDistribution(0, 0)
@@ -503,8 +614,9 @@ cdef class BernoulliDistribution(Distribution):
 			else:
 				log_probability[i] = self.logp[<int> X[i]]
 
-	def sample(self, n=None):
-		return numpy.random.choice(2, p=[1-self.p, self.p], size=n)
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
+		return random_state.choice(2, p=[1-self.p, self.p], size=n)
 
 	cdef double _summarize(self, double* items, double* weights, int n,
 		int column_idx, int d) nogil:
@@ -577,8 +689,9 @@ cdef class NormalDistribution(Distribution):
 				log_probability[i] = self.log_sigma_sqrt_2_pi - ((X[i] - self.mu) ** 2) *\
 					self.two_sigma_squared
 
-	def sample(self, n=None):
-		return numpy.random.normal(self.mu, self.sigma, n)
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
+		return random_state.normal(self.mu, self.sigma, n)
 
 	cdef double _summarize(self, double* items, double* weights, int n,
 		int column_idx, int d) nogil:
@@ -672,9 +785,10 @@ cdef class LogNormalDistribution(Distribution):
 				log_probability[i] = -_log(X[i] * self.sigma * SQRT_2_PI) - 0.5\
 					* ((_log(X[i]) - self.mu) / self.sigma) ** 2
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
 		"""Return a sample from this distribution."""
-		return numpy.random.lognormal(self.mu, self.sigma, n)
+		random_state = check_random_state(random_state)
+		return random_state.lognormal(self.mu, self.sigma, n)
 
 	cdef double _summarize(self, double* items, double* weights, int n,
 		int column_idx, int d) nogil:
@@ -766,8 +880,9 @@ cdef class ExponentialDistribution(Distribution):
 			else:
 				log_probability[i] = self.log_rate - self.rate * X[i]
 
-	def sample(self, n=None):
-		return numpy.random.exponential(1. / self.parameters[0], n)
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
+		return random_state.exponential(1. / self.parameters[0], n)
 
 	cdef double _summarize(self, double* items, double* weights, int n,
 		int column_idx, int d) nogil:
@@ -859,9 +974,10 @@ cdef class BetaDistribution(Distribution):
 				log_probability[i] = beta_norm + (alpha-1)*_log(X[i]) + \
 					(beta-1)*_log(1-X[i])
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
 		"""Return a random sample from the beta distribution."""
-		return numpy.random.beta(self.alpha, self.beta, n)
+		random_state = check_random_state(random_state)
+		return random_state.beta(self.alpha, self.beta, n)
 
 	cdef double _summarize(self, double* items, double* weights, int n,
 		int column_idx, int d) nogil:
@@ -952,8 +1068,9 @@ cdef class GammaDistribution(Distribution):
 				log_probability[i] = (_log(beta) * alpha - lgamma(alpha) +
 					_log(X[i]) * (alpha - 1) - beta * X[i])
 
-	def sample(self, n=None):
-		return numpy.random.gamma(self.parameters[0], 1.0 / self.parameters[1])
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
+		return random_state.gamma(self.parameters[0], 1.0 / self.parameters[1], n)
 
 	def fit(self, items, weights=None, inertia=0.0, epsilon=1E-9,
 		iteration_limit=1000, column_idx=0):
@@ -1139,6 +1256,10 @@ cdef class DiscreteDistribution(Distribution):
 			d = parameters[0]
 			self.dist = d
 			self.log_dist = {key: _log(value) for key, value in d.items()}
+			self.version += 1
+
+			if self.encoded_keys is not None:
+				self.bake(self.encoded_keys)
 
 	def __cinit__(self, dict characters, bint frozen=False):
 		"""
@@ -1159,6 +1280,7 @@ cdef class DiscreteDistribution(Distribution):
 		self.encoded_keys = None
 		self.encoded_counts = NULL
 		self.encoded_log_probability = NULL
+		self.version = 0
 
 	def __dealloc__(self):
 		if self.encoded_keys is not None:
@@ -1257,16 +1379,75 @@ cdef class DiscreteDistribution(Distribution):
 			self.encoded_counts[i] = 0
 			self.encoded_log_probability[i] = self.log_dist.get(key, NEGINF)
 
-	def log_probability(self, X):
-		"""Return the log prob of the X under this distribution."""
+		self.version += 1
+
+	def log_probability(self, X, out=None):
+		"""Return the log prob of the X under this distribution.
 
-		return self.__log_probability(X)
+		If X is a list or a numpy array of any shape, the log probability
+		of each symbol in it is returned as a float64 array of that shape,
+		written into out if it is given. Numeric and string symbols are
+		looked up in bulk by a binary search over the sorted keys.
+		"""
+
+		if not isinstance(X, (list, numpy.ndarray)):
+			if out is None:
+				return self.__log_probability(X)
+
+			out = log_probability_out(out, ())
+			out[()] = self.__log_probability(X)
+			return out
+
+		# Symbols are only looked up in bulk when every key is a string, or
+		# every key a number, and X is of the same kind. Mixed and tuple
+		# keys are looked up one symbol at a time, as given.
+		keys = list(self.log_dist.keys())
+		if len(keys) > 0 and all(isinstance(key, str) for key in keys):
+			kinds = 'U'
+		elif len(keys) > 0 and all(isinstance(key, (int, float, numpy.number,
+			numpy.bool_)) for key in keys):
+			kinds = 'biuf'
+		else:
+			kinds = ''
+
+		try:
+			X_ndarray = numpy.asarray(X)
+		except ValueError:
+			X_ndarray = None
+
+		if X_ndarray is None or X_ndarray.dtype.kind not in kinds:
+			if isinstance(X, list):
+				out = log_probability_out(out, (len(X),))
+				out[:] = [self.__log_probability(x) for x in X]
+			else:
+				out = log_probability_out(out, X.shape)
+				out.flat = [self.__log_probability(x) for x in X.flat]
+			return out
+
+		X = X_ndarray
+		out = log_probability_out(out, X.shape)
+
+		values = numpy.array([self.log_dist[key] for key in keys])
+		keys = numpy.array(keys)
+		idx = numpy.argsort(keys, kind='mergesort')
+		keys, values = keys[idx], values[idx]
+
+		idx = numpy.searchsorted(keys, X).clip(0, len(keys)-1)
+		numpy.copyto(out, numpy.where(keys[idx] == X, values[idx], NEGINF))
+
+		if X.dtype.kind == 'f':
+			out[numpy.isnan(X)] = 0.
+		elif X.dtype.kind == 'U':
+			out[X == 'nan'] = 0.
+
+		return out
 
 	cdef double __log_probability(self, X):
 		if isinstance(X, (str, unicode)):
 			if X == 'nan':
 				return 0.
-		elif X is None or numpy.isnan(X):
+		elif X is None or (isinstance(X, (float, numpy.floating)) and 
+			numpy.isnan(X)):
 			return 0.
 
 		return self.log_dist.get(X, NEGINF)
@@ -1276,21 +1457,20 @@ cdef class DiscreteDistribution(Distribution):
 		for i in range(n):
 			if isnan(X[i]):
 				log_probability[i] = 0.
-			elif X[i] < 0 or X[i] > self.n:
+			elif X[i] < 0 or X[i] >= self.n:
 				log_probability[i] = NEGINF
 			else:
 				log_probability[i] = self.encoded_log_probability[<int> X[i]]
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
+		keys, probabilities = zip(*self.items())
+		probabilities = numpy.array(probabilities) / sum(probabilities)
+
+		idxs = random_state.choice(len(keys), size=n, p=probabilities)
 		if n is None:
-			rand = random.random()
-			for key, value in self.items():
-				if value >= rand:
-					return key
-				rand -= value
-		else:
-			samples = [self.sample() for i in range(n)]
-			return numpy.array(samples)
+			return keys[idxs]
+		return numpy.array([keys[idx] for idx in idxs])
 
 
 	def fit(self, items, weights=None, inertia=0.0, pseudocount=0.0,
@@ -1382,6 +1562,25 @@ cdef class DiscreteDistribution(Distribution):
 			for i in range(len(self.encoded_keys)):
 				self.encoded_counts[i] = 0
 
+	def _get_summaries(self):
+		encoded_counts = None
+		if self.encoded_summary == 1:
+			encoded_counts = [self.encoded_counts[i] for i in range(self.n)]
+
+		return [dict(self.summaries[0]), self.summaries[1], encoded_counts]
+
+	def _merge_summaries(self, summaries):
+		characters, total, encoded_counts = summaries
+
+		for key, value in characters.items():
+			self.summaries[0][key] = self.summaries[0].get(key, 0) + value
+		self.summaries[1] += total
+
+		if encoded_counts is not None:
+			self.encoded_summary = 1
+			for i in range(self.n):
+				self.encoded_counts[i] += encoded_counts[i]
+
 	def to_json(self, separators=(',', ' :'), indent=4):
 		"""Serialize the distribution to a JSON.
 
@@ -1478,8 +1677,9 @@ cdef class PoissonDistribution(Distribution):
 			else:
 				log_probability[i] = X[i] * self.logl - self.l - lgamma(X[i]+1)
 
-	def sample(self, n=None):
-		return numpy.random.poisson(self.l, n)
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
+		return random_state.poisson(self.l, n)
 
 	cdef double _summarize(self, double* items, double* weights, int n,
 		int column_idx, int d) nogil:
@@ -1529,21 +1729,35 @@ cdef class PoissonDistribution(Distribution):
 
 
 cdef class KernelDensity(Distribution):
-	"""An abstract kernel density, with shared properties and methods."""
+	"""An abstract kernel density, with shared properties and methods.
+
+	A copy of the points sorted by value is kept alongside the weights and
+	their running sum, so that each kernel only has to look at the points
+	within its support of a query, found by binary search. This index is
+	rebuilt whenever the points change.
+
+	The points given to `summarize` are stored as a list of chunks, each
+	batch appended without copying those before it, and only joined once
+	when `from_summaries` is called. If max_points is set, a uniform random
+	subset of at most that many points, keeping their weights, is kept.
+	"""
 
 	property parameters:
 		def __get__(self):
 			return [self.points_ndarray.tolist(), self.bandwidth, self.weights_ndarray.tolist()]
 		def __set__(self, parameters):
-			self.points_ndarray = numpy.array(parameters[0])
+			self.points_ndarray = numpy.array(parameters[0], dtype=numpy.float64)
 			self.points = <double*> self.points_ndarray.data
+			self.n = self.points_ndarray.shape[0]
 
 			self.bandwidth = parameters[1]
 
-			self.weights_ndarray = numpy.array(parameters[2])
+			self.weights_ndarray = numpy.array(parameters[2], dtype=numpy.float64)
 			self.weights = <double*> self.weights_ndarray.data
+			self._build_index()
 
-	def __cinit__(self, points=[], bandwidth=1, weights=None, frozen=False):
+	def __cinit__(self, points=[], bandwidth=1, weights=None, frozen=False,
+		*args, **kwargs):
 		"""
 		Take in points, bandwidth, and appropriate weights. If no weights
 		are provided, a uniform weight of 1/n is provided to each point.
@@ -1566,13 +1780,82 @@ cdef class KernelDensity(Distribution):
 		self.weights = <double*> self.weights_ndarray.data
 
 		self.bandwidth = bandwidth
-		self.summaries = []
+		self.summaries = [[], [], [], 0]
 		self.name = "KernelDensity"
 		self.frozen = frozen
+		self.max_points = None
+		self._build_index()
+
+	cdef void _build_index(self):
+		"""Sort the points, carrying their weights along, and store the running
+		sum of the sorted weights."""
+
+		idx = numpy.argsort(self.points_ndarray[:self.n], kind='mergesort')
+
+		self.sorted_points_ndarray = self.points_ndarray[idx]
+		self.sorted_points = <double*> self.sorted_points_ndarray.data
+
+		self.sorted_weights_ndarray = self.weights_ndarray[idx]
+		self.sorted_weights = <double*> self.sorted_weights_ndarray.data
+
+		self.cumulative_weights_ndarray = numpy.zeros(self.n+1, dtype=numpy.float64)
+		numpy.cumsum(self.sorted_weights_ndarray, out=self.cumulative_weights_ndarray[1:])
+		self.cumulative_weights = <double*> self.cumulative_weights_ndarray.data
 
 	def __reduce__(self):
 		"""Serialize the distribution for pickle."""
-		return self.__class__, (self.points_ndarray, self.bandwidth, self.weights_ndarray, self.frozen)
+		return self.__class__, (self.points_ndarray, self.bandwidth, 
+			self.weights_ndarray, self.frozen, self.max_points)
+
+	def _settings(self):
+		"""Return the keyword arguments, beyond the parameters, which a copy
+		of the distribution has to be made with."""
+		return {'max_points' : self.max_points}
+
+	def copy(self):
+		"""Return a deep copy of this distribution object.
+
+		This object will not be tied to any other distribution or connected
+		in any form.
+
+		Paramters
+		---------
+		None
+
+		Returns
+		-------
+		distribution : KernelDensity
+			A copy of the distribution with the same parameters and settings.
+		"""
+
+		return self.__class__(*self.parameters, **self._settings())
+
+	def to_json(self, separators=(',', ' :'), indent=4):
+		"""Serialize the distribution to a JSON.
+
+		Parameters
+		----------
+		separators : tuple, optional
+			The two separators to pass to the json.dumps function for formatting.
+			Default is (',', ' : ').
+
+		indent : int, optional
+			The indentation to use at each level. Passed to json.dumps for
+			formatting. Default is 4.
+
+		Returns
+		-------
+		json : str
+			A properly formatted JSON object.
+		"""
+
+		return json.dumps({
+								'class' : 'Distribution',
+								'name'  : self.name,
+								'parameters' : self.parameters,
+								'frozen' : self.frozen,
+								'settings' : self._settings()
+						   }, separators=separators, indent=indent)
 
 	def fit(self, points, weights=None, inertia=0.0, column_idx=0):
 		"""Replace the points, allowing for inertia if specified."""
@@ -1600,46 +1883,167 @@ cdef class KernelDensity(Distribution):
 		else:
 			self.points_ndarray = numpy.concatenate((self.points_ndarray, points))
 			self.weights_ndarray = numpy.concatenate((self.weights_ndarray*inertia, weights*(1-inertia)))
-			self.n = points.shape[0]
+			self.n = self.points_ndarray.shape[0]
 
 		self.points = <double*> self.points_ndarray.data
 		self.weights = <double*> self.weights_ndarray.data
+		self._build_index()
 
 	def summarize(self, items, weights=None, column_idx=0):
 		"""Summarize a batch of data into sufficient statistics for a later update.
 
+		The points are added to the stored summaries as a new chunk, so
+		summarizing many batches takes time linear in the number of points.
+		Missing values and points with no weight are dropped.
+
 		Parameters
 		----------
-		items : array-like, shape (n_samples, n_dimensions)
-			This is the data to train on. Each row is a sample, and each column
-			is a dimension to train on. For univariate distributions an array
-			is used, while for multivariate distributions a 2d matrix is used.
+		items : array-like, shape (n_samples,) or (n_samples, n_dimensions)
+			This is the data to train on. If a 2d matrix is given, the column
+			column_idx is used.
 
 		weights : array-like, shape (n_samples,), optional
 			The initial weights of each sample in the matrix. If nothing is
 			passed in then each sample is assumed to be the same weight.
 			Default is None.
 
+		column_idx : int, optional
+			The column of a 2d matrix to use. Default is 0.
+
 		Returns
 		-------
 		None
 		"""
 
-		# If no previously stored summaries, just store the incoming data
-		if len(self.summaries) == 0:
-			self.summaries = [items, weights]
+		items = numpy.array(items, dtype=numpy.float64)
+		if items.ndim == 2:
+			items = items[:, column_idx]
 
-		# Otherwise, append the items and weights
+		if weights is None:
+			weights = numpy.ones(items.shape[0], dtype=numpy.float64)
 		else:
-			prior_items, prior_weights = self.summaries
-			items = numpy.concatenate([prior_items, items])
+			weights = numpy.array(weights, dtype=numpy.float64)
+
+		self._append_summaries(items, weights)
+
+	cdef double _summarize(self, double* items, double* weights, int n,
+		int column_idx, int d) nogil:
+		with gil:
+			self._copy_summaries(items, weights, n, column_idx, d)
+
+	cdef void _copy_summaries(self, double* items, double* weights, int n,
+		int column_idx, int d):
+		"""Copy a column of points and their weights out of the buffers given
+		to _summarize and add them to the stored summaries."""
+
+		cdef numpy.ndarray items_ndarray = numpy.empty(n, dtype=numpy.float64)
+		cdef numpy.ndarray weights_ndarray = numpy.empty(n, dtype=numpy.float64)
+		cdef double* items_ptr = <double*> items_ndarray.data
+		cdef double* weights_ptr = <double*> weights_ndarray.data
+		cdef int i
+
+		for i in range(n):
+			items_ptr[i] = items[i*d + column_idx]
+			weights_ptr[i] = weights[i]
+
+		self._append_summaries(items_ndarray, weights_ndarray)
+
+	def _append_summaries(self, items, weights):
+		"""Add a chunk of points and their weights to the stored summaries."""
+
+		keep = (weights > 0) & ~numpy.isnan(items)
+		if not keep.all():
+			items, weights = items[keep], weights[keep]
+
+		if items.shape[0] == 0:
+			return
 
-			# If even one summary lacks weights, then weights can't be assigned
-			# to any of the points.
-			if weights is not None:
-				weights = numpy.concatenate([prior_weights, weights])
+		item_chunks, weight_chunks, key_chunks, n = self.summaries
+		item_chunks.append(items)
+		weight_chunks.append(weights)
+		self.summaries[3] = n + items.shape[0]
 
-			self.summaries = [items, weights]
+		if self.max_points is not None:
+			key_chunks.append(check_random_state(None).uniform(size=items.shape[0]))
+			if self.summaries[3] > 2 * self.max_points:
+				self._subsample_summaries()
+
+	def _subsample_summaries(self):
+		"""Keep the max_points stored points with the smallest random keys.
+
+		Every point is given a uniform random key when it is summarized, so
+		those with the smallest keys are a uniform random subset of all of
+		the points summarized, and stay so when summaries are merged. This is
+		done whenever twice as many points are stored, so the cost of each
+		point summarized is constant.
+		"""
+
+		item_chunks, weight_chunks, key_chunks, n = self.summaries
+		if n <= self.max_points:
+			return
+
+		# Points summarized before max_points was set have no keys.
+		if len(key_chunks) != len(item_chunks):
+			key_chunks = [check_random_state(None).uniform(size=items.shape[0])
+				for items in item_chunks]
+
+		keys = numpy.concatenate(key_chunks)
+		idx = numpy.argpartition(keys, self.max_points-1)[:self.max_points]
+
+		self.summaries = [[numpy.concatenate(item_chunks)[idx]],
+			[numpy.concatenate(weight_chunks)[idx]], [keys[idx]], self.max_points]
+
+	def from_summaries(self, inertia=0.0):
+		"""Replace the points with those summarized, allowing for inertia.
+
+		Parameters
+		----------
+		inertia : double, optional
+			The weight of the previous points, with the summarized points
+			weighted by 1-inertia. Default is 0.0.
+
+		Returns
+		-------
+		None
+		"""
+
+		# If the distribution is frozen, don't bother with any calculation
+		if self.frozen == True:
+			return
+
+		if self.summaries[3] > 0:
+			if self.max_points is not None:
+				self._subsample_summaries()
+
+			item_chunks, weight_chunks, _, _ = self.summaries
+			self.fit(numpy.concatenate(item_chunks), 
+				numpy.concatenate(weight_chunks), inertia)
+
+		self.clear_summaries()
+
+	def clear_summaries(self):
+		"""Clear the summary statistics stored in the object."""
+
+		self.summaries = [[], [], [], 0]
+
+	def _get_summaries(self):
+		"""Return the stored chunks of points, weights and keys."""
+
+		return [list(self.summaries[0]), list(self.summaries[1]), 
+			list(self.summaries[2]), self.summaries[3]]
+
+	def _merge_summaries(self, summaries):
+		"""Add the chunks returned by `_get_summaries` on a copy of this
+		distribution to those stored, without copying them."""
+
+		item_chunks, weight_chunks, key_chunks, n = summaries
+		self.summaries[0].extend(item_chunks)
+		self.summaries[1].extend(weight_chunks)
+		self.summaries[2].extend(key_chunks)
+		self.summaries[3] += n
+
+		if self.max_points is not None and self.summaries[3] > 2 * self.max_points:
+			self._subsample_summaries()
 
 	@classmethod
 	def blank(cls):
@@ -1651,34 +2055,81 @@ cdef class GaussianKernelDensity(KernelDensity):
 	A quick way of storing points to represent a Gaussian kernel density in one
 	dimension. Takes in the points at initialization, and calculates the log of
 	the sum of the Gaussian distance of the new point from every other point.
+
+	If a tolerance is given, points far enough from a query that their kernels
+	sum to less than the tolerance are skipped, and only those within a
+	window found by binary search over the sorted points are summed. A query
+	with no points in its window is evaluated against every point.
 	"""
 
-	def __cinit__(self, points=[], bandwidth=1, weights=None, frozen=False):
+	def __cinit__(self, points=[], bandwidth=1, weights=None, frozen=False,
+		tolerance=None, max_points=None):
 		self.name = "GaussianKernelDensity"
+		self.tolerance = tolerance
+		self.max_points = max_points
+
+	property tolerance:
+		def __get__(self):
+			return self._tolerance if self._tolerance > 0 else None
+		def __set__(self, tolerance):
+			if tolerance is not None and tolerance <= 0:
+				raise ValueError("tolerance must be positive")
+
+			self._tolerance = tolerance or 0
+
+	def __reduce__(self):
+		"""Serialize the distribution for pickle."""
+		return self.__class__, (self.points_ndarray, self.bandwidth,
+			self.weights_ndarray, self.frozen, self.tolerance, self.max_points)
+
+	def _settings(self):
+		"""Return the keyword arguments, beyond the parameters, which a copy
+		of the distribution has to be made with."""
+		return {'tolerance' : self.tolerance, 'max_points' : self.max_points}
 
 	cdef void _log_probability(self, double* X, double* log_probability, int n) nogil:
 		cdef double mu, w, scalar = 1.0 / SQRT_2_PI, prob, b = self.bandwidth
-		cdef int i, j
+		cdef double radius = 0
+		cdef double* points = self.points
+		cdef double* weights = self.weights
+		cdef int i, j, start, end
+
+		# Each point adds at most w / sqrt(2 pi) * exp(-0.5 (d/b)^2) and the
+		# weights sum to one, so dropping the points further than this from
+		# a query changes its density by less than the tolerance.
+		if self._tolerance > 0:
+			points = self.sorted_points
+			weights = self.sorted_weights
+
+			if self._tolerance * SQRT_2_PI < 1:
+				radius = b * csqrt(-2 * _log(self._tolerance * SQRT_2_PI))
 
 		for i in range(n):
+			start = 0
+			end = self.n
+
+			if self._tolerance > 0 and not isnan(X[i]):
+				start = _lower_bound(points, self.n, X[i] - radius)
+				end = _upper_bound(points, self.n, X[i] + radius)
+
+				if start == end:
+					start = 0
+					end = self.n
+
 			prob = 0.0
 
-			for j in range(self.n):
-				mu = self.points[j]
-				w = self.weights[j]
+			for j in range(start, end):
+				mu = points[j]
+				w = weights[j]
 				prob += w * scalar * cexp(-0.5*((mu-X[i]) / b) ** 2)
 
 			log_probability[i] = _log(prob)
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
 		sigma = self.parameters[1]
-		if n is None:
-			mu = numpy.random.choice(self.parameters[0], p=self.parameters[2])
-			return numpy.random.normal(mu, sigma)
-		else:
-			mus = numpy.random.choice(self.parameters[0], n, p=self.parameters[2])
-			samples = [numpy.random.normal(mu, sigma) for mu in mus]
-			return numpy.array(samples)
+		mu = random_state.choice(self.parameters[0], n, p=self.parameters[2])
+		return random_state.normal(mu, sigma)
 
 
 cdef class UniformKernelDensity(KernelDensity):
@@ -1688,38 +2139,31 @@ cdef class UniformKernelDensity(KernelDensity):
 	the sum of the Gaussian distances of the new point from every other point.
 	"""
 
-	def __cinit__(self, points=[], bandwidth=1, weights=None, frozen=False):
+	def __cinit__(self, points=[], bandwidth=1, weights=None, frozen=False,
+		max_points=None):
 		self.name = "UniformKernelDensity"
+		self.max_points = max_points
 
 	cdef void _log_probability(self, double* X, double* log_probability, int n) nogil:
-		cdef double mu, w, scalar = 1.0 / SQRT_2_PI, prob, b = self.bandwidth
-		cdef int i, j
+		cdef double prob, b = self.bandwidth
+		cdef int i, start, end
 
 		for i in range(n):
 			if isnan(X[i]):
 				log_probability[i] = 0.0
 				continue
 
-			prob = 0.0
-
-			for j in range(self.n):
-				mu = self.points[j]
-				w = self.weights[j]
-
-				if fabs(mu - X[i]) <= b:
-					prob += w
+			start = _lower_bound(self.sorted_points, self.n, X[i] - b)
+			end = _upper_bound(self.sorted_points, self.n, X[i] + b)
+			prob = self.cumulative_weights[end] - self.cumulative_weights[start]
 
 			log_probability[i] = _log(prob)
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
 		band = self.parameters[1]
-		if n is None:
-			mu = numpy.random.choice(self.parameters[0], p=self.parameters[2])
-			return numpy.random.uniform(mu-band, mu+band)
-		else:
-			mus = numpy.random.choice(self.parameters[0], n, p=self.parameters[2])
-			samples = [numpy.random.uniform(mu-band, mu+band) for mu in mus]
-			return numpy.array(samples)
+		mu = random_state.choice(self.parameters[0], n, p=self.parameters[2])
+		return random_state.uniform(mu-band, mu+band)
 
 
 cdef class TriangleKernelDensity(KernelDensity):
@@ -1729,13 +2173,15 @@ cdef class TriangleKernelDensity(KernelDensity):
 	the sum of the Gaussian distances of the new point from every other point.
 	"""
 
-	def __cinit__(self, points=[], bandwidth=1, weights=None, frozen=False):
+	def __cinit__(self, points=[], bandwidth=1, weights=None, frozen=False,
+		max_points=None):
 		self.name = "TriangleKernelDensity"
+		self.max_points = max_points
 
 	cdef void _log_probability(self, double* X, double* log_probability, int n) nogil:
-		cdef double mu, w, scalar = 1.0 / SQRT_2_PI, prob
+		cdef double mu, w, prob
 		cdef double hinge, b = self.bandwidth
-		cdef int i, j
+		cdef int i, j, start, end
 
 		for i in range(n):
 			if isnan(X[i]):
@@ -1743,25 +2189,23 @@ cdef class TriangleKernelDensity(KernelDensity):
 				continue
 
 			prob = 0.0
+			start = _upper_bound(self.sorted_points, self.n, X[i] - b)
+			end = _lower_bound(self.sorted_points, self.n, X[i] + b)
 
-			for j in range(self.n):
-				mu = self.points[j]
-				w = self.weights[j]
+			for j in range(start, end):
+				mu = self.sorted_points[j]
+				w = self.sorted_weights[j]
 				hinge = b - fabs(mu - X[i])
 				if hinge > 0:
 					prob += hinge * w
 
 			log_probability[i] = _log(prob)
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
 		band = self.parameters[1]
-		if n is None:
-			mu = numpy.random.choice(self.parameters[0], p=self.parameters[2])
-			return numpy.random.triangular(mu-band, mu, mu+band)
-		else:
-			mus = numpy.random.choice(self.parameters[0], n, p=self.parameters[2])
-			samples = [numpy.random.triangular(mu-band, mu, mu+band) for mu in mus]
-			return numpy.array(samples)
+		mu = random_state.choice(self.parameters[0], n, p=self.parameters[2])
+		return random_state.triangular(mu-band, mu, mu+band)
 
 cdef class MultivariateDistribution(Distribution):
 	"""
@@ -1929,11 +2373,14 @@ cdef class IndependentComponentsDistribution(MultivariateDistribution):
 				(<Model> self.distributions_ptr[j])._log_probability(X+i*self.d+j, &logp, 1)
 				log_probability[i] += logp * self.weights_ptr[j]
 
-	def sample(self, n=None):
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
 		if n is None:
-			return numpy.array([d.sample() for d in self.parameters[0]])
+			return numpy.array([d.sample(random_state=random_state)
+				for d in self.parameters[0]])
 		else:
-			return numpy.array([self.sample() for i in range(n)])
+			return numpy.array([d.sample(n, random_state=random_state)
+				for d in self.parameters[0]]).T
 
 	def fit(self, X, weights=None, inertia=0, pseudocount=0.0):
 		"""
@@ -1993,6 +2440,13 @@ cdef class IndependentComponentsDistribution(MultivariateDistribution):
 		for d in self.parameters[0]:
 			d.clear_summaries()
 
+	def _get_summaries(self):
+		return [d._get_summaries() for d in self.parameters[0]]
+
+	def _merge_summaries(self, summaries):
+		for d, summary in zip(self.parameters[0], summaries):
+			d._merge_summaries(summary)
+
 	def to_json(self, separators=(',', ' : '), indent=4):
 		"""Convert the distribution to JSON format."""
 
@@ -2023,6 +2477,63 @@ cdef class IndependentComponentsDistribution(MultivariateDistribution):
 		return IndependentComponentsDistribution(distributions, distribution_weights)
 
 
+ctypedef fused mvg_real:
+	float
+	double
+
+cdef int _mvg_log_probability(mvg_real* X, double* mu, double* inv_cov,
+	double log_det, int n, int d, int tile, double* z, double* logp,
+	int* missing) nogil:
+	"""Calculate the log probability of n rows of X under a multivariate
+	Gaussian, given its mean and the transposed inverse of the lower
+	Cholesky factor of its covariance, stored by row.
+
+	The rows are centered into z, tile rows at a time, and each tile is
+	whitened by one triangular matrix multiplication. Rows with missing
+	values are skipped, their positions written into missing and their
+	number returned.
+	"""
+
+	cdef int i, j, l, m, start = 0, n_missing = 0, next_missing
+	cdef bint has_missing
+	cdef double logp_i, alpha = 1
+
+	while start < n:
+		m = min(tile, n - start)
+		next_missing = n_missing
+
+		for l in range(m):
+			i = start + l
+			has_missing = False
+
+			for j in range(d):
+				z[l*d + j] = X[i*d + j] - mu[j]
+				has_missing = has_missing or isnan(z[l*d + j])
+
+			if has_missing:
+				missing[n_missing] = i
+				n_missing += 1
+
+		# Read by column inv_cov is the inverse of the lower factor L and each
+		# row of z is a column, so this sets y = L^-1 (x - mu) for every row.
+		dtrmm('L', 'L', 'N', 'N', &d, &m, &alpha, inv_cov, &d, z, &d)
+
+		for l in range(m):
+			i = start + l
+			if next_missing < n_missing and missing[next_missing] == i:
+				next_missing += 1
+				continue
+
+			logp_i = 0
+			for j in range(d):
+				logp_i += z[l*d + j] * z[l*d + j]
+
+			logp[i] = -0.5 * (d * LOG_2_PI + logp_i) - 0.5 * log_det
+
+		start += m
+
+	return n_missing
+
 cdef class MultivariateGaussianDistribution(MultivariateDistribution):
 	property parameters:
 		def __get__(self):
@@ -2030,6 +2541,7 @@ cdef class MultivariateGaussianDistribution(MultivariateDistribution):
 		def __set__(self, parameters):
 			self.mu = numpy.array(parameters[0])
 			self.cov = numpy.array(parameters[1])
+			self._clear_patterns()
 
 	def __cinit__(self, means=[], covariance=[], frozen=False):
 		"""
@@ -2067,20 +2579,142 @@ cdef class MultivariateGaussianDistribution(MultivariateDistribution):
 		self.pair_w_sum = <double*> calloc(d*d, sizeof(double))
 		self.clear_summaries()
 
+		self.patterns = <MissingPattern*> calloc(MISSING_PATTERN_CACHE_SIZE,
+			sizeof(MissingPattern))
+		self.n_patterns = 0
+		self.pattern_clock = 0
+		self.lock = PyThread_allocate_lock()
+
+		self.scratch = <double**> calloc(MVG_SCRATCH_POOL_SIZE, sizeof(double*))
+		self.n_scratch = 0
+		self.tile = max(1, MVG_TILE_SIZE // max(d, 1))
+
 	def __reduce__(self):
 		"""Serialize the distribution for pickle."""
 		return self.__class__, (self.mu, self.cov, self.frozen)
 
 	def __dealloc__(self):
+		cdef int i
+
 		free(self._mu_new)
 		free(self.column_sum)
 		free(self.column_w_sum)
 		free(self.pair_sum)
 		free(self.pair_w_sum)
 
+		if self.patterns != NULL:
+			self._clear_patterns()
+			free(self.patterns)
+
+		if self.scratch != NULL:
+			for i in range(self.n_scratch):
+				free(self.scratch[i])
+			free(self.scratch)
+
+		if self.lock != NULL:
+			PyThread_free_lock(self.lock)
+
+	cdef void _clear_patterns(self):
+		"""Forget the marginals cached for each pattern of missing values."""
+
+		cdef int i
+
+		for i in range(self.n_patterns):
+			free(self.patterns[i].mask)
+			free(self.patterns[i].factor)
+
+		self.n_patterns = 0
+
+	cdef double* _acquire_scratch(self) nogil:
+		"""Return a buffer for one tile of rows, reusing one released by an
+		earlier call if there is one."""
+
+		cdef double* z = NULL
+
+		PyThread_acquire_lock(self.lock, WAIT_LOCK)
+		if self.n_scratch > 0:
+			self.n_scratch -= 1
+			z = self.scratch[self.n_scratch]
+		PyThread_release_lock(self.lock)
+
+		if z == NULL:
+			z = <double*> malloc(self.tile*self.d*sizeof(double))
+
+		return z
+
+	cdef void _release_scratch(self, double* z) nogil:
+		"""Keep a buffer from _acquire_scratch for later calls, unless enough
+		are kept already."""
+
+		PyThread_acquire_lock(self.lock, WAIT_LOCK)
+		if self.n_scratch < MVG_SCRATCH_POOL_SIZE:
+			self.scratch[self.n_scratch] = z
+			self.n_scratch += 1
+			z = NULL
+		PyThread_release_lock(self.lock)
+
+		free(z)
+
+	def log_probability(self, X):
+		"""Return the log probability of the given X under this distribution.
+
+		Parameters
+		----------
+		X : list or numpy.ndarray
+			The point or points to calculate the log probability of. If one
+			point is passed in, then it will return a single log probability.
+			If a vector of points is passed in, then it will return a vector
+			of log probabilities. C-contiguous float64 and float32 arrays are
+			read as they are, without being copied.
+
+		Returns
+		-------
+		logp : double or numpy.ndarray
+			The log probability of that point under the distribution. If a
+			single point is passed in, it will return a single double
+			corresponding to that point. If a vector of points is passed in
+			then it will return a numpy array of log probabilities for each
+			point.
+		"""
+
+		cdef numpy.ndarray X_ndarray
+		cdef numpy.ndarray logp_ndarray
+		cdef double* logp_ptr
+		cdef void* X_ptr
+		cdef int n
+
+		if isinstance(X, numpy.ndarray) and X.dtype == numpy.float32:
+			X_ndarray = numpy.ascontiguousarray(X)
+		else:
+			X_ndarray = numpy.asarray(X, dtype='float64', order='C')
+
+		if X_ndarray.ndim not in (1, 2) or numpy.shape(X_ndarray)[-1] != self.d:
+			raise ValueError("X has shape {} but the distribution has {} "
+				"dimensions".format(numpy.shape(X_ndarray), self.d))
+
+		n = X_ndarray.size // self.d
+		logp_ndarray = numpy.empty(n, dtype='float64')
+
+		X_ptr = <void*> X_ndarray.data
+		logp_ptr = <double*> logp_ndarray.data
+
+		if X_ndarray.dtype == numpy.float32:
+			with nogil:
+				self._log_probability_float32(<float*> X_ptr, logp_ptr, n)
+		else:
+			with nogil:
+				self._log_probability(<double*> X_ptr, logp_ptr, n)
+
+		if n == 1:
+			return logp_ndarray[0]
+		else:
+			return logp_ndarray
+
 	cdef void _log_probability(self, double* X, double* logp, int n) nogil:
-		cdef int i, j, d = self.d
+		cdef int i, j, d = self.d, n_missing = 0
+		cdef int* missing = <int*> calloc(n, sizeof(int))
 		cdef double* dot
+		cdef double* z
 
 		if _is_gpu_enabled():
 			with gil:
@@ -2089,43 +2723,237 @@ cdef class MultivariateGaussianDistribution(MultivariateDistribution):
 				x2 = cupy.array(self.inv_cov)
 				dot_ndarray = cupy.dot(x1, x2).get()
 				dot = <double*> (<numpy.ndarray> dot_ndarray).data
+
+			for i in range(n):
+				logp[i] = 0
+				for j in range(d):
+					if isnan(X[i*d + j]):
+						missing[n_missing] = i
+						n_missing += 1
+						break
+					else:
+						logp[i] += (dot[i*d + j] - self._inv_dot_mu[j])**2
+				else:
+					logp[i] = -0.5 * (d * LOG_2_PI + logp[i]) - 0.5 * self._log_det
 		else:
-			dot = <double*> calloc(n*d, sizeof(double))
-			mdot(X, self._inv_cov, dot, n, d, d)
+			z = self._acquire_scratch()
+			n_missing = _mvg_log_probability(X, self._mu, self._inv_cov,
+				self._log_det, n, d, self.tile, z, logp, missing)
+			self._release_scratch(z)
+
+		if n_missing > 0:
+			self._log_probability_missing(X, logp, missing, n_missing)
+
+		free(missing)
+
+	cdef void _log_probability_float32(self, float* X, double* logp, int n) nogil:
+		cdef int i, j, d = self.d, n_missing
+		cdef int* missing = <int*> calloc(n, sizeof(int))
+		cdef int* rows
+		cdef double* X_missing
+		cdef double* logp_missing
+		cdef double* z = self._acquire_scratch()
+
+		n_missing = _mvg_log_probability(X, self._mu, self._inv_cov,
+			self._log_det, n, d, self.tile, z, logp, missing)
+		self._release_scratch(z)
+
+		# Only the rows with missing values are copied to float64.
+		if n_missing > 0:
+			rows = <int*> calloc(n_missing, sizeof(int))
+			X_missing = <double*> calloc(n_missing*d, sizeof(double))
+			logp_missing = <double*> calloc(n_missing, sizeof(double))
+
+			for i in range(n_missing):
+				rows[i] = i
+				for j in range(d):
+					X_missing[i*d + j] = X[missing[i]*d + j]
+
+			self._log_probability_missing(X_missing, logp_missing, rows,
+				n_missing)
+
+			for i in range(n_missing):
+				logp[missing[i]] = logp_missing[i]
+
+			free(rows)
+			free(X_missing)
+			free(logp_missing)
+
+		free(missing)
+
+	cdef void _log_probability_missing(self, double* X, double* logp, int* rows,
+		int n) nogil:
+		"""Calculate the log probability of the given rows, each of which has
+		missing values, under the marginal over their observed dimensions.
+
+		The rows are grouped by which of their values are missing, and each
+		group is scored with a single matrix multiplication by the inverse
+		Cholesky factor of its marginal, which is cached across calls.
+		"""
+
+		cdef int i, j, l, k, m, start = 0, end, d = self.d
+		cdef unsigned long long h
+		cdef double log_det, logp_i
+		cdef char* mask
+		cdef PatternRow* order = <PatternRow*> calloc(n, sizeof(PatternRow))
+		cdef char* masks = <char*> calloc(n*d, sizeof(char))
+		cdef char* done = <char*> calloc(n, sizeof(char))
+		cdef int* group = <int*> calloc(n, sizeof(int))
+		cdef int* idx = <int*> calloc(d, sizeof(int))
+		cdef double* factor = <double*> calloc(d*d, sizeof(double))
+		cdef double* z = <double*> calloc(n*d, sizeof(double))
+		cdef double* dot = <double*> calloc(n*d, sizeof(double))
 
 		for i in range(n):
-			logp[i] = 0
+			h = 14695981039346656037ULL
 			for j in range(d):
-				if isnan(X[i*d + j]):
-					logp[i] = self._log_probability_missing(X+i*d)
-					break
-				else:
-					logp[i] += (dot[i*d + j] - self._inv_dot_mu[j])**2
-			else:
-				logp[i] = -0.5 * (d * LOG_2_PI + logp[i]) - 0.5 * self._log_det
+				masks[i*d + j] = not isnan(X[rows[i]*d + j])
+				h = (h ^ <unsigned long long> masks[i*d + j]) * 1099511628211ULL
 
-		if not _is_gpu_enabled():
-			free(dot)
+			order[i].hash = h
+			order[i].row = i
 
-	cdef double _log_probability_missing(self, double* X) nogil:
-		cdef double logp
+		qsort(order, n, sizeof(PatternRow), _compare_pattern_rows)
 
-		with gil:
-			X_ndarray = ndarray_wrap_cpointer(X, self.d)
-			avail = ~numpy.isnan(X_ndarray)
-			if avail.sum() == 0:
-				return 0
+		while start < n:
+			end = start + 1
+			while end < n and order[end].hash == order[start].hash:
+				end += 1
 
-			a = numpy.ix_(avail, avail)
+			# Rows with the same hash almost always have the same values
+			# missing, but any which do not are split into their own groups.
+			for i in range(start, end):
+				if done[i]:
+					continue
 
+				mask = masks + order[i].row*d
+				m = 0
+				for l in range(i, end):
+					if not done[l] and memcmp(mask, masks + order[l].row*d, d) == 0:
+						group[m] = rows[order[l].row]
+						done[l] = 1
+						m += 1
 
-			d1 = MultivariateGaussianDistribution(self.mu[avail], self.cov[a])
-			logp = d1.log_probability(X_ndarray[avail])
+				k = 0
+				for j in range(d):
+					if mask[j]:
+						idx[k] = j
+						k += 1
 
-		return logp
+				if k == 0:
+					for l in range(m):
+						logp[group[l]] = 0
+					continue
 
-	def sample(self, n=None):
-		return numpy.random.multivariate_normal(self.parameters[0],
+				if self._marginal(mask, k, idx, factor, &log_det) != 0:
+					for l in range(m):
+						logp[group[l]] = NAN
+					continue
+
+				for l in range(m):
+					for j in range(k):
+						z[l*k + j] = X[group[l]*d + idx[j]] - self._mu[idx[j]]
+
+				mdot(z, factor, dot, m, k, k)
+
+				for l in range(m):
+					logp_i = 0
+					for j in range(k):
+						logp_i += dot[l*k + j] ** 2
+
+					logp[group[l]] = -0.5 * (k * LOG_2_PI + logp_i) - 0.5 * log_det
+
+			start = end
+
+		free(order)
+		free(masks)
+		free(done)
+		free(group)
+		free(idx)
+		free(factor)
+		free(z)
+		free(dot)
+
+	cdef int _marginal(self, char* mask, int k, int* idx, double* factor,
+		double* log_det) nogil:
+		"""Write the transposed inverse Cholesky factor and the log determinant
+		of the covariance of the k observed dimensions idx into factor and
+		log_det, taking them from the cache if they are there. Returns the
+		LAPACK info code, which is nonzero if the factorization failed."""
+
+		cdef int i, j, slot, info = 0, d = self.d
+		cdef char* mask_copy
+		cdef double* factor_copy
+
+		PyThread_acquire_lock(self.lock, WAIT_LOCK)
+		self.pattern_clock += 1
+		for i in range(self.n_patterns):
+			if memcmp(self.patterns[i].mask, mask, d) == 0:
+				memcpy(factor, self.patterns[i].factor, k*k*sizeof(double))
+				log_det[0] = self.patterns[i].log_det
+				self.patterns[i].last_used = self.pattern_clock
+				PyThread_release_lock(self.lock)
+				return 0
+
+		PyThread_release_lock(self.lock)
+
+		for i in range(k):
+			for j in range(k):
+				factor[i*k + j] = self._cov[idx[i]*d + idx[j]]
+
+		dpotrf('L', &k, factor, &k, &info)
+		if info != 0:
+			return info
+
+		log_det[0] = 0
+		for i in range(k):
+			log_det[0] += 2 * _log(factor[i*k + i])
+
+		dtrtri('L', 'N', &k, factor, &k, &info)
+		if info != 0:
+			return info
+
+		# LAPACK stores matrices by column, so read by row this is the
+		# transpose of the inverse factor, and the part below the diagonal
+		# still holds the covariance.
+		for i in range(k):
+			for j in range(i):
+				factor[i*k + j] = 0
+
+		mask_copy = <char*> malloc(d*sizeof(char))
+		factor_copy = <double*> malloc(k*k*sizeof(double))
+		if mask_copy == NULL or factor_copy == NULL:
+			free(mask_copy)
+			free(factor_copy)
+			return 0
+
+		memcpy(mask_copy, mask, d*sizeof(char))
+		memcpy(factor_copy, factor, k*k*sizeof(double))
+
+		PyThread_acquire_lock(self.lock, WAIT_LOCK)
+		if self.n_patterns < MISSING_PATTERN_CACHE_SIZE:
+			slot = self.n_patterns
+			self.n_patterns += 1
+		else:
+			slot = 0
+			for i in range(1, self.n_patterns):
+				if self.patterns[i].last_used < self.patterns[slot].last_used:
+					slot = i
+
+			free(self.patterns[slot].mask)
+			free(self.patterns[slot].factor)
+
+		self.patterns[slot].mask = mask_copy
+		self.patterns[slot].factor = factor_copy
+		self.patterns[slot].log_det = log_det[0]
+		self.patterns[slot].k = k
+		self.patterns[slot].last_used = self.pattern_clock
+		PyThread_release_lock(self.lock)
+		return 0
+
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
+		return random_state.multivariate_normal(self.parameters[0],
 			self.parameters[1], n)
 
 	cdef double _summarize(self, double* X, double* weights, int n,
@@ -2266,6 +3094,7 @@ cdef class MultivariateGaussianDistribution(MultivariateDistribution):
 		self._inv_cov = <double*> self.inv_cov.data
 
 		mdot(self._mu, self._inv_cov, self._inv_dot_mu, 1, d, d)
+		self._clear_patterns()
 		self.clear_summaries()
 
 	def clear_summaries(self):
@@ -2276,6 +3105,29 @@ cdef class MultivariateGaussianDistribution(MultivariateDistribution):
 		memset(self.pair_sum, 0, self.d*self.d*sizeof(double))
 		memset(self.pair_w_sum, 0, self.d*self.d*sizeof(double))
 
+	def _get_summaries(self):
+		cdef int d = self.d
+
+		return [ndarray_wrap_cpointer(self.column_sum, d*d).copy(),
+			ndarray_wrap_cpointer(self.column_w_sum, d).copy(),
+			ndarray_wrap_cpointer(self.pair_sum, d*d).copy(),
+			ndarray_wrap_cpointer(self.pair_w_sum, d*d).copy()]
+
+	def _merge_summaries(self, summaries):
+		cdef int i, d = self.d
+		cdef numpy.ndarray column_sum = numpy.asarray(summaries[0], dtype='float64')
+		cdef numpy.ndarray column_w_sum = numpy.asarray(summaries[1], dtype='float64')
+		cdef numpy.ndarray pair_sum = numpy.asarray(summaries[2], dtype='float64')
+		cdef numpy.ndarray pair_w_sum = numpy.asarray(summaries[3], dtype='float64')
+
+		for i in range(d*d):
+			self.column_sum[i] += (<double*> column_sum.data)[i]
+			self.pair_sum[i] += (<double*> pair_sum.data)[i]
+			self.pair_w_sum[i] += (<double*> pair_w_sum.data)[i]
+
+		for i in range(d):
+			self.column_w_sum[i] += (<double*> column_w_sum.data)[i]
+
 	@classmethod
 	def from_samples(cls, X, weights=None, **kwargs):
 		"""Fit a distribution to some data without pre-specifying it."""
@@ -2323,8 +3175,9 @@ cdef class DirichletDistribution(MultivariateDistribution):
 			for j in range(d):
 				log_probability[i] += self.alphas_ptr[j] * _log(X[i*d + j])
 
-	def sample(self, n=None):
-		return numpy.random.dirichlet(self.alphas, n)
+	def sample(self, n=None, random_state=None):
+		random_state = check_random_state(random_state)
+		return random_state.dirichlet(self.alphas, n)
 
 	cdef double _summarize(self, double* X, double* weights, int n,
 		int column_idx, int d) nogil:
@@ -2357,6 +3210,12 @@ cdef class DirichletDistribution(MultivariateDistribution):
 	def clear_summaries(self):
 		self.summaries_ndarray *= 0
 
+	def _get_summaries(self):
+		return self.summaries_ndarray.copy()
+
+	def _merge_summaries(self, summaries):
+		self.summaries_ndarray += summaries
+
 	def fit(self, X, weights=None, inertia=0.0, pseudocount=0.0):
 		self.summarize(X, weights)
 		self.from_summaries(inertia, pseudocount)
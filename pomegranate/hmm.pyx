@@ -8,9 +8,15 @@ from __future__ import print_function
 
 from cython.view cimport array as cvarray
 from libc.math cimport exp as cexp
+from libc.math cimport NAN
 from operator import attrgetter
-import math, random, itertools as it, sys, json
+import math, random, itertools as it, sys, json, heapq
 import networkx
+import functools
+import multiprocessing
+import os
+import pickle
+import shutil
 import tempfile
 import warnings
 import time
@@ -22,16 +28,30 @@ from .distributions cimport Distribution
 from .distributions cimport DiscreteDistribution
 from .distributions cimport IndependentComponentsDistribution
 from .kmeans import Kmeans
+from .io import EncodedSequence
+from .io import RaggedSequences
+from .io import SequenceShards
+from .io import _as_key
+from .io import _load_arrays
+from .io import _prefetch
+from .io import _save_arrays
 
 from .utils cimport _log
+from .utils cimport isnan
+from .utils cimport mdot
 from .utils cimport pair_lse
+from .utils import check_random_state
 
 from libc.stdlib cimport calloc
 from libc.stdlib cimport free
+from libc.stdlib cimport realloc
 from libc.string cimport memcpy
 from libc.string cimport memset
 
+from scipy.linalg.cython_blas cimport dgemm
+
 import numpy
+import scipy.sparse
 cimport numpy
 
 from joblib import Parallel
@@ -56,7 +76,52 @@ DEF NEGINF = float("-inf")
 DEF INF = float("inf")
 DEF SQRT_2_PI = 2.50662827463
 
+# The maximum number of cells, (length+1) * states * sequences, that a single
+# batch of sequences is allowed to hold in one dynamic programming matrix.
+DEF BATCH_CELLS = 4194304
+DEF MAX_BATCH_SIZE = 512
+
+# The number of tasks per thread that sequences are split into when work is
+# parallelized across sequences, so that idle threads can pick up the
+# remaining tasks of a thread which is running behind.
+DEF TASKS_PER_JOB = 4
+
+# The smallest number of non-silent states, and the smallest fraction of all
+# possible edges between them, for which bake will use the dense kernels.
+DEF DENSE_MIN_STATES = 32
+DEF DENSE_MIN_FRACTION = 0.5
+
+# The smallest normalizing constant allowed for a row of the scaled kernels
+# before they give up and fall back to log space.
+DEF SCALED_MIN = 1e-300
+
+# The maximum number of cells, symbols * states, of the emission lookup table
+# which bake will build for a discrete model.
+DEF EMISSION_TABLE_CELLS = 1048576
+
+# The largest range of integer symbols which a symbol encoder will cover with a
+# direct lookup table, and the number of alphabets it remembers the codes of.
+DEF INTEGER_TABLE_SIZE = 1048576
+DEF ENCODER_CACHE_SIZE = 64
+
+# The number of batches which are loaded and encoded ahead of training when
+# fitting to a stream of batches of sequences.
+DEF PREFETCH_BATCHES = 2
+
+# The number of sequences whose paths are sampled together by one thread, each
+# batch drawing from its own generator so that the samples do not depend on
+# the number of threads.
+DEF SAMPLE_BATCH_SIZE = 1024
+
 def _check_input(sequence, model):
+    if isinstance(sequence, EncodedSequence):
+        if not model.discrete and sequence.keymap is None:
+            return sequence.view(numpy.ndarray)
+        elif sequence.keymap is model.keymap or sequence.keymap == model.keymap:
+            return sequence.view(numpy.ndarray)
+
+        sequence = sequence.symbols()
+
     n = len(sequence)
 
     if not model.discrete:
@@ -64,40 +129,773 @@ def _check_input(sequence, model):
 
     elif model.multivariate and model.discrete:
         sequence_ndarray = numpy.empty((n, model.d), dtype=numpy.float64)
+        if n == 0:
+            return sequence_ndarray
 
-        for i in range(n):
-            for j in range(model.d):
-                symbol = sequence[i][j]
-                keymap = model.keymap[j]
-
-                if isinstance(symbol, str) and symbol == 'nan':
-                    sequence_ndarray[i, j] = numpy.nan
-                elif isinstance(symbol, (int, float)) and numpy.isnan(symbol):
-                    sequence_ndarray[i, j] = numpy.nan
-                elif symbol in keymap:
-                    sequence_ndarray[i, j] = keymap[symbol]
-                else:
-                    raise ValueError("Symbol '{}' is not defined in a distribution"
-                        .format(symbol))
+        if not isinstance(sequence, numpy.ndarray):
+            sequence = numpy.array(sequence, dtype=object)
+
+        for j in range(model.d):
+            sequence_ndarray[:, j] = model.encoders[j].encode(sequence[:, j])
     else:
-        sequence_ndarray = numpy.empty(n, dtype=numpy.float64)
-        keymap = model.keymap[0]
+        if n == 0:
+            return numpy.empty(0, dtype=numpy.float64)
 
-        for i in range(n):
-            symbol = sequence[i]
-
-            if isinstance(symbol, str) and symbol == 'nan':
-                sequence_ndarray[i] = numpy.nan
-            elif isinstance(symbol, (int, float)) and numpy.isnan(symbol):
-                sequence_ndarray[i] = numpy.nan
-            elif sequence[i] in keymap:
-                sequence_ndarray[i] = keymap[symbol]
-            else:
-                raise ValueError("Symbol '{}' is not defined in a distribution"
-                    .format(symbol))
+        sequence_ndarray = model.encoders[0].encode(sequence)
 
     return sequence_ndarray
 
+# The state of a process started by HiddenMarkovModel.fit with the
+# multiprocessing backend: its copy of the model, the training sequences, and
+# the iteration whose parameters the model holds.
+_training_worker = {}
+
+def _init_training_worker(model, directory, out_transitions):
+    """Set up a worker process for multiprocessing Baum-Welch.
+
+    The sequences are memory-mapped from the files written by the parent, so
+    every worker shares the same pages rather than holding its own copy.
+    """
+
+    _training_worker['model'] = model
+    _training_worker['X'] = RaggedSequences.load(os.path.join(directory, 
+        'sequences'))
+    _training_worker['parameters'] = os.path.join(directory, 'parameters')
+    _training_worker['iteration'] = None
+    _training_worker['valid'] = numpy.array_equal(out_transitions,
+        model._out_transitions())
+
+def _summarize_training_batch(batch, weights, iteration, algorithm,
+    memory_budget):
+    """Summarize a batch of sequences in a worker process, returning the log
+    probability of the batch and the sufficient statistics gathered.
+
+    The parameters of the model are written once per iteration by the parent,
+    and are only read by a worker on its first batch of each iteration.
+    """
+
+    if not _training_worker['valid']:
+        raise RuntimeError("the model was baked differently in a worker process")
+
+    model = _training_worker['model']
+    X = _training_worker['X']
+
+    if _training_worker['iteration'] != iteration:
+        with open(_training_worker['parameters'], 'rb') as infile:
+            model._set_parameters(pickle.load(infile))
+        _training_worker['iteration'] = iteration
+
+    logp = model.summarize([X[i] for i in batch], weights,
+        algorithm=algorithm, memory_budget=memory_budget)
+
+    summaries = model._get_summaries()
+    model.clear_summaries()
+    return logp, summaries
+
+cdef class SymbolEncoder(object):
+    """Encode discrete symbols into the integers of a keymap in bulk.
+
+    Rather than looking up each symbol in the keymap, the unique symbols of
+    an array are found with numpy and only those are looked up, after which
+    the codes are broadcast back to every observation. The codes of recently
+    seen alphabets are cached, and integer symbols are encoded directly
+    through a lookup table when the keymap holds a small range of integers.
+
+    Parameters
+    ----------
+    keymap : dict
+        The mapping from each symbol to its integer code.
+    """
+
+    cdef public dict keymap
+    cdef numpy.ndarray integer_table
+    cdef long integer_offset
+    cdef dict cache
+    cdef str key_kind
+
+    def __init__(self, keymap):
+        self.keymap = keymap
+        self.integer_table = None
+        self.integer_offset = 0
+        self.cache = {}
+
+        # Symbols are only encoded in bulk when numpy gives them the same
+        # kind as every key, 'U' for strings and 'f' for numbers, so that
+        # mixed or tuple alphabets are looked up as they are.
+        if all(isinstance(key, str) for key in keymap):
+            self.key_kind = 'U'
+        elif all(isinstance(key, (int, float, numpy.number, numpy.bool_)) 
+            for key in keymap):
+            self.key_kind = 'f'
+        else:
+            self.key_kind = 'O'
+
+        keys = [key for key, code in keymap.items() if _is_integer(key)]
+        if len(keys) > 0:
+            low, high = int(min(keys)), int(max(keys))
+
+            if high - low < INTEGER_TABLE_SIZE:
+                self.integer_table = numpy.empty(high - low + 1, dtype='float64')
+                self.integer_table[:] = numpy.nan
+                for key in keys:
+                    self.integer_table[int(key) - low] = keymap[key]
+
+                self.integer_offset = low
+
+    def __reduce__(self):
+        return self.__class__, (self.keymap,)
+
+    def encode(self, symbols):
+        """Encode an array of symbols.
+
+        Parameters
+        ----------
+        symbols : array-like, shape (n,)
+            The symbols to encode. The strings 'nan' and float NaN are missing
+            values and are encoded as NaN.
+
+        Returns
+        -------
+        codes : numpy.ndarray, shape (n,)
+            The float64 code of each symbol.
+        """
+
+        if not isinstance(symbols, numpy.ndarray) or symbols.dtype == object:
+            symbols = list(symbols)
+            values = numpy.asarray(symbols)
+        else:
+            values = symbols
+
+        kind = values.dtype.kind
+        if values.ndim != 1 or not ((kind == 'U' and self.key_kind == 'U') or 
+            (kind in 'biuf' and self.key_kind == 'f')):
+            return numpy.array([self._encode_symbol(symbol) for symbol in 
+                (symbols if isinstance(symbols, list) else symbols.tolist())], 
+                dtype='float64')
+
+        symbols = values
+        if symbols.dtype.kind in 'iu' and self.integer_table is not None:
+            idxs = symbols.astype('int64') - self.integer_offset
+            if idxs.min() >= 0 and idxs.max() < self.integer_table.shape[0]:
+                codes = self.integer_table[idxs]
+                if not numpy.isnan(codes).any():
+                    return codes
+
+        try:
+            alphabet, idxs = numpy.unique(symbols, return_inverse=True)
+        except TypeError:
+            return numpy.array([self._encode_symbol(symbol) 
+                for symbol in symbols.tolist()], dtype='float64')
+
+        if alphabet.dtype == object:
+            return self._encode_alphabet(alphabet)[idxs]
+
+        key = alphabet.dtype.str, alphabet.tobytes()
+        codes = self.cache.get(key)
+        if codes is None:
+            codes = self._encode_alphabet(alphabet)
+
+            if len(self.cache) >= ENCODER_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = codes
+
+        return codes[idxs]
+
+    def _encode_alphabet(self, alphabet):
+        return numpy.array([self._encode_symbol(symbol) 
+            for symbol in alphabet.tolist()], dtype='float64')
+
+    def _encode_symbol(self, symbol):
+        if isinstance(symbol, str) and symbol == 'nan':
+            return numpy.nan
+        elif isinstance(symbol, (int, float)) and numpy.isnan(symbol):
+            return numpy.nan
+        elif symbol in self.keymap:
+            return self.keymap[symbol]
+
+        raise ValueError("Symbol '{}' is not defined in a distribution"
+            .format(symbol))
+
+def _is_integer(key):
+    if isinstance(key, (bool, numpy.bool_)):
+        return False
+    elif isinstance(key, (int, numpy.integer)):
+        return True
+    return isinstance(key, float) and key.is_integer()
+
+def _check_sequences(sequences, model):
+    """Check a list of sequences or a RaggedSequences collection.
+
+    A collection is encoded for the model at most once and then returned as
+    views into its buffer, without copying each sequence.
+    """
+
+    if isinstance(sequences, RaggedSequences):
+        sequences = sequences.encode(model)
+
+    return [_check_input(sequence, model) for sequence in sequences]
+
+def _pad_sequences(sequences, d):
+    """Pack a list of checked sequences into a zero padded array.
+
+    Returns a contiguous float64 array of shape (n_sequences, max_length, d)
+    and an int32 array holding the true length of each sequence.
+    """
+
+    lengths = numpy.array([len(sequence) for sequence in sequences], dtype='int32')
+    n = lengths.max() if lengths.shape[0] > 0 else 0
+
+    X_padded = numpy.zeros((len(sequences), n, d), dtype='float64')
+    for j, sequence in enumerate(sequences):
+        X_padded[j, :lengths[j]] = numpy.asarray(sequence).reshape(lengths[j], d)
+
+    return X_padded, lengths
+
+def _length_batches(lengths, m):
+    """Group sequence indices into batches of similar lengths.
+
+    Sequences are sorted by length, longest first, and greedily packed so that
+    no batch holds more than BATCH_CELLS dynamic programming cells. This keeps
+    padding to a minimum and bounds the memory used by any single batch.
+    """
+
+    batches, batch = [], []
+    n = 0
+
+    for i in numpy.argsort(lengths, kind='mergesort')[::-1]:
+        if len(batch) == 0:
+            n = lengths[i]
+        elif (len(batch)+1) * (n+1) * m > BATCH_CELLS or len(batch) == MAX_BATCH_SIZE:
+            batches.append(batch)
+            batch, n = [], lengths[i]
+
+        batch.append(i)
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+def _balanced_batches(lengths, n_jobs):
+    """Split sequence indices into tasks with roughly equal total length.
+
+    Sequences are taken longest first and each is given to whichever task
+    holds the fewest observations so far. When n_jobs is above one the
+    sequences are split into TASKS_PER_JOB tasks per thread, returned most
+    expensive first, so that the small tasks at the end are picked up by
+    whichever threads finish early. Indices are sorted within each task.
+    """
+
+    lengths = numpy.asarray(lengths, dtype='int64')
+    n_tasks = n_jobs * TASKS_PER_JOB if n_jobs > 1 else 1
+    n_tasks = max(1, min(n_tasks, lengths.shape[0]))
+
+    tasks = [[] for j in range(n_tasks)]
+    costs = [(0, j) for j in range(n_tasks)]
+
+    for i in numpy.argsort(lengths, kind='mergesort')[::-1]:
+        cost, j = heapq.heappop(costs)
+        tasks[j].append(i)
+        heapq.heappush(costs, (cost + lengths[i] + 1, j))
+
+    costs.sort(reverse=True)
+    return [numpy.sort(numpy.array(tasks[j], dtype='int64')) for cost, j in costs]
+
+def _is_stream(sequences):
+    """Whether sequences are given as a source of batches of sequences, such
+    as a SequenceShards collection or a generator, rather than as a list."""
+
+    if isinstance(sequences, SequenceShards):
+        return True
+
+    return not (isinstance(sequences, RaggedSequences) or
+        hasattr(sequences, '__getitem__'))
+
+def _stream_passes(source):
+    """Iterate over the batches of a source again and again, yielding None
+    at the end of each pass. A one-shot iterator can only be passed over once
+    so iteration stops when it is exhausted, as it does for an empty source."""
+
+    while True:
+        batches = iter(source)
+        n = 0
+
+        for batch in batches:
+            n += 1
+            yield batch
+
+        yield None
+        if batches is source or n == 0:
+            return
+
+def _split_stream_batch(batch, model, batch_size):
+    """Check a batch from a stream and split it into lists of at most
+    batch_size sequences."""
+
+    if batch is None:
+        return None
+
+    X = _check_sequences(batch, model)
+    if batch_size is None:
+        return [X]
+
+    return [X[i:i+batch_size] for i in range(0, len(X), batch_size)]
+
+def _stream_batches(source, model, batch_size):
+    """Iterate over checked batches of sequences from a source without end,
+    loading them on a background thread. None marks the end of each pass."""
+
+    split = functools.partial(_split_stream_batch, model=model,
+        batch_size=batch_size)
+
+    prefetched = _prefetch(_stream_passes(source), split, PREFETCH_BATCHES)
+
+    try:
+        for batches in prefetched:
+            if batches is None:
+                yield None
+            else:
+                for batch in batches:
+                    if len(batch) > 0:
+                        yield batch
+    finally:
+        prefetched.close()
+
+def _stream_sample(source, discrete):
+    """Return the observations used to initialize a model from a stream of
+    batches of sequences. For a discrete model this is the distinct symbols in
+    every batch, otherwise it is every observation in the first batch."""
+
+    samples = []
+    for batch in source:
+        if isinstance(batch, RaggedSequences):
+            if discrete and batch.keymap is not None:
+                samples.append(numpy.array(list(batch.keymap[0]), dtype=object))
+                continue
+
+            batch = batch.symbols()
+
+        if len(batch) == 0:
+            continue
+
+        batch = numpy.concatenate([numpy.asarray(x) for x in batch])
+        if not discrete:
+            return batch
+
+        samples.append(numpy.unique(batch))
+
+    if len(samples) == 0:
+        raise ValueError("no sequences to train on")
+
+    return numpy.concatenate(samples)
+
+cdef struct ScratchArena:
+    # A block of memory that one thread carves its dynamic programming
+    # buffers out of. Nothing is freed until the arena is released, and
+    # requested counts every byte asked for so that the arena can grow to fit
+    # the largest call it has seen.
+    char* data
+    size_t capacity
+    size_t used
+    size_t requested
+    int index
+
+cdef void* _scratch_alloc(ScratchArena* arena, size_t size) nogil:
+    """Return size bytes of zeroed memory, taken from the arena if it is not
+    NULL and has room left, and from calloc otherwise."""
+
+    cdef void* ptr
+
+    size = (size + 15) & ~(<size_t> 15)
+    if arena != NULL:
+        arena.requested += size
+        if arena.used + size <= arena.capacity:
+            ptr = arena.data + arena.used
+            arena.used += size
+            memset(ptr, 0, size)
+            return ptr
+
+    return calloc(size, 1)
+
+cdef void _scratch_free(ScratchArena* arena, void* ptr) nogil:
+    """Free memory from _scratch_alloc, which only needs to be done if it was
+    not taken from the arena."""
+
+    if arena != NULL and <char*> ptr >= arena.data and \
+        <char*> ptr < arena.data + arena.capacity:
+        return
+
+    free(ptr)
+
+cdef struct IntBuffer:
+    # An array of ints which doubles in size whenever it fills up.
+    int* data
+    size_t size
+    size_t capacity
+
+cdef int _buffer_append(IntBuffer* buffer, int x) nogil:
+    """Append x to the buffer, returning -1 if it could not grow."""
+
+    cdef int* data
+
+    if buffer.size == buffer.capacity:
+        data = <int*> realloc(buffer.data, 2*(buffer.capacity+1)*sizeof(int))
+        if data == NULL:
+            return -1
+
+        buffer.data = data
+        buffer.capacity = 2*(buffer.capacity+1)
+
+    buffer.data[buffer.size] = x
+    buffer.size += 1
+    return 0
+
+cdef numpy.ndarray _buffer_array(IntBuffer* buffer):
+    """Return a copy of the ints in the buffer and free it."""
+
+    cdef numpy.ndarray y = numpy.empty(buffer.size, dtype='int32')
+    if buffer.size > 0:
+        memcpy(y.data, buffer.data, buffer.size*sizeof(int))
+
+    free(buffer.data)
+    buffer.data = NULL
+    buffer.size = buffer.capacity = 0
+    return y
+
+cdef struct DoubleBuffer:
+    # An array of doubles which doubles in size whenever it fills up.
+    double* data
+    size_t size
+    size_t capacity
+
+cdef int _double_buffer_append(DoubleBuffer* buffer, double x) nogil:
+    """Append x to the buffer, returning -1 if it could not grow."""
+
+    cdef double* data
+
+    if buffer.size == buffer.capacity:
+        data = <double*> realloc(buffer.data, 2*(buffer.capacity+1)*sizeof(double))
+        if data == NULL:
+            return -1
+
+        buffer.data = data
+        buffer.capacity = 2*(buffer.capacity+1)
+
+    buffer.data[buffer.size] = x
+    buffer.size += 1
+    return 0
+
+cdef numpy.ndarray _double_buffer_array(DoubleBuffer* buffer):
+    """Return a copy of the doubles in the buffer and free it."""
+
+    cdef numpy.ndarray y = numpy.empty(buffer.size, dtype='float64')
+    if buffer.size > 0:
+        memcpy(y.data, buffer.data, buffer.size*sizeof(double))
+
+    free(buffer.data)
+    buffer.data = NULL
+    buffer.size = buffer.capacity = 0
+    return y
+
+cdef double _kth_largest(double* x, int n, int k) nogil:
+    """Return the k-th largest value of x, reordering x in place."""
+
+    cdef int lo = 0, hi = n - 1, i, j
+    cdef double pivot
+
+    k -= 1
+    while lo < hi:
+        pivot = x[(lo + hi) / 2]
+        i, j = lo, hi
+
+        while i <= j:
+            while x[i] > pivot:
+                i += 1
+            while x[j] < pivot:
+                j -= 1
+            if i <= j:
+                x[i], x[j] = x[j], x[i]
+                i += 1
+                j -= 1
+
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            break
+
+    return x[k]
+
+cdef struct PosteriorSink:
+    # Takes the posterior log probabilities of one symbol at a time in place
+    # of the dense matrix. If top_k is above zero, the top_k most likely
+    # states of symbol i and their log probabilities are written, in
+    # descending order, to row i of states and values. Otherwise every state
+    # whose log probability is at least log_threshold is appended as an
+    # entry, and status is set if memory runs out.
+    int top_k
+    int* states
+    double* values
+    double log_threshold
+    IntBuffer rows
+    IntBuffer columns
+    DoubleBuffer entries
+    int status
+
+cdef void _sink_posteriors(PosteriorSink* sink, int i, double* r, int p) nogil:
+    """Pass the posterior log probabilities r of symbol i under each of the
+    p non-silent states to the sink."""
+
+    cdef int j, k, t = sink.top_k
+    cdef int* states
+    cdef double* values
+
+    if t > 0:
+        states = sink.states + i*t
+        values = sink.values + i*t
+
+        for j in range(t):
+            states[j] = -1
+            values[j] = NEGINF
+
+        for k in range(p):
+            if not r[k] > values[t-1]:
+                continue
+
+            j = t - 1
+            while j > 0 and values[j-1] < r[k]:
+                states[j] = states[j-1]
+                values[j] = values[j-1]
+                j -= 1
+
+            states[j] = k
+            values[j] = r[k]
+    else:
+        for k in range(p):
+            if r[k] >= sink.log_threshold:
+                sink.status |= _buffer_append(&sink.rows, i)
+                sink.status |= _buffer_append(&sink.columns, k)
+                sink.status |= _double_buffer_append(&sink.entries, r[k])
+
+cdef struct KBestPath:
+    # A path into a cell of the Viterbi matrix, stored as its log probability,
+    # the log probability of its last step and the rank-th best path into the
+    # cell node which it continues. The path holding only the start state has
+    # a node of -1.
+    double score
+    double weight
+    int node
+    int rank
+
+cdef struct KBestCell:
+    # The best paths into a cell of the Viterbi matrix found so far, in order,
+    # and a max-heap of the candidates for the next best path.
+    KBestPath* paths
+    int n_paths
+    int paths_capacity
+    KBestPath* heap
+    int heap_size
+    int heap_capacity
+    bint exhausted
+
+cdef int _kbest_append(KBestPath** paths, int* size, int* capacity, 
+    KBestPath path) nogil:
+    """Append a path to a growable array, returning -1 if it could not grow."""
+
+    cdef KBestPath* data
+
+    if size[0] == capacity[0]:
+        data = <KBestPath*> realloc(paths[0], 2*(capacity[0]+1)*sizeof(KBestPath))
+        if data == NULL:
+            return -1
+
+        paths[0] = data
+        capacity[0] = 2*(capacity[0]+1)
+
+    paths[0][size[0]] = path
+    size[0] += 1
+    return 0
+
+cdef int _kbest_push(KBestCell* cell, KBestPath path) nogil:
+    """Add a candidate path to the heap of a cell."""
+
+    cdef int i, parent
+
+    if _kbest_append(&cell.heap, &cell.heap_size, &cell.heap_capacity, 
+        path) != 0:
+        return -1
+
+    i = cell.heap_size - 1
+    while i > 0:
+        parent = (i - 1) / 2
+        if cell.heap[parent].score >= cell.heap[i].score:
+            break
+
+        cell.heap[parent], cell.heap[i] = cell.heap[i], cell.heap[parent]
+        i = parent
+
+    return 0
+
+cdef KBestPath _kbest_pop(KBestCell* cell) nogil:
+    """Remove and return the best candidate path in the heap of a cell."""
+
+    cdef int i = 0, child
+    cdef KBestPath best = cell.heap[0]
+
+    cell.heap_size -= 1
+    cell.heap[0] = cell.heap[cell.heap_size]
+
+    while True:
+        child = 2*i + 1
+        if child >= cell.heap_size:
+            break
+        if child + 1 < cell.heap_size and \
+            cell.heap[child+1].score > cell.heap[child].score:
+            child += 1
+        if cell.heap[i].score >= cell.heap[child].score:
+            break
+
+        cell.heap[child], cell.heap[i] = cell.heap[i], cell.heap[child]
+        i = child
+
+    return best
+
+cdef inline double _random_uniform(unsigned long long* state) nogil:
+    """Return a double drawn uniformly from [0, 1) by a splitmix64
+    generator, advancing its state."""
+
+    cdef unsigned long long z
+
+    state[0] += 0x9E3779B97F4A7C15ULL
+    z = state[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    z = z ^ (z >> 31)
+    return (z >> 11) * (1.0 / 9007199254740992.0)
+
+cdef void _alias_table(double* weights, int n, double* probabilities, 
+    int* aliases, int offset, int* small, int* large, double* scaled) nogil:
+    """Build the alias table of n weighted outcomes using Vose's method, so
+    that an outcome can be drawn with one uniform number. Entry i keeps
+    outcome offset+i with probability probabilities[i] and otherwise takes
+    outcome aliases[i]. small, large and scaled must hold n values."""
+
+    cdef int i, s, l, n_small = 0, n_large = 0
+    cdef double total = 0
+
+    for i in range(n):
+        total += weights[i]
+
+    for i in range(n):
+        aliases[i] = offset + i
+        probabilities[i] = 1.
+        if total > 0:
+            scaled[i] = weights[i] * n / total
+        else:
+            scaled[i] = 1.
+
+        if scaled[i] < 1:
+            small[n_small] = i
+            n_small += 1
+        else:
+            large[n_large] = i
+            n_large += 1
+
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        s = small[n_small]
+        l = large[n_large-1]
+
+        probabilities[s] = scaled[s]
+        aliases[s] = offset + l
+        scaled[l] += scaled[s] - 1
+
+        if scaled[l] < 1:
+            n_large -= 1
+            small[n_small] = l
+            n_small += 1
+
+cdef numpy.ndarray _int_array(int* x, int n):
+    """Return a copy of a C array of ints."""
+
+    cdef numpy.ndarray y = numpy.empty(n, dtype='int32')
+    if n > 0:
+        memcpy(y.data, x, n*sizeof(int))
+    return y
+
+cdef numpy.ndarray _double_array(double* x, int n):
+    """Return a copy of a C array of doubles."""
+
+    cdef numpy.ndarray y = numpy.empty(n, dtype='float64')
+    if n > 0:
+        memcpy(y.data, x, n*sizeof(double))
+    return y
+
+cdef void* _borrow(dict arrays, str name, dtype, list borrowed):
+    """Return a pointer to the data of a loaded array, which is kept alive
+    by adding it to borrowed."""
+
+    cdef numpy.ndarray array = numpy.ascontiguousarray(arrays[name], dtype=dtype)
+    borrowed.append(array)
+    return <void*> array.data
+
+def _graph_edges(graph, nodes):
+    """Return the edges of a graph as arrays, in the order networkx stores
+    them: the indices in nodes of the states each edge starts and ends in,
+    the log probability and pseudocount of each edge, and the group of each
+    edge as an object array."""
+
+    indices = {state: i for i, state in enumerate(nodes)}
+    edges = graph.edges(data=True)
+
+    starts = numpy.array([indices[a] for a, b, data in edges], dtype='int32')
+    ends = numpy.array([indices[b] for a, b, data in edges], dtype='int32')
+    probabilities = numpy.array([data['probability'] for a, b, data in edges], 
+        dtype='float64')
+    pseudocounts = numpy.array([data['pseudocount'] for a, b, data in edges], 
+        dtype='float64')
+
+    groups = numpy.empty(len(edges), dtype='object')
+    groups[:] = [data['group'] for a, b, data in edges]
+
+    return starts, ends, probabilities, pseudocounts, groups
+
+def _topological_sort(nodes, successors):
+    """Return nodes in topological order, given the successors of each in
+    the order they should be explored. This is a depth first search which
+    gives the same order as networkx.topological_sort with nbunch=nodes."""
+
+    seen, explored, order = set(), set(), []
+
+    for node in nodes:
+        if node in explored:
+            continue
+
+        fringe = [node]
+        while fringe:
+            w = fringe[-1]
+            if w in explored:
+                fringe.pop()
+                continue
+
+            seen.add(w)
+            new_nodes = []
+            for x in successors[w]:
+                if x not in explored:
+                    if x in seen:
+                        raise ValueError("silent states cannot form a cycle")
+                    new_nodes.append(x)
+
+            if new_nodes:
+                fringe.extend(new_nodes)
+            else:
+                explored.add(w)
+                order.append(w)
+                fringe.pop()
+
+    return order[::-1]
+
 # Useful python-based array-intended operations
 def log(value):
     """Return the natural log of the value or -infinity if the value is 0."""
@@ -149,6 +947,22 @@ cdef class HiddenMarkovModel(GraphModel):
     states : list
         The list of all states in the model, with silent states at the end
 
+    numerics : 'log' or 'scaled'
+        How the forward, backward and Baum-Welch kernels represent
+        probabilities. 'log' works in log space, using a log-sum-exp for
+        every edge. 'scaled' works in probability space, normalizing each
+        position to sum to one, which avoids most exp and log calls, and
+        falls back to log space for any sequence where a position
+        underflows. Default is 'log'.
+
+    scratch_limit : int or None
+        The largest number of bytes that each thread's scratch arena, which
+        holds the dynamic programming buffers of a single sequence between
+        calls, may grow to. Buffers which do not fit are allocated for the
+        call alone. If 0, no arenas are used. If None, the arenas grow to fit
+        the largest sequence seen. Use `free_scratch_buffers` to release
+        them. Default is None.
+
     Examples
     --------
     >>> from pomegranate import *
@@ -202,10 +1016,32 @@ cdef class HiddenMarkovModel(GraphModel):
     cdef int* out_transitions
     cdef int finite, n_tied_edge_groups
     cdef public list keymap
+    cdef public list encoders
     cdef object state_names
     cdef dict state_name_mapping
     cdef numpy.ndarray distributions
     cdef void** distributions_ptr
+    cdef public bint dense
+    cdef double* dense_transitions
+    cdef double* dense_transitions_t
+    cdef double* dense_starts
+    cdef double* dense_ends
+    cdef bint scaled
+    cdef double* in_transition_probabilities
+    cdef double* out_transition_probabilities
+    cdef double* emission_table
+    cdef int n_symbols
+    cdef long emission_version
+    cdef double* alias_probabilities
+    cdef int* alias_edges
+    cdef double* alias_no_end_probabilities
+    cdef int* alias_no_end_edges
+    cdef ScratchArena** arenas
+    cdef int n_arenas
+    cdef list free_arenas
+    cdef public object scratch_limit
+    cdef bint borrowed
+    cdef object borrowed_arrays
 
     def __init__(self, name=None, start=None, end=None):
         # Save the name or make up a name.
@@ -239,8 +1075,16 @@ cdef class HiddenMarkovModel(GraphModel):
         self.out_transitions = NULL
         self.out_transition_pseudocounts = NULL
         self.out_transition_log_probabilities = NULL
+        self.in_transition_probabilities = NULL
+        self.out_transition_probabilities = NULL
         self.expected_transitions = NULL
+        self.emission_table = NULL
+        self.alias_probabilities = NULL
+        self.alias_edges = NULL
+        self.alias_no_end_probabilities = NULL
+        self.alias_no_end_edges = NULL
         self.summaries = 0
+        self.scaled = 0
 
         self.tied_state_count = NULL
         self.tied = NULL
@@ -251,9 +1095,27 @@ cdef class HiddenMarkovModel(GraphModel):
         self.state_names = set()
         self.state_name_mapping = {}
 
+        self.arenas = NULL
+        self.n_arenas = 0
+        self.free_arenas = []
+        self.scratch_limit = None
+
+        self.borrowed = 0
+        self.borrowed_arrays = None
+
     def __dealloc__(self):
         self.free_bake_buffers()
 
+    property numerics:
+        def __get__(self):
+            return 'scaled' if self.scaled else 'log'
+
+        def __set__(self, value):
+            if value not in ('log', 'scaled'):
+                raise ValueError("numerics must be 'log' or 'scaled'")
+
+            self.scaled = value == 'scaled'
+
     def __getstate__(self):
         """Return model representation in a dictionary."""
 
@@ -265,7 +1127,10 @@ cdef class HiddenMarkovModel(GraphModel):
             'states' : self.states,
             'end_index' :    self.end_index,
             'start_index' :  self.start_index,
-            'silent_index' : self.silent_start
+            'silent_index' : self.silent_start,
+            'dense' :        bool(self.dense),
+            'numerics' :     self.numerics,
+            'scratch_limit' : self.scratch_limit
         }
 
         indices = { state: i for i, state in enumerate(self.states)}
@@ -346,24 +1211,134 @@ cdef class HiddenMarkovModel(GraphModel):
             self.add_transition(states[start], states[end], probability,
                 pseudocount, group)
 
-        # Bake the model
-        self.bake(verbose=False)
+        # Bake the model with the kernels it was baked with before
+        self.numerics = state.get('numerics', 'log')
+        self.scratch_limit = state.get('scratch_limit', None)
+        self.bake(verbose=False, dense=state.get('dense', None))
 
     def free_bake_buffers(self):
-        free(self.in_transition_pseudocounts)
-        free(self.out_transition_pseudocounts)
-        free(self.tied_state_count)
-        free(self.tied)
-        free(self.tied_edge_group_size)
-        free(self.tied_edges_starts)
-        free(self.tied_edges_ends)
+        # The edge lists of a loaded model point into the arrays it was
+        # loaded from, which may be memory-mapped, rather than being owned.
+        if not self.borrowed:
+            free(self.in_transition_pseudocounts)
+            free(self.out_transition_pseudocounts)
+            free(self.tied_state_count)
+            free(self.tied)
+            free(self.tied_edge_group_size)
+            free(self.tied_edges_starts)
+            free(self.tied_edges_ends)
+            free(self.in_edge_count)
+            free(self.in_transitions)
+            free(self.out_edge_count)
+            free(self.out_transitions)
+        else:
+            self.in_transition_pseudocounts = NULL
+            self.out_transition_pseudocounts = NULL
+            self.tied_state_count = NULL
+            self.tied = NULL
+            self.tied_edge_group_size = NULL
+            self.tied_edges_starts = NULL
+            self.tied_edges_ends = NULL
+            self.in_edge_count = NULL
+            self.in_transitions = NULL
+            self.out_edge_count = NULL
+            self.out_transitions = NULL
+
+            self.borrowed = 0
+            self.borrowed_arrays = None
+
         free(self.in_transition_log_probabilities)
         free(self.out_transition_log_probabilities)
         free(self.expected_transitions)
-        free(self.in_edge_count)
-        free(self.in_transitions)
-        free(self.out_edge_count)
-        free(self.out_transitions)
+        free(self.in_transition_probabilities)
+        free(self.out_transition_probabilities)
+        free(self.dense_transitions)
+        free(self.dense_transitions_t)
+        free(self.dense_starts)
+        free(self.dense_ends)
+        free(self.emission_table)
+        self._free_alias_tables()
+
+        self.in_transition_probabilities = NULL
+        self.out_transition_probabilities = NULL
+        self.dense_transitions = NULL
+        self.dense_transitions_t = NULL
+        self.dense_starts = NULL
+        self.dense_ends = NULL
+        self.dense = 0
+        self.emission_table = NULL
+        self.n_symbols = 0
+
+        self.free_scratch_buffers()
+
+    def free_scratch_buffers(self):
+        """Release the scratch memory kept for the dynamic programming buffers.
+
+        Each thread which runs a kernel on the model takes a scratch arena
+        which grows to fit the largest sequence it has seen and is reused by
+        later calls, avoiding an allocation for each buffer of each call. This
+        frees every arena, and must not be called while another thread is
+        using the model. New arenas are made as they are needed.
+        """
+
+        cdef int i
+
+        for i in range(self.n_arenas):
+            free(self.arenas[i].data)
+            free(self.arenas[i])
+
+        free(self.arenas)
+        self.arenas = NULL
+        self.n_arenas = 0
+        self.free_arenas = []
+
+    cdef ScratchArena* _acquire_scratch(self):
+        """Take a scratch arena for the calling thread, or return NULL if
+        scratch_limit is 0. The GIL serializes access to the pool."""
+
+        cdef ScratchArena** arenas
+        cdef ScratchArena* arena
+
+        if self.scratch_limit == 0:
+            return NULL
+
+        if self.free_arenas:
+            arena = self.arenas[self.free_arenas.pop()]
+        else:
+            arenas = <ScratchArena**> calloc(self.n_arenas+1, 
+                sizeof(ScratchArena*))
+            memcpy(arenas, self.arenas, self.n_arenas*sizeof(ScratchArena*))
+            free(self.arenas)
+            self.arenas = arenas
+
+            arena = <ScratchArena*> calloc(1, sizeof(ScratchArena))
+            arena.index = self.n_arenas
+            self.arenas[self.n_arenas] = arena
+            self.n_arenas += 1
+
+        arena.used = 0
+        arena.requested = 0
+        return arena
+
+    cdef void _release_scratch(self, ScratchArena* arena):
+        """Return a scratch arena to the pool, first growing it to fit
+        everything asked of it since it was taken, up to scratch_limit."""
+
+        cdef size_t size
+
+        if arena == NULL:
+            return
+
+        size = arena.requested
+        if self.scratch_limit is not None and size > self.scratch_limit:
+            size = self.scratch_limit
+
+        if size > arena.capacity:
+            free(arena.data)
+            arena.data = <char*> calloc(size, 1)
+            arena.capacity = size
+
+        self.free_arenas.append(arena.index)
 
 
     def add_state(self, state):
@@ -491,23 +1466,22 @@ cdef class HiddenMarkovModel(GraphModel):
         if groups is None or isinstance(groups, str):
             groups = [groups] * n
 
-        # Allow addition of many transitions from many states
-        if isinstance(a, list) and isinstance(b, list):
-            edges = izip(a, b, probabilities, pseudocounts, groups)
-            for start, end, probability, pseudocount, group in edges:
-                self.add_transition(start, end, probability, pseudocount, group)
-
         # Allow for multiple transitions to a specific state
-        elif isinstance(a, list) and isinstance(b, State):
-            edges = izip(a, probabilities, pseudocounts, groups)
-            for start, probability, pseudocount, group in edges:
-                self.add_transition(start, b, probability, pseudocount, group)
+        if isinstance(a, list) and isinstance(b, State):
+            b = it.repeat(b, n)
 
         # Allow for multiple transitions from a specific state
         elif isinstance(a, State) and isinstance(b, list):
-            edges = izip(b, probabilities, pseudocounts, groups)
-            for end, probability, pseudocount, group in edges:
-                self.add_transition(a, end, probability, pseudocount, group)
+            a = it.repeat(a, n)
+
+        elif not (isinstance(a, list) and isinstance(b, list)):
+            return
+
+        # Add the edges to the graph in one call rather than one at a time
+        edges = izip(a, b, probabilities, pseudocounts, groups)
+        self.graph.add_edges_from((start, end, {'probability': _log(probability),
+            'pseudocount': pseudocount or probability, 'group': group})
+            for start, end, probability, pseudocount, group in edges)
 
     def dense_transition_matrix(self):
         """Returns the dense transition matrix.
@@ -690,7 +1664,7 @@ cdef class HiddenMarkovModel(GraphModel):
             warnings.warn("Install pygraphviz for nicer visualizations")
             networkx.draw(self.graph, **kwargs)
 
-    def bake(self, verbose=False, merge="All"):
+    def bake(self, verbose=False, merge="All", dense=None):
         """Finalize the topology of the model.
 
         Finalize the topology of the model and assign a numerical index to
@@ -702,6 +1676,11 @@ cdef class HiddenMarkovModel(GraphModel):
         as well as self.start_index and self.end_index, and self.silent_start
         (the index of the first silent state).
 
+        The edges themselves stay in the networkx graph, which is what
+        add_transition, add_model, concatenate and serialization work on.
+        bake reads them out of the graph once and builds the edge lists from
+        numpy arrays, writing back only the edges that merging changes.
+
         Parameters
         ----------
         verbose : bool, optional
@@ -730,147 +1709,186 @@ cdef class HiddenMarkovModel(GraphModel):
                 intended.
             Default is 'All'.
 
+        dense : bool or None, optional
+            Whether to run the forward, backward and Baum-Welch kernels on a
+            dense transition matrix in scaled probability space using BLAS,
+            rather than on the sparse edge lists in log space. This is much
+            faster for large, densely connected models, but entries of the
+            forward and backward matrices which are hundreds of orders of
+            magnitude less likely than the best state at the same position
+            underflow to negative infinity. Requires that the only silent
+            states are the start and end states. If None, use the
+            dense kernels if the model has at least 32 non-silent states and
+            at least half of all possible edges between them. Default is None.
+
         Returns
         -------
         None
         """
 
-        self.free_bake_buffers()
+        cdef numpy.ndarray starts, ends, probabilities, pseudocounts, groups
+        cdef numpy.ndarray in_order, out_order, edge_count, tied, buffer
+        cdef int i, j
 
-        in_edge_count = numpy.zeros(len(self.graph.nodes()),
-            dtype=numpy.int32)
-        out_edge_count = numpy.zeros(len(self.graph.nodes()),
-            dtype=numpy.int32)
+        # The edges are read out of the graph once and every step below works
+        # on arrays of them, only writing changes back to the graph.
+        nodes = self.graph.nodes()
+        starts, ends, probabilities, pseudocounts, groups = _graph_edges(
+            self.graph, nodes)
 
         merge = merge.lower() if merge else None
-        while merge == 'all':
-            merge_count = 0
-
-            # Reindex the states based on ones which are still there
-            prestates = self.graph.nodes()
-            indices = { prestates[i]: i for i in range(len(prestates)) }
-
-            # Go through all the edges, summing in and out edges
-            for a, b in self.graph.edges():
-                out_edge_count[indices[a]] += 1
-                in_edge_count[indices[b]] += 1
-
-            # Go through each state, and if either in or out edges are 0,
-            # remove the edge.
-            for i in range(len(prestates)):
-                if prestates[i] is self.start or prestates[i] is self.end:
-                    continue
+        if merge == 'all':
+            # Repeatedly remove states which have no edges leading to them or
+            # no edges leaving them, other than the start and the end, until
+            # no orphan states remain.
+            alive = numpy.ones(len(nodes), dtype=bool)
+            removable = numpy.array([state is not self.start and state is not 
+                self.end for state in nodes], dtype=bool)
+            edge_alive = numpy.ones(len(starts), dtype=bool)
+
+            while True:
+                in_edge_count = numpy.bincount(ends[edge_alive], 
+                    minlength=len(nodes))
+                out_edge_count = numpy.bincount(starts[edge_alive], 
+                    minlength=len(nodes))
+
+                orphans = numpy.nonzero(alive & removable & ((in_edge_count == 0) 
+                    | (out_edge_count == 0)))[0]
+                if orphans.shape[0] == 0:
+                    break
 
-                if in_edge_count[i] == 0:
-                    merge_count += 1
-                    self.graph.remove_node(prestates[i])
+                for i in orphans:
+                    self.graph.remove_node(nodes[i])
 
-                    if verbose:
+                    if verbose and in_edge_count[i] == 0:
                         print("Orphan state {} removed due to no edges \
-                            leading to it".format(prestates[i].name))
-
-                elif out_edge_count[i] == 0:
-                    merge_count += 1
-                    self.graph.remove_node(prestates[i])
-
-                    if verbose:
+                            leading to it".format(nodes[i].name))
+                    elif verbose:
                         print("Orphan state {} removed due to no edges \
-                            leaving it".format(prestates[i].name))
+                            leaving it".format(nodes[i].name))
 
-            if merge_count == 0:
-                break
+                alive[orphans] = False
+                edge_alive = alive[starts] & alive[ends]
+
+            if not alive.all():
+                reindex = (numpy.cumsum(alive) - 1).astype('int32')
+                nodes = [state for state, keep in zip(nodes, alive) if keep]
+                starts = reindex[starts[edge_alive]]
+                ends = reindex[ends[edge_alive]]
+                probabilities = probabilities[edge_alive]
+                pseudocounts = pseudocounts[edge_alive]
+                groups = groups[edge_alive]
 
         # Go through the model checking to make sure out edges sum to 1.
         # Normalize them to 1 if this is not the case.
         if merge in ['all', 'partial']:
-            for state in self.graph.nodes():
+            totals = numpy.round(numpy.bincount(starts, weights=numpy.exp(
+                probabilities), minlength=len(nodes)), 8)
+            corrections = numpy.zeros(len(nodes), dtype='float64')
+
+            # The end state has no out edges, so will be 0
+            for i in numpy.nonzero(totals != 1.)[0]:
+                state = nodes[i]
+                if state is self.end:
+                    continue
 
-                # Perform log sum exp on the edges to see if they properly sum to 1
-                out_edges = round(sum(numpy.e**x['probability']
-                    for x in self.graph.edge[state].values()), 8)
+                # Issue a notice if verbose is activated
+                if verbose:
+                    print("{} : {} summed to {}, normalized to 1.0"\
+                        .format(self.name, state.name, float(totals[i])))
 
-                # The end state has no out edges, so will be 0
-                if out_edges != 1. and state != self.end:
-                    # Issue a notice if verbose is activated
-                    if verbose:
-                        print("{} : {} summed to {}, normalized to 1.0"\
-                            .format(self.name, state.name, out_edges))
+                # Reweight the edges so that the probability (not logp) sums
+                # to 1.
+                corrections[i] = log(float(totals[i]))
+                for edge in self.graph.edge[state].values():
+                    edge['probability'] = edge['probability'] - corrections[i]
 
-                    # Reweight the edges so that the probability (not logp) sums
-                    # to 1.
-                    for edge in self.graph.edge[state].values():
-                        edge['probability'] = edge['probability'] - log(out_edges)
+            probabilities -= corrections[starts]
 
         # Automatically merge adjacent silent states attached by a single edge
-        # of 1.0 probability, as that adds nothing to the model. Traverse the
-        # edges looking for 1.0 probability edges between silent states.
+        # of 1.0 probability, as that adds nothing to the model. Only edges
+        # leaving silent states can be merged, so only those are traversed.
+        merged = False
         while merge in ['all', 'partial']:
             # Repeatedly go through the model until no merges take place.
             merge_count = 0
 
-            for a, b, e in self.graph.edges(data=True):
+            candidates = [(a, b, e) for a in self.graph.nodes() if 
+                a.is_silent() for b, e in self.graph.edge[a].items()]
+
+            for a, b, e in candidates:
                 # Since we may have removed a or b in a previous iteration,
                 # a simple fix is to just check to see if it's still there
-                if a not in self.graph.nodes() or b not in self.graph.nodes():
+                if a not in self.graph or b not in self.graph:
                     continue
 
-                if a == self.start or b == self.end:
+                if a is self.start or b is self.end:
                     continue
 
-                # If a silent state has a probability 1 transition out
-                if e['probability'] == 0.0 and a.is_silent():
-
-                    # Make sure the transition is an appropriate merger
-                    if merge=='all' or (merge=='partial' and b.is_silent()):
-
-                        # Go through every transition to that state
-                        for x, y, d in self.graph.edges(data=True):
+                # If a silent state has a probability 1 transition out, and the
+                # transition is an appropriate merger
+                if e['probability'] == 0.0 and (merge == 'all' or b.is_silent()):
+                    # Go through every transition to that state
+                    for x, d in list(self.graph.pred[a].items()):
+                        # Increment the edge counter
+                        merge_count += 1
 
-                            # Make sure that the edge points to the current node
-                            if y is a:
-                                # Increment the edge counter
-                                merge_count += 1
+                        # Remove the edge going to that node
+                        self.graph.remove_edge(x, a)
 
-                                # Remove the edge going to that node
-                                self.graph.remove_edge(x, y)
+                        pseudo = max(e['pseudocount'], d['pseudocount'])
+                        group = e['group'] if e['group'] == d['group'] else None
+                        # Add a new edge going to the new node
+                        self.graph.add_edge(x, b, probability=d['probability'],
+                            pseudocount=pseudo, group=group)
 
-                                pseudo = max(e['pseudocount'], d['pseudocount'])
-                                group = e['group'] if e['group'] == d['group'] else None
-                                # Add a new edge going to the new node
-                                self.graph.add_edge(x, b, probability=d['probability'],
-                                    pseudocount=pseudo,
-                                    group=group)
+                        # Log the event
+                        if verbose:
+                            print("{} : {} - {} merged".format(
+                                self.name, a, b))
 
-                                # Log the event
-                                if verbose:
-                                    print("{} : {} - {} merged".format(
-                                        self.name, a, b))
-
-                        # Remove the state now that all edges are removed
-                        self.graph.remove_node(a)
+                    # Remove the state now that all edges are removed
+                    self.graph.remove_node(a)
+                    merged = True
 
             if merge_count == 0:
                 break
 
+        if merged:
+            nodes = self.graph.nodes()
+            starts, ends, probabilities, pseudocounts, groups = _graph_edges(
+                self.graph, nodes)
+
+        silent = numpy.array([state.is_silent() for state in nodes], dtype=bool)
+        silent_edges = numpy.nonzero(silent[starts] & silent[ends])[0]
+
         if merge in ['all', 'partial']:
-            # Detect whether or not there are loops of silent states by going
-            # through every pair of edges, and ensure that there is not a cycle
-            # of silent states.
-            for a, b, e in self.graph.edges(data=True):
-                for x, y, d in self.graph.edges(data=True):
-                    if a is y and b is x and a.is_silent() and b.is_silent():
-                        print("Loop: {} - {}".format(a.name, b.name))
+            # Detect whether or not there are loops of silent states by looking
+            # for pairs of edges between silent states in opposite directions.
+            pairs = set(zip(starts[silent_edges].tolist(), 
+                ends[silent_edges].tolist()))
+            for a, b in zip(starts[silent_edges], ends[silent_edges]):
+                if (b, a) in pairs:
+                    print("Loop: {} - {}".format(nodes[a].name, nodes[b].name))
+
+        n, m = len(nodes), starts.shape[0]
+
+        # Refuse dense kernels before the buffers of the previous bake are
+        # torn down, so that the model can still be used as it was.
+        if dense and (numpy.count_nonzero(silent) > 2 or 
+            self.graph.has_edge(self.start, self.end)):
+            raise ValueError("dense kernels require that the only silent states"
+                " are the start and end states")
 
-        states = self.graph.nodes()
-        n, m = len(states), len(self.graph.edges())
+        self.free_bake_buffers()
 
         self.n_edges = m
         self.n_states = n
 
         silent_states, normal_states = [], []
 
-        for state in states:
-            if state.is_silent():
+        for state, is_silent in zip(nodes, silent):
+            if is_silent:
                 silent_states.append(state)
             else:
                 normal_states.append(state)
@@ -885,13 +1903,11 @@ cdef class HiddenMarkovModel(GraphModel):
         # transition between silent states must be from a lower-numbered state
         # to a higher-numbered state. Since we ban loops of silent states, we
         # can get away with this.
+        successors = {state: [] for state in silent_states}
+        for a, b in zip(starts[silent_edges], ends[silent_edges]):
+            successors[nodes[a]].append(nodes[b])
 
-        # Get the subgraph of all silent states
-        silent_subgraph = self.graph.subgraph(silent_states)
-
-        # Get the sorted silent states. Isn't it convenient how NetworkX has
-        # exactly the algorithm we need?
-        silent_states_sorted = networkx.topological_sort(silent_subgraph, nbunch=silent_states)
+        silent_states_sorted = _topological_sort(silent_states, successors)
 
         # What's the index of the first silent state?
         self.silent_start = len(normal_states)
@@ -908,50 +1924,47 @@ cdef class HiddenMarkovModel(GraphModel):
 
         # Create a sparse representation of the tied states in the model. This
         # is done in the same way of the transition, by having a vector of
-        # counts, and a vector of the IDs that the state is tied to.
-        self.tied_state_count = <int*> calloc(self.silent_start+1, sizeof(int))
-        for i in range(self.silent_start+1):
-            self.tied_state_count[i] = 0
-
+        # counts, and a vector of the IDs that the state is tied to, found by
+        # grouping the states by the distribution object they hold.
+        tied_groups = {}
         for i in range(self.silent_start):
-            for j in range(self.silent_start):
-                if i == j:
-                    continue
-                if self.states[i].distribution is self.states[j].distribution:
-                    self.tied_state_count[i+1] += 1
-
-        for i in range(1, self.silent_start+1):
-            self.tied_state_count[i] += self.tied_state_count[i-1]
+            tied_groups.setdefault(id(self.states[i].distribution), []).append(i)
 
-        self.tied = <int*> calloc(self.tied_state_count[self.silent_start], sizeof(int))
-        for i in range(self.tied_state_count[self.silent_start]):
-            self.tied[i] = -1
+        tied_lists = [[j for j in tied_groups[id(self.states[i].distribution)]
+            if j != i] for i in range(self.silent_start)]
 
+        self.tied_state_count = <int*> calloc(self.silent_start+1, sizeof(int))
+        self.tied_state_count[0] = 0
         for i in range(self.silent_start):
-            for j in range(self.silent_start):
-                if i == j:
-                    continue
+            self.tied_state_count[i+1] = self.tied_state_count[i] + len(tied_lists[i])
 
-                if self.states[i].distribution is self.states[j].distribution:
-                    # Begin at the first index which belongs to state i...
-                    start = self.tied_state_count[i]
-
-                    # Find the first non -1 entry in order to put our index.
-                    while self.tied[start] != -1:
-                        start += 1
-
-                    # Now that we've found a non -1 entry, put the index of the
-                    # state which this state is tied to in!
-                    self.tied[start] = j
+        tied = numpy.array([j for tied_list in tied_lists for j in tied_list], 
+            dtype='int32')
+        self.tied = <int*> calloc(tied.shape[0], sizeof(int))
+        memcpy(self.tied, tied.data, tied.shape[0]*sizeof(int))
 
         # Unpack the state weights
         self.state_weights = numpy.zeros(self.silent_start)
         for i in range(self.silent_start):
             self.state_weights[i] = _log(self.states[i].weight)
 
-        # This holds numpy array indexed [a, b] to transition log probabilities
-        # from a to b, where a and b are state indices. It starts out saying all
-        # transitions are impossible.
+        # Now we need to find a way of storing in-edges for a state in a manner
+        # that can be called in the cythonized methods below. This is basically
+        # an inversion of the graph. We will do this by having two lists, one
+        # list size number of nodes + 1, and one list size number of edges.
+        # The node size list will store the beginning and end values in the
+        # edge list that point to that node. The edge list will be ordered in
+        # such a manner that all edges pointing to the same node are grouped
+        # together. This will allow us to run the algorithms in time
+        # nodes*edges instead of nodes*nodes. A stable sort of the edges by
+        # the state they end in (or start in) gives exactly these lists.
+        reindex = numpy.array([indices[state] for state in nodes], dtype='int32')
+        starts = reindex[starts]
+        ends = reindex[ends]
+
+        in_order = numpy.argsort(ends, kind='mergesort')
+        out_order = numpy.argsort(starts, kind='mergesort')
+
         self.in_transitions = <int*> calloc(m, sizeof(int))
         self.in_edge_count = <int*> calloc(n+1, sizeof(int))
         self.in_transition_pseudocounts = <double*> calloc(m,
@@ -968,89 +1981,42 @@ cdef class HiddenMarkovModel(GraphModel):
 
         self.expected_transitions =  <double*> calloc(self.n_edges, sizeof(double))
 
-        memset(self.in_transitions, -1, m*sizeof(int))
-        memset(self.in_edge_count, 0, (n+1)*sizeof(int))
-        memset(self.in_transition_pseudocounts, 0, m*sizeof(double))
-        memset(self.in_transition_log_probabilities, 0, m*sizeof(double))
+        edge_count = numpy.zeros(n+1, dtype='int32')
+        numpy.cumsum(numpy.bincount(ends, minlength=n), out=edge_count[1:])
+        memcpy(self.in_edge_count, edge_count.data, (n+1)*sizeof(int))
 
-        memset(self.out_transitions, -1, m*sizeof(int))
-        memset(self.out_edge_count, 0, (n+1)*sizeof(int))
-        memset(self.out_transition_pseudocounts, 0, m*sizeof(double))
-        memset(self.out_transition_log_probabilities, 0, m*sizeof(double))
+        edge_count = numpy.zeros(n+1, dtype='int32')
+        numpy.cumsum(numpy.bincount(starts, minlength=n), out=edge_count[1:])
+        memcpy(self.out_edge_count, edge_count.data, (n+1)*sizeof(int))
 
-        # Now we need to find a way of storing in-edges for a state in a manner
-        # that can be called in the cythonized methods below. This is basically
-        # an inversion of the graph. We will do this by having two lists, one
-        # list size number of nodes + 1, and one list size number of edges.
-        # The node size list will store the beginning and end values in the
-        # edge list that point to that node. The edge list will be ordered in
-        # such a manner that all edges pointing to the same node are grouped
-        # together. This will allow us to run the algorithms in time
-        # nodes*edges instead of nodes*nodes.
-        for a, b in self.graph.edges_iter():
-            # Increment the total number of edges going to node b.
-            self.in_edge_count[indices[b]+1] += 1
-            # Increment the total number of edges leaving node a.
-            self.out_edge_count[indices[a]+1] += 1
+        buffer = starts[in_order]
+        memcpy(self.in_transitions, buffer.data, m*sizeof(int))
+        buffer = probabilities[in_order]
+        memcpy(self.in_transition_log_probabilities, buffer.data, m*sizeof(double))
+        buffer = pseudocounts[in_order]
+        memcpy(self.in_transition_pseudocounts, buffer.data, m*sizeof(double))
+
+        buffer = ends[out_order]
+        memcpy(self.out_transitions, buffer.data, m*sizeof(int))
+        buffer = probabilities[out_order]
+        memcpy(self.out_transition_log_probabilities, buffer.data, m*sizeof(double))
+        buffer = pseudocounts[out_order]
+        memcpy(self.out_transition_pseudocounts, buffer.data, m*sizeof(double))
 
         # Determine if the model is infinite or not based on the number of edges
         # to the end state
-        if self.in_edge_count[indices[self.end]+1] == 0:
+        i = indices[self.end]
+        if self.in_edge_count[i+1] == self.in_edge_count[i]:
             self.finite = 0
         else:
             self.finite = 1
-        # Take the cumulative sum so that we can associate array indices with
-        # in or out transitions
-        for i in xrange(1, n+1):
-            self.in_edge_count[i] += self.in_edge_count[i-1]
-            self.out_edge_count[i] += self.out_edge_count[i-1]
 
-        # We need to store the edge groups as name : set pairs.
+        # We need to store the edge groups as name : list pairs, in the order
+        # the edges are stored in the graph. We only care about forward
+        # representations of the edges.
         edge_groups = {}
-
-        # Now we go through the edges again in order to both fill in the
-        # transition probability matrix, and also to store the indices sorted
-        # by the end-node.
-        for a, b, data in self.graph.edges_iter(data=True):
-            # Put the edge in the dict. Its weight is log-probability
-            start = self.in_edge_count[indices[b]]
-
-            # Start at the beginning of the section marked off for node b.
-            # If another node is already there, keep walking down the list
-            # until you find a -1 meaning a node hasn't been put there yet.
-            while self.in_transitions[start] != -1:
-                if start == self.in_edge_count[indices[b]+1]:
-                    break
-                start += 1
-
-            self.in_transition_log_probabilities[start] = <double>data['probability']
-            self.in_transition_pseudocounts[start] = data['pseudocount']
-
-            # Store transition info in an array where the in_edge_count shows
-            # the mapping stuff.
-            self.in_transitions[start] = <int>indices[a]
-
-            # Now do the same for out edges
-            start = self.out_edge_count[indices[a]]
-
-            while self.out_transitions[start] != -1:
-                if start == self.out_edge_count[indices[a]+1]:
-                    break
-                start += 1
-
-            self.out_transition_log_probabilities[start] = <double>data['probability']
-            self.out_transition_pseudocounts[start] = data['pseudocount']
-            self.out_transitions[start] = <int>indices[b]
-
-            # If this edge belongs to a group, we need to add it to the
-            # dictionary. We only care about forward representations of
-            # the edges.
-            group = data['group']
-            if group != None:
-                if group in edge_groups:
-                    edge_groups[group].append((indices[a], indices[b]))
-                else:
-                    edge_groups[group] = [(indices[a], indices[b])]
+        for i in numpy.nonzero(groups != None)[0]:
+            edge_groups.setdefault(groups[i], []).append((starts[i], ends[i]))
 
         # We will organize the tied edges using three arrays. The first will be
         # the cumulative number of members in each group, to slice the later
@@ -1121,15 +2087,6 @@ cdef class HiddenMarkovModel(GraphModel):
                 if isinstance(d, IndependentComponentsDistribution):
                     d.bake(keys)
 
-        self.state_name_mapping = {state.name: i for i, state in enumerate(self.states)}
-        self.distributions = numpy.empty(self.silent_start, dtype='object')
-        for i in range(self.silent_start):
-            self.distributions[i] = self.states[i].distribution
-            if self.d != self.distributions[i].d:
-                raise ValueError("mis-matching inputs for states")
-
-        self.distributions_ptr = <void**> self.distributions.data
-
         # This holds the index of the start state
         try:
             self.start_index = indices[self.start]
@@ -1143,26 +2100,304 @@ cdef class HiddenMarkovModel(GraphModel):
             raise SyntaxError("Model.end has been deleted, leaving the \
                 model with no end. Please ensure it has an end.")
 
+        self._bake_tables(dense)
 
-    def sample(self, length=0, path=False):
-        """Generate a sequence from the model.
+    def _bake_tables(self, dense):
+        """Build everything which bake derives from the states and the edge
+        lists: the symbol encoders, the array of distributions, and the
+        transition probability, dense and emission tables."""
 
-        Returns the sequence generated, as a list of emitted items. The
-        model must have been baked first in order to run this method.
+        cdef int i, p
 
-        If a length is specified and the HMM is infinite (no edges to the
-        end state), then that number of samples will be randomly generated.
-        If the length is specified and the HMM is finite, the method will
-        attempt to generate a prefix of that length. Currently it will force
-        itself to not take an end transition unless that is the only path,
-        making it not a true random sample on a finite model.
+        if self.discrete:
+            self.encoders = [SymbolEncoder(keymap) for keymap in self.keymap]
 
-        WARNING: If the HMM has no explicit end state, must specify a length
-        to use.
+        self.state_name_mapping = {state.name: i for i, state in enumerate(self.states)}
+        self.distributions = numpy.empty(self.silent_start, dtype='object')
+        for i in range(self.silent_start):
+            self.distributions[i] = self.states[i].distribution
+            if self.d != self.distributions[i].d:
+                raise ValueError("mis-matching inputs for states")
 
-        Parameters
-        ----------
-        length : int, optional
+        self.distributions_ptr = <void**> self.distributions.data
+
+        if dense is None:
+            dense = self._dense_compatible() and self.silent_start >= \
+                DENSE_MIN_STATES and self.out_edge_count[self.silent_start] >= \
+                DENSE_MIN_FRACTION * self.silent_start * self.silent_start
+
+        self.in_transition_probabilities = <double*> calloc(self.n_edges, 
+            sizeof(double))
+        self.out_transition_probabilities = <double*> calloc(self.n_edges, 
+            sizeof(double))
+
+        if dense:
+            p = self.silent_start
+            self.dense_transitions = <double*> calloc(p*p, sizeof(double))
+            self.dense_transitions_t = <double*> calloc(p*p, sizeof(double))
+            self.dense_starts = <double*> calloc(p, sizeof(double))
+            self.dense_ends = <double*> calloc(p, sizeof(double))
+            self.dense = 1
+
+        # Discrete models over a small alphabet look their emissions up in a
+        # table of every symbol under every state instead of calling into
+        # the distributions for each observation.
+        if self.discrete and not self.multivariate and all(isinstance(
+            distribution, DiscreteDistribution) for distribution in 
+            self.distributions) and (len(self.keymap[0]) + 2) * \
+            self.silent_start <= EMISSION_TABLE_CELLS:
+            self.n_symbols = len(self.keymap[0])
+            self.emission_table = <double*> calloc((self.n_symbols+2) * 
+                self.silent_start, sizeof(double))
+
+        self._update_transition_probabilities()
+        self._update_emission_table()
+
+    cdef bint _dense_compatible(self):
+        """Return whether the dense kernels can represent this model."""
+
+        cdef int k, l
+
+        if self.n_states - self.silent_start != 2:
+            return 0
+
+        for l in range(self.out_edge_count[self.start_index], 
+            self.out_edge_count[self.start_index+1]):
+            if self.out_transitions[l] >= self.silent_start:
+                return 0
+
+        return 1
+
+    cdef void _update_transition_probabilities(self) nogil:
+        """Copy the transition log probabilities into the arrays used by the
+        scaled and dense kernels."""
+
+        cdef int l
+
+        for l in range(self.n_edges):
+            self.in_transition_probabilities[l] = cexp(
+                self.in_transition_log_probabilities[l])
+            self.out_transition_probabilities[l] = cexp(
+                self.out_transition_log_probabilities[l])
+
+        if self.dense:
+            self._dense_update()
+
+        # The alias tables are rebuilt from the new probabilities the next
+        # time the model is sampled from.
+        self._free_alias_tables()
+
+    cdef void _free_alias_tables(self) nogil:
+        free(self.alias_probabilities)
+        free(self.alias_edges)
+        free(self.alias_no_end_probabilities)
+        free(self.alias_no_end_edges)
+
+        self.alias_probabilities = NULL
+        self.alias_edges = NULL
+        self.alias_no_end_probabilities = NULL
+        self.alias_no_end_edges = NULL
+
+    cdef void _build_alias_tables(self) nogil:
+        """Build the alias tables which sampling draws the edge out of each
+        state from, if they have not been built since the transition
+        probabilities last changed. The second table leaves out the edges to
+        the end state, unless a state has no other edges."""
+
+        cdef int k, l, start, n, m = self.n_edges
+        cdef double* weights
+        cdef int* small
+        cdef int* large
+        cdef double* scaled
+
+        if self.alias_probabilities != NULL:
+            return
+
+        self.alias_probabilities = <double*> calloc(m+1, sizeof(double))
+        self.alias_edges = <int*> calloc(m+1, sizeof(int))
+        self.alias_no_end_probabilities = <double*> calloc(m+1, sizeof(double))
+        self.alias_no_end_edges = <int*> calloc(m+1, sizeof(int))
+
+        weights = <double*> calloc(m+1, sizeof(double))
+        small = <int*> calloc(m+1, sizeof(int))
+        large = <int*> calloc(m+1, sizeof(int))
+        scaled = <double*> calloc(m+1, sizeof(double))
+
+        for k in range(self.n_states):
+            start = self.out_edge_count[k]
+            n = self.out_edge_count[k+1] - start
+
+            for l in range(n):
+                weights[l] = cexp(self.out_transition_log_probabilities[start+l])
+
+            _alias_table(weights, n, self.alias_probabilities+start, 
+                self.alias_edges+start, start, small, large, scaled)
+
+            for l in range(n):
+                if self.out_transitions[start+l] == self.end_index:
+                    weights[l] = 0
+
+            _alias_table(weights, n, self.alias_no_end_probabilities+start, 
+                self.alias_no_end_edges+start, start, small, large, scaled)
+
+        free(weights)
+        free(small)
+        free(large)
+        free(scaled)
+
+    cdef void _update_emission_table(self) nogil:
+        """Fill in the emission lookup table, if the model has one. Row k
+        holds the log emission, plus the state weight, of symbol k under each
+        non-silent state, row n_symbols holds that of a missing symbol and
+        the last row is impossible, for symbols outside of the alphabet."""
+
+        cdef int k, l, p = self.silent_start
+        cdef double symbol
+        cdef double* row
+
+        if self.emission_table == NULL:
+            return
+
+        self.emission_version = self._emission_version()
+
+        for k in range(self.n_symbols+1):
+            symbol = k if k < self.n_symbols else NAN
+            row = self.emission_table + k*p
+
+            for l in range(p):
+                (<Model> self.distributions_ptr[l])._log_probability(&symbol, 
+                    row+l, 1)
+                row[l] += self.state_weights[l]
+
+        for l in range(p):
+            self.emission_table[(self.n_symbols+1)*p + l] = NEGINF
+
+    cdef long _emission_version(self) nogil:
+        """Return the sum of the versions of the discrete distributions which
+        the emission lookup table was filled in from. Every change to one of
+        them, such as a direct fit or a new set of parameters, increases it,
+        so the table is refilled before it is next read."""
+
+        cdef int l
+        cdef long version = 0
+
+        for l in range(self.silent_start):
+            version += (<DiscreteDistribution> self.distributions_ptr[l]).version
+
+        return version
+
+    cdef double* _emission_row(self, double symbol) nogil:
+        """Return the row of the emission lookup table for an encoded
+        symbol."""
+
+        cdef int k
+
+        if isnan(symbol):
+            k = self.n_symbols
+        elif symbol < 0 or symbol >= self.n_symbols:
+            k = self.n_symbols + 1
+        else:
+            k = <int> symbol
+
+        return self.emission_table + k*self.silent_start
+
+    cdef void _emissions(self, double* sequence, double* e, int n, 
+        int i_stride, int l_stride) nogil:
+        """Fill in the log emission, plus the state weight, of each of the n
+        observations in sequence under each non-silent state, storing that of
+        observation i under state l in e[i*i_stride + l*l_stride]."""
+
+        cdef int i, k, l, p = self.silent_start, dim = self.d
+        cdef void** distributions = self.distributions_ptr
+        cdef double* row
+
+        if self.emission_table != NULL:
+            if self._emission_version() != self.emission_version:
+                self._update_emission_table()
+
+            for i in range(n):
+                row = self._emission_row(sequence[i])
+                for l in range(p):
+                    e[i*i_stride + l*l_stride] = row[l]
+        else:
+            # Tied states share a distribution, so only the first state of
+            # each tie calls it and the others copy its emissions.
+            for l in range(p):
+                k = self._tied_representative(l)
+                for i in range(n):
+                    if k == l:
+                        (<Model> distributions[l])._log_probability(
+                            sequence+i*dim, e+i*i_stride+l*l_stride, 1)
+                    else:
+                        e[i*i_stride + l*l_stride] = e[i*i_stride + k*l_stride]
+
+            for l in range(p):
+                for i in range(n):
+                    e[i*i_stride + l*l_stride] += self.state_weights[l]
+
+    cdef int _tied_representative(self, int k) nogil:
+        """Return the lowest index among the non-silent state k and the states
+        which are tied to it."""
+
+        cdef int start = self.tied_state_count[k]
+
+        if start < self.tied_state_count[k+1] and self.tied[start] < k:
+            return self.tied[start]
+        return k
+
+    cdef void _dense_update(self) nogil:
+        """Copy the transition probabilities from the sparse edge lists into
+        the dense transition matrix, start and end vectors."""
+
+        cdef int k, l, li, p = self.silent_start
+        cdef int* out_edges = self.out_edge_count
+        cdef double probability
+
+        memset(self.dense_transitions, 0, p*p*sizeof(double))
+        memset(self.dense_transitions_t, 0, p*p*sizeof(double))
+        memset(self.dense_starts, 0, p*sizeof(double))
+        memset(self.dense_ends, 0, p*sizeof(double))
+
+        for k in range(self.n_states):
+            for l in range(out_edges[k], out_edges[k+1]):
+                li = self.out_transitions[l]
+                probability = cexp(self.out_transition_log_probabilities[l])
+
+                if k == self.start_index:
+                    self.dense_starts[li] = probability
+                elif li == self.end_index:
+                    self.dense_ends[k] = probability
+                else:
+                    self.dense_transitions[k*p + li] = probability
+                    self.dense_transitions_t[li*p + k] = probability
+
+
+    def sample(self, length=0, path=False, n=None, random_state=None, 
+        n_jobs=1):
+        """Generate sequences from the model.
+
+        Returns the sequence generated, as a list of emitted items. The
+        model must have been baked first in order to run this method.
+
+        If a length is specified and the HMM is infinite (no edges to the
+        end state), then that number of samples will be randomly generated.
+        If the length is specified and the HMM is finite, the method will
+        attempt to generate a prefix of that length. Currently it will force
+        itself to not take an end transition unless that is the only path,
+        making it not a true random sample on a finite model.
+
+        If n is given, n sequences are generated at once and returned in a
+        single RaggedSequences buffer. The hidden state paths are sampled
+        without the GIL, in batches split across n_jobs threads, from alias
+        tables which are built once per set of transition probabilities, and
+        the emissions of each distribution are then drawn in bulk.
+
+        WARNING: If the HMM has no explicit end state, must specify a length
+        to use.
+
+        Parameters
+        ----------
+        length : int, optional
             Generate a sequence with a maximal length of this size. Used if
             you have no explicit end state. Default is 0.
 
@@ -1170,113 +2405,205 @@ cdef class HiddenMarkovModel(GraphModel):
             Return the path of hidden states in addition to the emissions. If
             true will return a tuple of (sample, path). Default is False.
 
+        n : int or None, optional
+            The number of sequences to generate. If None, generate a single
+            sequence and return it as a list. Default is None.
+
+        random_state : None, int or numpy.random.RandomState, optional
+            The random number generator to draw from, or a seed for one. If
+            None, numpy.random is used. Default is None.
+
+        n_jobs : int, optional
+            The number of threads to sample paths with when n is given.
+            Default is 1.
+
         Returns
         -------
         sample : list or tuple
             If path is true, return a tuple of (sample, path), otherwise return
-            just the samples.
+            just the samples. If n is given, the samples are a RaggedSequences
+            holding the emissions of each sequence, and the paths are a
+            RaggedSequences holding the index of each state visited, whose
+            symbols are the names of the states.
         """
 
         if self.d == 0:
             raise ValueError("must bake model before sampling")
 
-        return self._sample(length, path)
+        if length == 0 and not self.finite:
+            raise ValueError("must specify a length to sample from a model "
+                "without an end state")
 
-    cdef list _sample(self, int length, int path):
-        cdef int i, j, k, l, li, m=len(self.states)
-        cdef double cumulative_probability
-        cdef double [:,:] transition_probabilities = numpy.zeros((m,m))
-        cdef double [:] cum_probabilities = numpy.zeros(self.n_edges)
+        X, paths = self._sample(1 if n is None else n, length, path, 
+            random_state, n_jobs)
 
-        cdef int*  out_edges = self.out_edge_count
+        if n is None:
+            sequence = X[0].symbols() if self.discrete else X[0].view(
+                numpy.ndarray)
+            sequence = sequence.tolist() if not self.multivariate else \
+                list(sequence)
 
-        for k in range(m):
-            cumulative_probability = 0.
-            for l in range(out_edges[k], out_edges[k+1]):
-                cumulative_probability += cexp(
-                    self.out_transition_log_probabilities[l])
-                cum_probabilities[l] = cumulative_probability
+            if path:
+                return [sequence, [self.states[i] for i in 
+                    paths[0].astype('int32')]]
+            return sequence
 
-        # This holds the numerical index of the state we are currently in.
-        # Start in the start state
-        i = self.start_index
+        if path:
+            return X, paths
+        return X
 
-        # Record the number of samples
-        cdef int n = 0
-        # Define the list of emissions, and the path of hidden states taken
-        cdef list emissions = [], sequence_path = []
-        cdef State state
-        cdef double sample
+    def _sample(self, int n, int length, path, random_state, n_jobs):
+        """Generate n sequences, returning the emissions and the paths, or
+        None if the paths were not asked for, as RaggedSequences."""
 
-        while i != self.end_index:
-            # Get the object associated with this state
-            state = self.states[i]
+        cdef int i, k, l, p = self.silent_start
+        cdef int n_batches = (n + SAMPLE_BATCH_SIZE - 1) // SAMPLE_BATCH_SIZE
 
-            # Add the state to the growing path
-            sequence_path.append(state)
+        random_state = check_random_state(random_state)
+        seeds = random_state.randint(0, 2**31, size=(n_batches, 2))
+        self._build_alias_tables()
 
-            if not state.is_silent():
-                # There's an emission distribution, so sample from it
-                emissions.append(state.distribution.sample())
-                n += 1
-
-            # If we've reached the specified length, return the appropriate
-            # values
-            if length != 0 and n >= length:
-                if path:
-                    return [emissions, sequence_path]
-                return emissions
-
-            # What should we pick as our next state?
-            # Generate a number between 0 and 1 to make a weighted decision
-            # as to which state to jump to next.
-            sample = random.random()
-
-            # Save the last state id we were in
-            j = i
-
-            # Find out which state we're supposed to go to by comparing the
-            # random number to the list of cumulative probabilities for that
-            # state, and then picking the selected state.
-            for k in range(out_edges[i], out_edges[i+1]):
-                if cum_probabilities[k] > sample:
-                    i = self.out_transitions[k]
-                    break
+        with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+            batches = parallel(delayed(self._sample_paths, check_pickle=False)(
+                min(SAMPLE_BATCH_SIZE, n - i*SAMPLE_BATCH_SIZE), length, path,
+                (int(seeds[i, 0]) << 31) | int(seeds[i, 1])) 
+                for i in range(n_batches))
+
+        emitted = numpy.concatenate([batch[0] for batch in batches])
+        offsets = numpy.zeros(n+1, dtype='int64')
+        numpy.cumsum(numpy.concatenate([batch[1] for batch in batches]), 
+            out=offsets[1:])
+
+        if self.multivariate:
+            data = numpy.empty((emitted.shape[0], self.d), dtype='float64')
+        else:
+            data = numpy.empty(emitted.shape[0], dtype='float64')
+
+        # Tied states share a distribution, so their emissions are drawn
+        # together.
+        tied = numpy.array([self._tied_representative(k) for k in range(p)], 
+            dtype='int32')
+        emitted = tied[emitted]
+
+        counts = numpy.bincount(emitted, minlength=p)
+        ends = numpy.cumsum(counts)
+        order = numpy.argsort(emitted, kind='mergesort')
+
+        for k in range(p):
+            if counts[k] > 0:
+                data[order[ends[k]-counts[k]:ends[k]]] = self._sample_emissions(
+                    self.distributions[k], counts[k], random_state)
+
+        X = RaggedSequences(data, offsets, self.keymap if self.discrete else None)
+        if not path:
+            return X, None
+
+        path_offsets = numpy.zeros(n+1, dtype='int64')
+        numpy.cumsum(numpy.concatenate([batch[3] for batch in batches]), 
+            out=path_offsets[1:])
+
+        paths = RaggedSequences(numpy.concatenate([batch[2] for batch in 
+            batches]), path_offsets, [{state.name: i for i, state in 
+            enumerate(self.states)}])
+        return X, paths
+
+    def _sample_emissions(self, distribution, int n, random_state):
+        """Draw n emissions from a distribution, encoding discrete symbols
+        with the keymap of the model."""
+
+        cdef int j
+
+        if not self.discrete:
+            X = numpy.asarray(distribution.sample(n, random_state=random_state),
+                dtype='float64')
+            return X.reshape(n, self.d) if self.multivariate else X
+
+        if isinstance(distribution, DiscreteDistribution):
+            keymap = self.keymap[0]
+            probabilities = numpy.zeros(len(keymap))
+            for key, probability in distribution.parameters[0].items():
+                probabilities[keymap[key]] = probability
+
+            return random_state.choice(len(keymap), n, p=probabilities / 
+                probabilities.sum()).astype('float64')
+
+        X = numpy.asarray(distribution.sample(n, random_state=random_state), 
+            dtype=object).reshape(n, self.d)
+        return numpy.array([[self.keymap[j][symbol] for symbol in X[:, j]]
+            for j in range(self.d)], dtype='float64').T
+
+    def _sample_paths(self, int n, int length, path, unsigned long long seed):
+        """Sample the hidden state paths of n sequences without the GIL.
+
+        Returns the non-silent state of each emission, the number of
+        emissions in each sequence and, if path is true, every state visited
+        and the number of states visited by each sequence.
+        """
+
+        cdef int i, j, k, l, start, m, count, visited, status = 0
+        cdef bint avoid_end = length > 0 and self.finite
+        cdef double u
+        cdef double* probabilities = self.alias_probabilities
+        cdef int* aliases = self.alias_edges
+        cdef IntBuffer emitted, states
+        cdef numpy.ndarray n_emitted = numpy.zeros(n, dtype='int64')
+        cdef numpy.ndarray n_visited = numpy.zeros(n, dtype='int64')
+        cdef numpy.int64_t* n_emitted_ptr = <numpy.int64_t*> n_emitted.data
+        cdef numpy.int64_t* n_visited_ptr = <numpy.int64_t*> n_visited.data
+        cdef bint keep_path = path
+
+        # A finite model asked for sequences of a given length does not take
+        # an edge to the end state unless that is the only way out.
+        if avoid_end:
+            probabilities = self.alias_no_end_probabilities
+            aliases = self.alias_no_end_edges
+
+        memset(&emitted, 0, sizeof(IntBuffer))
+        memset(&states, 0, sizeof(IntBuffer))
 
-            # If the user specified a length, and we're not at that length, and
-            # we're in an infinite HMM, we want to avoid going to the end state
-            # if possible. If there is only a single probability 1 end to the
-            # end state we can't avoid it, otherwise go somewhere else.
-            if length != 0 and self.finite == 1 and i == self.end_index:
-                # If there is only one transition...
-                if len(range(out_edges[j], out_edges[j+1])) == 1:
-                    # ...and that transition goes to the end of the model...
-                    if self.out_transitions[out_edges[j]] == self.end_index:
-                        # ... then end the sampling, as nowhere else to go.
+        with nogil:
+            for j in range(n):
+                i = self.start_index
+                count = 0
+                visited = 0
+
+                while status == 0:
+                    if keep_path:
+                        status = _buffer_append(&states, i)
+                        visited += 1
+
+                    if i < self.silent_start:
+                        status |= _buffer_append(&emitted, i)
+                        count += 1
+
+                        if length > 0 and count >= length:
+                            break
+
+                    start = self.out_edge_count[i]
+                    m = self.out_edge_count[i+1] - start
+                    if i == self.end_index or m == 0:
                         break
 
-                # Take the cumulative probability of not going to the end state
-                cumulative_probability = 0.
-                for k in range(out_edges[k], out_edges[k+1]):
-                    if self.out_transitions[k] != self.end_index:
-                        cumulative_probability += cum_probabilities[k]
+                    u = _random_uniform(&seed) * m
+                    k = min(<int> u, m-1)
+                    l = start + k
+                    if u - k >= probabilities[l]:
+                        l = aliases[l]
 
-                # Randomly select a number in that probability range
-                sample = random.uniform(0, cumulative_probability)
+                    i = self.out_transitions[l]
 
-                # Select the state is corresponds to
-                for k in range(out_edges[i], out_edges[i+1]):
-                    if cum_probabilities[k] > sample:
-                        i = self.out_transitions[k]
-                        break
+                n_emitted_ptr[j] = count
+                n_visited_ptr[j] = visited
 
-        # Done! Return either emissions, or emissions and path.
-        if path:
-            sequence_path.append(self.end)
-            return [emissions, sequence_path]
-        return emissions
+        emitted_ndarray = _buffer_array(&emitted)
+        states_ndarray = _buffer_array(&states)
+
+        if status != 0:
+            raise MemoryError("ran out of memory while sampling paths")
 
-    cpdef double log_probability(self, sequence, check_input=True):
+        return emitted_ndarray, n_emitted, states_ndarray, n_visited
+
+    cpdef log_probability(self, sequence, check_input=True, n_jobs=1):
         """Calculate the log probability of a single sequence.
 
         If a path is provided, calculate the log probability of that sequence
@@ -1284,25 +2611,39 @@ cdef class HiddenMarkovModel(GraphModel):
 
         Parameters
         ----------
-        sequence : array-like
-            Return the array of observations in a single sequence of data
+        sequence : array-like or RaggedSequences
+            Return the array of observations in a single sequence of data. If
+            a RaggedSequences collection is given, the log probability of
+            each sequence in it is returned.
 
         check_input : bool, optional
             Check to make sure that all emissions fall under the support of
             the emission distributions. Default is True.
 
+        n_jobs : int, optional
+            The number of threads to split the sequence across. Each thread
+            summarizes its part of the sequence starting from every
+            non-silent state, which multiplies the work by the number of
+            non-silent states, so this is only faster for long sequences when
+            n_jobs is well above the number of states. Default is 1.
+
         Returns
         -------
-        logp : double
+        logp : double or numpy.ndarray
             The log probability of the sequence
         """
 
         if self.d == 0:
             raise ValueError("must bake model before computing probability")
 
-        cdef numpy.ndarray sequence_ndarray
+        if isinstance(sequence, RaggedSequences):
+            return numpy.array([self.log_probability(sequence_view, 
+                n_jobs=n_jobs) for sequence_view in sequence.encode(self)])
+
+        cdef numpy.ndarray sequence_ndarray, f_ndarray
         cdef double* sequence_ptr
         cdef double log_probability
+        cdef ScratchArena* arena
         cdef int n = len(sequence)
         cdef int mv = self.multivariate
 
@@ -1313,13 +2654,32 @@ cdef class HiddenMarkovModel(GraphModel):
 
         sequence_ptr = <double*> sequence_ndarray.data
 
-        with nogil:
-            log_probability = self._vl_log_probability(sequence_ptr, n)
+        if n_jobs > 1 and n > 1:
+            f_ndarray = self._scan(sequence_ndarray, None, n, n_jobs, 0, False)[0]
+            return self._forward_log_probability(<double*> f_ndarray.data, n)
 
+        arena = self._acquire_scratch()
+        try:
+            with nogil:
+                log_probability = self._vl_log_probability(sequence_ptr, n,
+                    arena)
+        finally:
+            self._release_scratch(arena)
+
+        return log_probability
+
+    cdef double _vl_log_probability(self, double* sequence, int n,
+        ScratchArena* arena=NULL) nogil:
+        cdef double* f = self._forward(sequence, n, NULL, arena)
+        cdef double log_probability = self._forward_log_probability(f, n)
+
+        _scratch_free(arena, f)
         return log_probability
 
-    cdef double _vl_log_probability(self, double* sequence, int n) nogil:
-        cdef double* f = self._forward(sequence, n, NULL)
+    cdef double _forward_log_probability(self, double* f, int n) nogil:
+        """Return the log probability of a sequence of n symbols from its
+        forward matrix."""
+
         cdef double log_probability
         cdef int i, m = self.n_states
 
@@ -1330,7 +2690,6 @@ cdef class HiddenMarkovModel(GraphModel):
             for i in range(self.silent_start):
                 log_probability = pair_lse(log_probability, f[n*m + i])
 
-        free(f)
         return log_probability
 
     cpdef numpy.ndarray forward(self, sequence):
@@ -1389,33 +2748,48 @@ cdef class HiddenMarkovModel(GraphModel):
         free(f)
         return f_ndarray
 
-    cdef double* _forward(self, double* sequence, int n, double* emissions) nogil:
-        cdef int i, k, ki, l, li
-        cdef int p = self.silent_start, m = self.n_states
+    cdef double* _forward(self, double* sequence, int n, double* emissions,
+        ScratchArena* arena=NULL) nogil:
+        cdef int i, l
+        cdef int m = self.n_states
         cdef int dim = self.d
 
         cdef void** distributions = <void**> self.distributions_ptr
 
-        cdef double log_probability
-        cdef int* in_edges = self.in_edge_count
-
         cdef double* e = NULL
-        cdef double* f = <double*> calloc(m*(n+1), sizeof(double))
+        cdef double* f = <double*> _scratch_alloc(arena, m*(n+1)*sizeof(double))
 
         # Either fill in a new emissions matrix, or use the one which has
         # been provided from a previous call.
         if emissions is NULL:
-            e = <double*> calloc(n*self.silent_start, sizeof(double))
-            for l in range(self.silent_start):
-                for i in range(n):
-                    (<Model> distributions[l])._log_probability(sequence+i*dim, e+l*n+i, 1)
-                    e[l*n + i] += self.state_weights[l]
+            e = <double*> _scratch_alloc(arena, n*self.silent_start*sizeof(double))
+            self._emissions(sequence, e, n, 1, n)
         else:
             e = emissions
 
+        if self.dense and n > 0:
+            self._dense_forward_log(e, n, f)
+        elif not (self.scaled and n > 0 and self._scaled_forward_log(e, n, f)):
+            self._forward_initial(f)
+            for i in range(n):
+                self._forward_step(f + i*m, f + (i+1)*m, e + i, n)
+
+        if emissions is NULL:
+            _scratch_free(arena, e)
+        return f
+
+    cdef void _forward_initial(self, double* f) nogil:
+        """Fill in the first row of the forward matrix, before any symbol
+        has been emitted."""
+
+        cdef int k, ki, l
+        cdef int m = self.n_states
+        cdef int* in_edges = self.in_edge_count
+        cdef double log_probability
+
         # We must start in the start state, having emitted 0 symbols
-        for i in range(m):
-            f[i] = NEGINF
+        for l in range(m):
+            f[l] = NEGINF
         f[self.start_index] = 0.
 
         for l in range(self.silent_start, m):
@@ -1442,63 +2816,79 @@ cdef class HiddenMarkovModel(GraphModel):
             # Update the table entry
             f[l] = log_probability
 
-        for i in range(n):
-            for l in range(self.silent_start):
-                # Do the recurrence for non-silent states l
-                # This holds the log total transition probability in from
-                # all previous states
+    cdef void _forward_step(self, double* fp, double* fc, double* e,
+        int stride) nogil:
+        """Calculate one row of the forward matrix, fc, from the previous
+        row, fp. The emission of state l for this symbol is e[l*stride]."""
 
-                log_probability = NEGINF
-                for k in range(in_edges[l], in_edges[l+1]):
-                    ki = self.in_transitions[k]
+        cdef int k, ki, l
+        cdef int m = self.n_states
+        cdef int* in_edges = self.in_edge_count
+        cdef double log_probability
 
-                    # For each previous state k
-                    log_probability = pair_lse(log_probability,
-                        f[i*m + ki] + self.in_transition_log_probabilities[k])
+        for l in range(self.silent_start):
+            # Do the recurrence for non-silent states l
+            # This holds the log total transition probability in from
+            # all previous states
 
-                # Now set the table entry for log probability of emitting
-                # index+1 characters and ending in state l
-                f[(i+1)*m + l] = log_probability + e[i + l*n]
+            log_probability = NEGINF
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
 
-            for l in range(self.silent_start, m):
-                # Now do the first pass over the silent states
-                # This holds the log total transition probability in from
-                # all current-step non-silent states
-                log_probability = NEGINF
-                for k in range(in_edges[l], in_edges[l+1]):
-                    ki = self.in_transitions[k]
-                    if ki >= self.silent_start:
-                        continue
+                # For each previous state k
+                log_probability = pair_lse(log_probability,
+                    fp[ki] + self.in_transition_log_probabilities[k])
 
-                    # For each current-step non-silent state k
-                    log_probability = pair_lse(log_probability,
-                        f[(i+1)*m + ki] + self.in_transition_log_probabilities[k])
+            # Now set the table entry for log probability of emitting
+            # index+1 characters and ending in state l
+            fc[l] = log_probability + e[l*stride]
 
-                # Set the table entry to the partial result.
-                f[(i+1)*m + l] = log_probability
+        self._forward_silent(fc)
 
-            for l in range(self.silent_start, m):
-                # Now the second pass through silent states, where we account
-                # for transitions between silent states.
+    cdef void _forward_silent(self, double* fc) nogil:
+        """Fill in the silent states of a forward row, fc, from the non-silent
+        states of the same row."""
 
-                # This holds the log total transition probability in from
-                # all current-step silent states that can have transitions into
-                # this state.
-                log_probability = NEGINF
-                for k in range(in_edges[l], in_edges[l+1]):
-                    ki = self.in_transitions[k]
-                    if ki < self.silent_start or ki >= l:
-                        continue
-                    # For each current-step preceding silent state k
-                    log_probability = pair_lse(log_probability,
-                        f[(i+1)*m + ki] + self.in_transition_log_probabilities[k])
+        cdef int k, ki, l
+        cdef int m = self.n_states
+        cdef int* in_edges = self.in_edge_count
+        cdef double log_probability
 
-                # Add the previous partial result and update the table entry
-                f[(i+1)*m + l] = pair_lse(f[(i+1)*m + l], log_probability)
+        for l in range(self.silent_start, m):
+            # Now do the first pass over the silent states
+            # This holds the log total transition probability in from
+            # all current-step non-silent states
+            log_probability = NEGINF
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                if ki >= self.silent_start:
+                    continue
 
-        if emissions is NULL:
-            free(e)
-        return f
+                # For each current-step non-silent state k
+                log_probability = pair_lse(log_probability,
+                    fc[ki] + self.in_transition_log_probabilities[k])
+
+            # Set the table entry to the partial result.
+            fc[l] = log_probability
+
+        for l in range(self.silent_start, m):
+            # Now the second pass through silent states, where we account
+            # for transitions between silent states.
+
+            # This holds the log total transition probability in from
+            # all current-step silent states that can have transitions into
+            # this state.
+            log_probability = NEGINF
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                if ki < self.silent_start or ki >= l:
+                    continue
+                # For each current-step preceding silent state k
+                log_probability = pair_lse(log_probability,
+                    fc[ki] + self.in_transition_log_probabilities[k])
+
+            # Add the previous partial result and update the table entry
+            fc[l] = pair_lse(fc[l], log_probability)
 
     cpdef numpy.ndarray backward(self, sequence):
         """Run the backward algorithm on the sequence.
@@ -1555,194 +2945,1082 @@ cdef class HiddenMarkovModel(GraphModel):
         free(b)
         return b_ndarray
 
-    cdef double* _backward(self, double* sequence, int n, double* emissions) nogil:
-        cdef int i, ir, k, kr, l, li
-        cdef int p = self.silent_start, m = self.n_states
+    cdef double* _backward(self, double* sequence, int n, double* emissions,
+        ScratchArena* arena=NULL) nogil:
+        cdef int i, ir, l
+        cdef int m = self.n_states
         cdef int dim = self.d
 
         cdef void** distributions = <void**> self.distributions_ptr
 
-        cdef double log_probability
-        cdef int* out_edges = self.out_edge_count
-
         cdef double* e = NULL
-        cdef double* b = <double*> calloc((n+1)*m, sizeof(double))
+        cdef double* b = <double*> _scratch_alloc(arena, (n+1)*m*sizeof(double))
 
         # Either fill in a new emissions matrix, or use the one which has
         # been provided from a previous call.
         if emissions is NULL:
-            e = <double*> calloc(n*self.silent_start, sizeof(double))
-            for l in range(self.silent_start):
-                for i in range(n):
-                    (<Model> distributions[l])._log_probability(sequence+i*dim, e+l*n+i, 1)
-                    e[l*n + i] += self.state_weights[l]
+            e = <double*> _scratch_alloc(arena, n*self.silent_start*sizeof(double))
+            self._emissions(sequence, e, n, 1, n)
         else:
             e = emissions
 
-        # We must end in the end state, having emitted len(sequence) symbols
-        if self.finite == 1:
-            for i in range(m):
-                b[n*m + i] = NEGINF
-            b[n*m + self.end_index] = 0
-        else:
-            for i in range(self.silent_start):
-                b[n*m + i] = 0.
-            for i in range(self.silent_start, m):
-                b[n*m + i] = NEGINF
+        if self.dense and n > 0:
+            self._dense_backward_log(e, n, b)
+        elif not (self.scaled and n > 0 and self._scaled_backward_log(e, n, b)):
+            self._backward_initial(b + n*m)
 
-        for kr in range(m-self.silent_start):
-            if self.finite == 0:
-                break
-            # Cython arrays cannot go backwards, so modify the loop to account
-            # for this.
-            k = m - kr - 1
+            # Now that we're done with the base case, move on to the recurrence
+            for ir in range(n):
+                # Cython xranges cannot go backwards properly, redo to handle
+                # it properly
+                i = n - ir - 1
+                self._backward_step(b + i*m, b + (i+1)*m, e + i, n)
 
-            # Do the silent states' dependencies on each other.
-            # Doing it in reverse order ensures that anything we can
-            # possibly transition to is already done.
+        if emissions is NULL:
+            _scratch_free(arena, e)
+        return b
 
-            if k == self.end_index:
-                # We already set the log-probability for this, so skip it
-                continue
+    cdef double* _scaled_emissions(self, double* e, int n, 
+        double* emission_max) nogil:
+        """Convert the log emission table into probabilities.
 
-            # This holds the log total probability that we go to
-            # current-step silent states and then continue from there to
-            # finish the sequence.
-            log_probability = NEGINF
-            for l in range(out_edges[k], out_edges[k+1]):
-                li = self.out_transitions[l]
-                if li < k+1:
-                    continue
+        Row i of the returned table holds the emission probability of each
+        non-silent state for symbol i divided by the largest of them, whose
+        log is stored in emission_max[i].
+        """
 
-                # For each possible current-step silent state we can go to,
-                # take into account just transition probability
-                log_probability = pair_lse(log_probability,
-                    b[n*m + li] + self.out_transition_log_probabilities[l])
+        cdef int i, l, p = self.silent_start
+        cdef double* w = <double*> calloc(n*p, sizeof(double))
 
-            # Now this is the probability of reaching the end state given we are
-            # in this silent state.
-            b[n*m + k] = log_probability
+        for i in range(n):
+            emission_max[i] = NEGINF
+            for l in range(p):
+                if e[l*n + i] > emission_max[i]:
+                    emission_max[i] = e[l*n + i]
 
-        for k in range(self.silent_start):
-            if self.finite == 0:
-                break
-            # Do the non-silent states in the last step, which depend on
-            # current-step silent states.
+            if emission_max[i] == NEGINF:
+                continue
 
-            # This holds the total accumulated log probability of going
-            # to such states and continuing from there to the end.
-            log_probability = NEGINF
-            for l in range(out_edges[k], out_edges[k+1]):
-                li = self.out_transitions[l]
-                if li < self.silent_start:
-                    continue
+            for l in range(p):
+                w[i*p + l] = cexp(e[l*n + i] - emission_max[i])
 
-                # For each current-step silent state, add in the probability
-                # of going from here to there and then continuing on to the
-                # end of the sequence.
-                log_probability = pair_lse(log_probability,
-                    b[n*m + li] + self.out_transition_log_probabilities[l])
+        return w
 
-            # Now we have summed the probabilities of all the ways we can
-            # get from here to the end, so we can fill in the table entry.
-            b[n*m + k] = log_probability
+    cdef bint _scaled_forward(self, double* w, double* emission_max, int n,
+        double* f, double* scale) nogil:
+        """Run the forward algorithm in scaled probability space.
 
-        # Now that we're done with the base case, move on to the recurrence
-        for ir in range(n):
-            #if self.finite == 0 and ir == 0:
-            #   continue
-            # Cython xranges cannot go backwards properly, redo to handle
-            # it properly
-            i = n - ir - 1
-            for kr in range(m-self.silent_start):
-                k = m - kr - 1
+        Each row of f is normalized so that the non-silent states sum to one,
+        and scale[i] holds the log of the product of the normalizing
+        constants up to row i, so that the log forward value is the log of f
+        plus scale. Returns False if any row underflows, in which case the
+        log space kernels should be used instead.
+        """
 
-                # Do the silent states' dependency on subsequent non-silent
-                # states, iterating backwards to match the order we use later.
+        cdef int i, k, ki, l, m = self.n_states, p = self.silent_start
+        cdef int* in_edges = self.in_edge_count
+        cdef double* probabilities = self.in_transition_probabilities
+        cdef double* fp
+        cdef double* fc
+        cdef double probability, total
 
-                # This holds the log total probability that we go to some
-                # subsequent state that emits the right thing, and then continue
-                # from there to finish the sequence.
-                log_probability = NEGINF
-                for l in range(out_edges[k], out_edges[k+1]):
-                    li = self.out_transitions[l]
-                    if li >= self.silent_start:
-                        continue
+        memset(f, 0, (n+1)*m*sizeof(double))
+        f[self.start_index] = 1.
+        scale[0] = 0.
 
-                    # For each subsequent non-silent state l, take into account
-                    # transition and emission emission probability.
-                    log_probability = pair_lse(log_probability,
-                        b[(i+1)*m + li] + self.out_transition_log_probabilities[l] +
-                        e[i + li*n])
+        for l in range(p, m):
+            if l == self.start_index:
+                continue
+
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                if ki >= p and ki < l:
+                    f[l] += f[ki] * probabilities[k]
+
+        for i in range(n):
+            fp = f + i*m
+            fc = f + (i+1)*m
+            total = 0.
+
+            for l in range(p):
+                probability = 0.
+                for k in range(in_edges[l], in_edges[l+1]):
+                    probability += fp[self.in_transitions[k]] * probabilities[k]
+
+                fc[l] = probability * w[i*p + l]
+                total += fc[l]
+
+            if total < SCALED_MIN:
+                return 0
+
+            for l in range(p):
+                fc[l] /= total
+
+            for l in range(p, m):
+                for k in range(in_edges[l], in_edges[l+1]):
+                    ki = self.in_transitions[k]
+                    if ki < p:
+                        fc[l] += fc[ki] * probabilities[k]
+
+            for l in range(p, m):
+                for k in range(in_edges[l], in_edges[l+1]):
+                    ki = self.in_transitions[k]
+                    if ki >= p and ki < l:
+                        fc[l] += fc[ki] * probabilities[k]
+
+            scale[i+1] = scale[i] + _log(total) + emission_max[i]
+
+        return 1
+
+    cdef bint _scaled_backward(self, double* w, double* emission_max, int n,
+        double* b, double* scale) nogil:
+        """Run the backward algorithm in scaled probability space.
+
+        Each row of b is normalized to sum to one, and scale[i] holds the log
+        of the product of the normalizing constants from row i to the end.
+        Returns False if any row underflows.
+        """
+
+        cdef int i, ir, k, kr, l, li, m = self.n_states, p = self.silent_start
+        cdef int* out_edges = self.out_edge_count
+        cdef double* probabilities = self.out_transition_probabilities
+        cdef double* u = <double*> calloc(p, sizeof(double))
+        cdef double* bc
+        cdef double* bn
+        cdef double probability, total
+
+        bc = b + n*m
+        self._backward_initial(bc)
+
+        scale[n] = NEGINF
+        for l in range(m):
+            if bc[l] > scale[n]:
+                scale[n] = bc[l]
+
+        if scale[n] == NEGINF:
+            free(u)
+            return 0
+
+        for l in range(m):
+            bc[l] = cexp(bc[l] - scale[n])
+
+        for ir in range(n):
+            i = n - ir - 1
+            bc = b + i*m
+            bn = b + (i+1)*m
 
-                # We can't go from a silent state here to a silent state on the
-                # next symbol, so we're done finding the probability assuming we
-                # transition straight to a non-silent state.
-                b[i*m + k] = log_probability
+            for l in range(p):
+                u[l] = bn[l] * w[i*p + l]
 
-            for kr in range(m-self.silent_start):
+            for kr in range(m-p):
                 k = m - kr - 1
+                probability = 0.
+                for l in range(out_edges[k], out_edges[k+1]):
+                    li = self.out_transitions[l]
+                    if li < p:
+                        probability += u[li] * probabilities[l]
+
+                bc[k] = probability
 
-                # Do the silent states' dependencies on each other.
-                # Doing it in reverse order ensures that anything we can
-                # possibly transition to is already done.
+            for kr in range(m-p):
+                k = m - kr - 1
+                for l in range(out_edges[k], out_edges[k+1]):
+                    li = self.out_transitions[l]
+                    if li > k:
+                        bc[k] += bc[li] * probabilities[l]
 
-                # This holds the log total probability that we go to
-                # current-step silent states and then continue from there to
-                # finish the sequence.
-                log_probability = NEGINF
+            total = 0.
+            for k in range(p):
+                probability = 0.
                 for l in range(out_edges[k], out_edges[k+1]):
                     li = self.out_transitions[l]
-                    if li < k+1:
+                    if li < p:
+                        probability += u[li] * probabilities[l]
+                    else:
+                        probability += bc[li] * probabilities[l]
+
+                bc[k] = probability
+                total += probability
+
+            for k in range(p, m):
+                total += bc[k]
+
+            if total < SCALED_MIN:
+                free(u)
+                return 0
+
+            for k in range(m):
+                bc[k] /= total
+
+            scale[i] = scale[i+1] + _log(total) + emission_max[i]
+
+        free(u)
+        return 1
+
+    cdef bint _scaled_forward_log(self, double* e, int n, double* f) nogil:
+        """Fill in the log forward matrix using the scaled kernels, returning
+        False if they underflow."""
+
+        cdef int i, l, m = self.n_states
+        cdef double* emission_max = <double*> calloc(n, sizeof(double))
+        cdef double* scale = <double*> calloc(n+1, sizeof(double))
+        cdef double* w = self._scaled_emissions(e, n, emission_max)
+        cdef bint success = self._scaled_forward(w, emission_max, n, f, scale)
+
+        if success:
+            for i in range(n+1):
+                for l in range(m):
+                    f[i*m + l] = _log(f[i*m + l]) + scale[i]
+
+        free(emission_max)
+        free(scale)
+        free(w)
+        return success
+
+    cdef bint _scaled_backward_log(self, double* e, int n, double* b) nogil:
+        """Fill in the log backward matrix using the scaled kernels, returning
+        False if they underflow."""
+
+        cdef int i, l, m = self.n_states
+        cdef double* emission_max = <double*> calloc(n, sizeof(double))
+        cdef double* scale = <double*> calloc(n+1, sizeof(double))
+        cdef double* w = self._scaled_emissions(e, n, emission_max)
+        cdef bint success = self._scaled_backward(w, emission_max, n, b, scale)
+
+        if success:
+            for i in range(n+1):
+                for l in range(m):
+                    b[i*m + l] = _log(b[i*m + l]) + scale[i]
+
+        free(emission_max)
+        free(scale)
+        free(w)
+        return success
+
+    cdef double _dense_forward(self, double* e, int n, double* alpha, 
+        double* scale) nogil:
+        """Run the forward algorithm in scaled probability space.
+
+        Row i of alpha holds the probability of each non-silent state given
+        the first i+1 symbols, and scale[i] the log of the normalizing
+        constant for that row, so that the log forward value is the log of
+        alpha plus the sum of the scales so far. Returns the log probability
+        of the sequence, or negative infinity if it is impossible.
+        """
+
+        cdef int i, l, p = self.silent_start
+        cdef double emission_max, total
+        cdef double log_probability = 0
+        cdef double* a
+
+        for i in range(n):
+            a = alpha + i*p
+
+            if i == 0:
+                memcpy(a, self.dense_starts, p*sizeof(double))
+            else:
+                mdot(a - p, self.dense_transitions, a, 1, p, p)
+
+            emission_max = NEGINF
+            for l in range(p):
+                if e[l*n + i] > emission_max:
+                    emission_max = e[l*n + i]
+
+            if emission_max == NEGINF:
+                return NEGINF
+
+            total = 0
+            for l in range(p):
+                a[l] *= cexp(e[l*n + i] - emission_max)
+                total += a[l]
+
+            if total == 0:
+                return NEGINF
+
+            for l in range(p):
+                a[l] /= total
+
+            scale[i] = _log(total) + emission_max
+            log_probability += scale[i]
+
+        if self.finite == 1:
+            total = 0
+            a = alpha + (n-1)*p
+            for l in range(p):
+                total += a[l] * self.dense_ends[l]
+
+            log_probability += _log(total)
+
+        return log_probability
+
+    cdef void _dense_backward(self, double* e, int n, double* scale, 
+        double* beta) nogil:
+        """Run the backward algorithm in scaled probability space, using the
+        scales calculated by the forward pass, and store in row i of beta the
+        backward values for the first i+1 symbols."""
+
+        cdef int i, ir, l, p = self.silent_start
+        cdef double* w = <double*> calloc(p, sizeof(double))
+
+        for l in range(p):
+            beta[(n-1)*p + l] = self.dense_ends[l] if self.finite == 1 else 1.
+
+        for ir in range(n-1):
+            i = n - ir - 2
+            for l in range(p):
+                w[l] = cexp(e[l*n + i+1] - scale[i+1]) * beta[(i+1)*p + l]
+
+            mdot(w, self.dense_transitions_t, beta + i*p, 1, p, p)
+
+        free(w)
+
+    cdef void _dense_forward_log(self, double* e, int n, double* f) nogil:
+        """Fill in the log forward matrix using the dense kernels."""
+
+        cdef int i, l, m = self.n_states, p = self.silent_start
+        cdef double* alpha = <double*> calloc(n*p, sizeof(double))
+        cdef double* scale = <double*> calloc(n, sizeof(double))
+        cdef double cumulative_scale = 0, total
+
+        for l in range((n+1)*m):
+            f[l] = NEGINF
+        f[self.start_index] = 0
+
+        if self._dense_forward(e, n, alpha, scale) == NEGINF:
+            # Fall back to log space to find which entries are impossible.
+            self._forward_initial(f)
+            for i in range(n):
+                self._forward_step(f + i*m, f + (i+1)*m, e + i, n)
+        else:
+            for i in range(n):
+                cumulative_scale += scale[i]
+                total = 0
+                for l in range(p):
+                    f[(i+1)*m + l] = _log(alpha[i*p + l]) + cumulative_scale
+                    total += alpha[i*p + l] * self.dense_ends[l]
+
+                if self.finite == 1:
+                    f[(i+1)*m + self.end_index] = _log(total) + cumulative_scale
+
+        free(alpha)
+        free(scale)
+
+    cdef void _dense_backward_log(self, double* e, int n, double* b) nogil:
+        """Fill in the log backward matrix using the dense kernels."""
+
+        cdef int i, l, m = self.n_states, p = self.silent_start
+        cdef double* alpha = <double*> calloc(n*p, sizeof(double))
+        cdef double* beta = <double*> calloc(n*p, sizeof(double))
+        cdef double* scale = <double*> calloc(n, sizeof(double))
+        cdef double* w = <double*> calloc(p, sizeof(double))
+        cdef double cumulative_scale = 0, total
+
+        for l in range((n+1)*m):
+            b[l] = NEGINF
+
+        if self._dense_forward(e, n, alpha, scale) == NEGINF:
+            self._backward_initial(b + n*m)
+            for i in range(n):
+                self._backward_step(b + (n-i-1)*m, b + (n-i)*m, e + n-i-1, n)
+        else:
+            self._dense_backward(e, n, scale, beta)
+
+            if self.finite == 1:
+                b[n*m + self.end_index] = 0
+
+            for i in range(n-1, -1, -1):
+                total = 0
+                for l in range(p):
+                    b[(i+1)*m + l] = _log(beta[i*p + l]) + cumulative_scale
+                    w[l] = beta[i*p + l] * cexp(e[l*n + i] - scale[i])
+                    total += self.dense_starts[l] * w[l]
+
+                cumulative_scale += scale[i]
+                b[i*m + self.start_index] = _log(total) + cumulative_scale
+
+            # The non-silent states before the first symbol is emitted.
+            mdot(w, self.dense_transitions_t, beta, 1, p, p)
+            for l in range(p):
+                b[l] = _log(beta[l]) + cumulative_scale
+
+        free(alpha)
+        free(beta)
+        free(scale)
+        free(w)
+
+    cdef void _backward_initial(self, double* b) nogil:
+        """Fill in the last row of the backward matrix, after every symbol
+        has been emitted."""
+
+        cdef int i, k, kr, l, li
+        cdef int m = self.n_states
+        cdef int* out_edges = self.out_edge_count
+        cdef double log_probability
+
+        # We must end in the end state, having emitted len(sequence) symbols
+        if self.finite == 1:
+            for i in range(m):
+                b[i] = NEGINF
+            b[self.end_index] = 0
+        else:
+            for i in range(self.silent_start):
+                b[i] = 0.
+            for i in range(self.silent_start, m):
+                b[i] = NEGINF
+
+        for kr in range(m-self.silent_start):
+            if self.finite == 0:
+                break
+            # Cython arrays cannot go backwards, so modify the loop to account
+            # for this.
+            k = m - kr - 1
+
+            # Do the silent states' dependencies on each other.
+            # Doing it in reverse order ensures that anything we can
+            # possibly transition to is already done.
+
+            if k == self.end_index:
+                # We already set the log-probability for this, so skip it
+                continue
+
+            # This holds the log total probability that we go to
+            # current-step silent states and then continue from there to
+            # finish the sequence.
+            log_probability = NEGINF
+            for l in range(out_edges[k], out_edges[k+1]):
+                li = self.out_transitions[l]
+                if li < k+1:
+                    continue
+
+                # For each possible current-step silent state we can go to,
+                # take into account just transition probability
+                log_probability = pair_lse(log_probability,
+                    b[li] + self.out_transition_log_probabilities[l])
+
+            # Now this is the probability of reaching the end state given we are
+            # in this silent state.
+            b[k] = log_probability
+
+        for k in range(self.silent_start):
+            if self.finite == 0:
+                break
+            # Do the non-silent states in the last step, which depend on
+            # current-step silent states.
+
+            # This holds the total accumulated log probability of going
+            # to such states and continuing from there to the end.
+            log_probability = NEGINF
+            for l in range(out_edges[k], out_edges[k+1]):
+                li = self.out_transitions[l]
+                if li < self.silent_start:
+                    continue
+
+                # For each current-step silent state, add in the probability
+                # of going from here to there and then continuing on to the
+                # end of the sequence.
+                log_probability = pair_lse(log_probability,
+                    b[li] + self.out_transition_log_probabilities[l])
+
+            # Now we have summed the probabilities of all the ways we can
+            # get from here to the end, so we can fill in the table entry.
+            b[k] = log_probability
+
+    cdef void _backward_step(self, double* bc, double* bn, double* e,
+        int stride) nogil:
+        """Calculate one row of the backward matrix, bc, from the next row,
+        bn. The emission of state l for the next symbol is e[l*stride]."""
+
+        cdef int k, kr, l, li
+        cdef int m = self.n_states
+        cdef int* out_edges = self.out_edge_count
+        cdef double log_probability
+
+        for kr in range(m-self.silent_start):
+            k = m - kr - 1
+
+            # Do the silent states' dependency on subsequent non-silent
+            # states, iterating backwards to match the order we use later.
+
+            # This holds the log total probability that we go to some
+            # subsequent state that emits the right thing, and then continue
+            # from there to finish the sequence.
+            log_probability = NEGINF
+            for l in range(out_edges[k], out_edges[k+1]):
+                li = self.out_transitions[l]
+                if li >= self.silent_start:
+                    continue
+
+                # For each subsequent non-silent state l, take into account
+                # transition and emission emission probability.
+                log_probability = pair_lse(log_probability,
+                    bn[li] + self.out_transition_log_probabilities[l] +
+                    e[li*stride])
+
+            # We can't go from a silent state here to a silent state on the
+            # next symbol, so we're done finding the probability assuming we
+            # transition straight to a non-silent state.
+            bc[k] = log_probability
+
+        for kr in range(m-self.silent_start):
+            k = m - kr - 1
+
+            # Do the silent states' dependencies on each other.
+            # Doing it in reverse order ensures that anything we can
+            # possibly transition to is already done.
+
+            # This holds the log total probability that we go to
+            # current-step silent states and then continue from there to
+            # finish the sequence.
+            log_probability = NEGINF
+            for l in range(out_edges[k], out_edges[k+1]):
+                li = self.out_transitions[l]
+                if li < k+1:
+                    continue
+
+                # For each possible current-step silent state we can go to,
+                # take into account just transition probability
+                log_probability = pair_lse(log_probability,
+                    bc[li] + self.out_transition_log_probabilities[l])
+
+            # Now add this probability in with the probability accumulated
+            # from transitions to subsequent non-silent states.
+            bc[k] = pair_lse(log_probability, bc[k])
+
+        for k in range(self.silent_start):
+            # Do the non-silent states in the current step, which depend on
+            # subsequent non-silent states and current-step silent states.
+
+            # This holds the total accumulated log probability of going
+            # to such states and continuing from there to the end.
+            log_probability = NEGINF
+            for l in range(out_edges[k], out_edges[k+1]):
+                li = self.out_transitions[l]
+                if li >= self.silent_start:
+                    continue
+
+                # For each subsequent non-silent state l, take into account
+                # transition and emission emission probability.
+                log_probability = pair_lse(log_probability,
+                    bn[li] + self.out_transition_log_probabilities[l] +
+                    e[li*stride])
+
+            for l in range(out_edges[k], out_edges[k+1]):
+                li = self.out_transitions[l]
+                if li < self.silent_start:
+                    continue
+
+                # For each current-step silent state, add in the probability
+                # of going from here to there and then continuing on to the
+                # end of the sequence.
+                log_probability = pair_lse(log_probability,
+                    bc[li] + self.out_transition_log_probabilities[l])
+
+            # Now we have summed the probabilities of all the ways we can
+            # get from here to the end, so we can fill in the table entry.
+            bc[k] = log_probability
+
+    def filter(self, lag=0, window=100):
+        """Create an online filter for streaming observations.
+
+        See HiddenMarkovModelFilter for details.
+
+        Parameters
+        ----------
+        lag : int, optional
+            The number of observations to delay the smoothed posterior by.
+            Default is 0.
+
+        window : int, optional
+            The number of observations for which Viterbi traceback is stored.
+            Default is 100.
+
+        Returns
+        -------
+        filter : HiddenMarkovModelFilter
+            A filter with no observations.
+        """
+
+        return HiddenMarkovModelFilter(self, lag, window)
+
+    def forward_batch(self, X, lengths=None):
+        """Run the forward algorithm on many sequences at once.
+
+        The sequences are processed together as a batch, with the dynamic
+        programming matrix laid out as states by sequences so that the inner
+        loop of the recursion runs over contiguous memory across the batch.
+        This removes the per-sequence overhead when scoring a large number of
+        short sequences. Sequences beyond the padded length have a forward
+        log probability of negative infinity.
+
+        Parameters
+        ----------
+        X : list or array-like, shape (n_sequences, max_length[, d])
+            Either a list of sequences, or a padded array of sequences where
+            each row holds one sequence followed by arbitrary padding.
+
+        lengths : array-like, shape (n_sequences,), optional
+            The length of each sequence when X is a padded array. If None, X
+            is treated as a list of sequences. Default is None.
+
+        Returns
+        -------
+        matrix : array-like, shape (n_sequences, max_length+1, n_states)
+            The forward matrix of each sequence in the batch.
+        """
+
+        if self.d == 0:
+            raise ValueError("must bake model before using forward algorithm")
+
+        cdef numpy.ndarray X_ndarray, lengths_ndarray
+        cdef int b, n, m = self.n_states
+        cdef double* e
+        cdef double* f
+
+        X_ndarray, lengths_ndarray = self._check_batch_input(X, lengths)
+        b, n = X_ndarray.shape[0], X_ndarray.shape[1]
+
+        cdef double* X_ptr = <double*> X_ndarray.data
+        cdef int* lengths_ptr = <int*> lengths_ndarray.data
+        cdef numpy.ndarray f_ndarray = numpy.empty((n+1, m, b), dtype='float64')
+
+        with nogil:
+            e = self._batch_emissions(X_ptr, lengths_ptr, b, n)
+            f = self._forward_batch(e, lengths_ptr, b, n)
+            memcpy(<double*> f_ndarray.data, f, (n+1)*m*b*sizeof(double))
+            free(e)
+            free(f)
+
+        return f_ndarray.transpose(2, 0, 1).copy()
+
+    def backward_batch(self, X, lengths=None):
+        """Run the backward algorithm on many sequences at once.
+
+        See `forward_batch` for the layout of the batch. Positions past the
+        end of a sequence have a backward log probability of negative infinity.
+
+        Parameters
+        ----------
+        X : list or array-like, shape (n_sequences, max_length[, d])
+            Either a list of sequences, or a padded array of sequences where
+            each row holds one sequence followed by arbitrary padding.
+
+        lengths : array-like, shape (n_sequences,), optional
+            The length of each sequence when X is a padded array. If None, X
+            is treated as a list of sequences. Default is None.
+
+        Returns
+        -------
+        matrix : array-like, shape (n_sequences, max_length+1, n_states)
+            The backward matrix of each sequence in the batch.
+        """
+
+        if self.d == 0:
+            raise ValueError("must bake model before using backward algorithm")
+
+        cdef numpy.ndarray X_ndarray, lengths_ndarray
+        cdef int b, n, m = self.n_states
+        cdef double* e
+        cdef double* bw
+
+        X_ndarray, lengths_ndarray = self._check_batch_input(X, lengths)
+        b, n = X_ndarray.shape[0], X_ndarray.shape[1]
+
+        cdef double* X_ptr = <double*> X_ndarray.data
+        cdef int* lengths_ptr = <int*> lengths_ndarray.data
+        cdef numpy.ndarray b_ndarray = numpy.empty((n+1, m, b), dtype='float64')
+
+        with nogil:
+            e = self._batch_emissions(X_ptr, lengths_ptr, b, n)
+            bw = self._backward_batch(e, lengths_ptr, b, n)
+            memcpy(<double*> b_ndarray.data, bw, (n+1)*m*b*sizeof(double))
+            free(e)
+            free(bw)
+
+        return b_ndarray.transpose(2, 0, 1).copy()
+
+    def _check_batch_input(self, X, lengths=None):
+        """Convert a list or padded array of sequences into a padded batch."""
+
+        if lengths is None:
+            sequences = _check_sequences(X, self)
+        else:
+            sequences = [_check_input(X[j][:lengths[j]], self) for j in range(len(lengths))]
+
+        return _pad_sequences(sequences, self.d)
+
+    def _log_probability_batch(self, sequences):
+        """Calculate the log probability of many checked sequences.
+
+        Sequences are grouped into batches of similar length which are each
+        run through the batched forward algorithm.
+        """
+
+        cdef numpy.ndarray X_ndarray, lengths_ndarray
+        cdef numpy.ndarray logp_ndarray
+        cdef int b, n
+        cdef double* e
+        cdef double* f
+
+        logp = numpy.empty(len(sequences), dtype='float64')
+        lengths = numpy.array([len(sequence) for sequence in sequences])
+
+        for batch in _length_batches(lengths, self.n_states):
+            X_ndarray, lengths_ndarray = _pad_sequences([sequences[i] for i in batch], self.d)
+            logp_ndarray = numpy.empty(len(batch), dtype='float64')
+            b, n = X_ndarray.shape[0], X_ndarray.shape[1]
+
+            with nogil:
+                e = self._batch_emissions(<double*> X_ndarray.data,
+                    <int*> lengths_ndarray.data, b, n)
+                f = self._forward_batch(e, <int*> lengths_ndarray.data, b, n)
+                self._batch_log_probability(f, <int*> lengths_ndarray.data, b,
+                    <double*> logp_ndarray.data)
+                free(e)
+                free(f)
+
+            logp[batch] = logp_ndarray
+
+        return logp
+
+    def _predict_log_proba_batch(self, sequences):
+        """Calculate the posterior state log probabilities of many checked
+        sequences using the batched forward and backward algorithms.
+
+        Returns a list with one (length, n_nonsilent_states) array per sequence.
+        """
+
+        cdef numpy.ndarray X_ndarray, lengths_ndarray
+        cdef numpy.ndarray logp_ndarray, r_ndarray
+        cdef int b, n, i, j, k, p = self.silent_start, m = self.n_states
+        cdef int* lengths_ptr
+        cdef double* e
+        cdef double* f
+        cdef double* bw
+        cdef double* r
+        cdef double* logp_ptr
+
+        results = [None for sequence in sequences]
+        lengths = numpy.array([len(sequence) for sequence in sequences])
+
+        for batch in _length_batches(lengths, m):
+            X_ndarray, lengths_ndarray = _pad_sequences([sequences[j] for j in batch], self.d)
+            b, n = X_ndarray.shape[0], X_ndarray.shape[1]
+            lengths_ptr = <int*> lengths_ndarray.data
+
+            logp_ndarray = numpy.empty(b, dtype='float64')
+            logp_ptr = <double*> logp_ndarray.data
+            r_ndarray = numpy.empty(lengths_ndarray.sum() * p, dtype='float64')
+            r = <double*> r_ndarray.data
+
+            with nogil:
+                e = self._batch_emissions(<double*> X_ndarray.data, lengths_ptr, b, n)
+                f = self._forward_batch(e, lengths_ptr, b, n)
+                bw = self._backward_batch(e, lengths_ptr, b, n)
+                self._batch_log_probability(f, lengths_ptr, b, logp_ptr)
+
+                for j in range(b):
+                    for i in range(lengths_ptr[j]):
+                        for k in range(p):
+                            r[i*p + k] = f[((i+1)*m + k)*b + j] + \
+                                bw[((i+1)*m + k)*b + j] - logp_ptr[j]
+
+                    r += lengths_ptr[j] * p
+
+                free(e)
+                free(f)
+                free(bw)
+
+            if numpy.any(logp_ndarray == NEGINF):
+                print("Warning: Sequence is impossible.")
+
+            offsets = numpy.cumsum(lengths_ndarray)[:-1] * p
+            for j, r_j in zip(batch, numpy.split(r_ndarray, offsets)):
+                results[j] = r_j.reshape(-1, p)
+
+        return results
+
+    def _baum_welch_summarize_batch(self, sequences, weights):
+        """Summarize many checked sequences using the batched forward and
+        backward algorithms. Returns the weighted sum of log probabilities.
+        """
+
+        cdef numpy.ndarray X_ndarray, lengths_ndarray, weights_ndarray
+        cdef int b, n
+        cdef double log_probability_sum = 0
+
+        lengths = numpy.array([len(sequence) for sequence in sequences])
+
+        for batch in _length_batches(lengths, self.n_states):
+            X_ndarray, lengths_ndarray = _pad_sequences([sequences[j] for j in batch], self.d)
+            weights_ndarray = numpy.array([weights[j] for j in batch], dtype='float64')
+            b, n = X_ndarray.shape[0], X_ndarray.shape[1]
+
+            with nogil:
+                log_probability_sum += self._summarize_batch(
+                    <double*> X_ndarray.data, <double*> weights_ndarray.data,
+                    <int*> lengths_ndarray.data, b, n)
+
+        return log_probability_sum
+
+    cdef double* _batch_emissions(self, double* X, int* lengths, int b, int n) nogil:
+        """Calculate the emission table of a padded batch of sequences.
+
+        The table is laid out as e[(i*silent_start + l)*b + j] for observation
+        i of sequence j under state l. Padded positions are impossible.
+        """
+
+        cdef int i, j, k, l, p = self.silent_start, dim = self.d
+        cdef void** distributions = self.distributions_ptr
+        cdef double* e = <double*> calloc(n*p*b, sizeof(double))
+        cdef double* scratch = <double*> calloc(n, sizeof(double))
+
+        for i in range(n*p*b):
+            e[i] = NEGINF
+
+        if self.emission_table != NULL:
+            for j in range(b):
+                self._emissions(X+j*n*dim, e+j, lengths[j], p*b, b)
+
+            free(scratch)
+            return e
+
+        for l in range(p):
+            k = self._tied_representative(l)
+            for j in range(b):
+                if k == l:
+                    (<Model> distributions[l])._log_probability(X+j*n*dim, 
+                        scratch, lengths[j])
+
+                    for i in range(lengths[j]):
+                        e[(i*p + l)*b + j] = scratch[i]
+                else:
+                    for i in range(lengths[j]):
+                        e[(i*p + l)*b + j] = e[(i*p + k)*b + j]
+
+        for l in range(p):
+            for j in range(b):
+                for i in range(lengths[j]):
+                    e[(i*p + l)*b + j] += self.state_weights[l]
+
+        free(scratch)
+        return e
+
+    cdef double* _forward_batch(self, double* e, int* lengths, int b, int n) nogil:
+        """Run the forward algorithm on a padded batch of sequences.
+
+        This mirrors `_forward`, but each cell is a vector across the batch,
+        with the matrix laid out as f[(i*m + l)*b + j]. Since padded positions
+        have impossible emissions, cells past the end of a sequence are -inf.
+        """
+
+        cdef int i, j, k, ki, l
+        cdef int p = self.silent_start, m = self.n_states
+        cdef int* in_edges = self.in_edge_count
+
+        cdef double log_transition
+        cdef double* f = <double*> calloc((n+1)*m*b, sizeof(double))
+        cdef double* log_probability = <double*> calloc(b, sizeof(double))
+        cdef double* fp
+        cdef double* fc
+        cdef double* ei
+
+        for i in range((n+1)*m*b):
+            f[i] = NEGINF
+
+        # We must start in the start state, having emitted 0 symbols
+        for j in range(b):
+            f[self.start_index*b + j] = 0.
+
+        for l in range(p, m):
+            # Handle transitions between silent states before the first symbol
+            # is emitted.
+            if l == self.start_index:
+                continue
+
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                if ki < p or ki >= l:
+                    continue
+
+                log_transition = self.in_transition_log_probabilities[k]
+                for j in range(b):
+                    f[l*b + j] = pair_lse(f[l*b + j], f[ki*b + j] + log_transition)
+
+        for i in range(n):
+            fp = f + i*m*b
+            fc = f + (i+1)*m*b
+            ei = e + i*p*b
+
+            for l in range(p):
+                # Do the recurrence for non-silent states l
+                for k in range(in_edges[l], in_edges[l+1]):
+                    ki = self.in_transitions[k]
+                    log_transition = self.in_transition_log_probabilities[k]
+
+                    for j in range(b):
+                        fc[l*b + j] = pair_lse(fc[l*b + j],
+                            fp[ki*b + j] + log_transition)
+
+                for j in range(b):
+                    fc[l*b + j] += ei[l*b + j]
+
+            for l in range(p, m):
+                # First pass over the silent states, from current-step
+                # non-silent states
+                for k in range(in_edges[l], in_edges[l+1]):
+                    ki = self.in_transitions[k]
+                    if ki >= p:
                         continue
 
-                    # For each possible current-step silent state we can go to,
-                    # take into account just transition probability
-                    log_probability = pair_lse(log_probability,
-                        b[i*m + li] + self.out_transition_log_probabilities[l])
+                    log_transition = self.in_transition_log_probabilities[k]
+                    for j in range(b):
+                        fc[l*b + j] = pair_lse(fc[l*b + j],
+                            fc[ki*b + j] + log_transition)
 
-                # Now add this probability in with the probability accumulated
-                # from transitions to subsequent non-silent states.
-                b[i*m + k] = pair_lse(log_probability, b[i*m + k])
+            for l in range(p, m):
+                # Second pass through silent states, from current-step
+                # preceding silent states
+                for j in range(b):
+                    log_probability[j] = NEGINF
 
-            for k in range(self.silent_start):
-                # Do the non-silent states in the current step, which depend on
-                # subsequent non-silent states and current-step silent states.
+                for k in range(in_edges[l], in_edges[l+1]):
+                    ki = self.in_transitions[k]
+                    if ki < p or ki >= l:
+                        continue
+
+                    log_transition = self.in_transition_log_probabilities[k]
+                    for j in range(b):
+                        log_probability[j] = pair_lse(log_probability[j],
+                            fc[ki*b + j] + log_transition)
+
+                for j in range(b):
+                    fc[l*b + j] = pair_lse(fc[l*b + j], log_probability[j])
+
+        free(log_probability)
+        return f
+
+    cdef double* _backward_batch(self, double* e, int* lengths, int b, int n) nogil:
+        """Run the backward algorithm on a padded batch of sequences.
+
+        This mirrors `_backward` using the same layout as `_forward_batch`.
+        The base case does not depend on the observations, so it is computed
+        once and placed at the end of each sequence.
+        """
+
+        cdef int i, ir, j, k, kr, l, li
+        cdef int p = self.silent_start, m = self.n_states
+        cdef int* out_edges = self.out_edge_count
+
+        cdef double log_transition
+        cdef double* bw = <double*> calloc((n+1)*m*b, sizeof(double))
+        cdef double* base = <double*> calloc(m, sizeof(double))
+        cdef double* log_probability = <double*> calloc(b, sizeof(double))
+        cdef double* bc
+        cdef double* bn
+        cdef double* ei
+
+        self._backward_initial(base)
+
+        for i in range((n+1)*m*b):
+            bw[i] = NEGINF
+
+        for j in range(b):
+            if lengths[j] == n:
+                for k in range(m):
+                    bw[(n*m + k)*b + j] = base[k]
+
+        for ir in range(n):
+            i = n - ir - 1
+            bc = bw + i*m*b
+            bn = bw + (i+1)*m*b
+            ei = e + i*p*b
 
-                # This holds the total accumulated log probability of going
-                # to such states and continuing from there to the end.
-                log_probability = NEGINF
+            for kr in range(m-p):
+                k = m - kr - 1
+
+                # Silent states' dependency on subsequent non-silent states
                 for l in range(out_edges[k], out_edges[k+1]):
                     li = self.out_transitions[l]
-                    if li >= self.silent_start:
+                    if li >= p:
                         continue
 
-                    # For each subsequent non-silent state l, take into account
-                    # transition and emission emission probability.
-                    log_probability = pair_lse(log_probability,
-                        b[(i+1)*m + li] + self.out_transition_log_probabilities[l] +
-                        e[i + li*n])
+                    log_transition = self.out_transition_log_probabilities[l]
+                    for j in range(b):
+                        bc[k*b + j] = pair_lse(bc[k*b + j],
+                            bn[li*b + j] + log_transition + ei[li*b + j])
+
+            for kr in range(m-p):
+                k = m - kr - 1
+
+                # Silent states' dependencies on each other
+                for j in range(b):
+                    log_probability[j] = NEGINF
 
                 for l in range(out_edges[k], out_edges[k+1]):
                     li = self.out_transitions[l]
-                    if li < self.silent_start:
+                    if li < k+1:
                         continue
 
-                    # For each current-step silent state, add in the probability
-                    # of going from here to there and then continuing on to the
-                    # end of the sequence.
-                    log_probability = pair_lse(log_probability,
-                        b[i*m + li] + self.out_transition_log_probabilities[l])
+                    log_transition = self.out_transition_log_probabilities[l]
+                    for j in range(b):
+                        log_probability[j] = pair_lse(log_probability[j],
+                            bc[li*b + j] + log_transition)
 
-                # Now we have summed the probabilities of all the ways we can
-                # get from here to the end, so we can fill in the table entry.
-                b[i*m + k] = log_probability
+                for j in range(b):
+                    bc[k*b + j] = pair_lse(log_probability[j], bc[k*b + j])
 
-        if emissions is NULL:
-            free(e)
-        return b
+            for k in range(p):
+                # Non-silent states depend on subsequent non-silent states and
+                # current-step silent states.
+                for l in range(out_edges[k], out_edges[k+1]):
+                    li = self.out_transitions[l]
+                    if li >= p:
+                        continue
 
-    def forward_backward(self, sequence):
+                    log_transition = self.out_transition_log_probabilities[l]
+                    for j in range(b):
+                        bc[k*b + j] = pair_lse(bc[k*b + j],
+                            bn[li*b + j] + log_transition + ei[li*b + j])
+
+                for l in range(out_edges[k], out_edges[k+1]):
+                    li = self.out_transitions[l]
+                    if li < p:
+                        continue
+
+                    log_transition = self.out_transition_log_probabilities[l]
+                    for j in range(b):
+                        bc[k*b + j] = pair_lse(bc[k*b + j],
+                            bc[li*b + j] + log_transition)
+
+            # Sequences which end here start from the base case instead.
+            for j in range(b):
+                if lengths[j] == i:
+                    for k in range(m):
+                        bc[k*b + j] = base[k]
+
+        free(base)
+        free(log_probability)
+        return bw
+
+    cdef void _batch_log_probability(self, double* f, int* lengths, int b,
+        double* log_probabilities) nogil:
+        """Extract the log probability of each sequence from a batched
+        forward matrix."""
+
+        cdef int i, j, n, m = self.n_states
+
+        for j in range(b):
+            n = lengths[j]
+
+            if self.finite == 1:
+                log_probabilities[j] = f[(n*m + self.end_index)*b + j]
+            else:
+                log_probabilities[j] = NEGINF
+                for i in range(self.silent_start):
+                    log_probabilities[j] = pair_lse(log_probabilities[j],
+                        f[(n*m + i)*b + j])
+
+    def forward_backward(self, sequence, memory_budget=None, n_jobs=1):
         """Run the forward-backward algorithm on the sequence.
 
         This algorithm returns an emission matrix and a transition matrix. The
@@ -1764,6 +4042,23 @@ cdef class HiddenMarkovModel(GraphModel):
         sequence : array-like
             An array (or list) of observations.
 
+        memory_budget : int or None, optional
+            The maximum number of bytes to use for the dynamic programming
+            matrices of a single sequence. If the full forward, backward and
+            emission matrices would exceed this, a checkpointed version of the
+            algorithm is used which stores only every k-th row of the forward
+            matrix and recomputes the rows in between during the backward
+            pass, using O(sqrt(n)) memory at the cost of a second forward
+            pass. If None, the full matrices are always used. Default is None.
+
+        n_jobs : int, optional
+            The number of threads to split the sequence across. Each thread
+            summarizes its part of the sequence starting from every
+            non-silent state, which multiplies the work by the number of
+            non-silent states, so this is only faster for long sequences when
+            n_jobs is well above the number of states. It is not used when
+            the memory budget requires checkpointing. Default is 1.
+
         Returns
         -------
         emissions : array-like, shape (len(sequence), n_nonsilent_states)
@@ -1785,8 +4080,95 @@ cdef class HiddenMarkovModel(GraphModel):
         sequence_ndarray = _check_input(sequence, self)
         sequence_data = <double*> sequence_ndarray.data
 
+        checkpoint = self._checkpoint_interval(n, memory_budget)
+        if checkpoint > 0:
+            return self._checkpoint_forward_backward_ndarray(sequence_data, n,
+                checkpoint)
+
+        if n_jobs > 1 and n > 1:
+            return self._parallel_forward_backward(sequence_ndarray, n, n_jobs)
+
         return self._forward_backward(sequence_data, n)
 
+    cdef tuple _parallel_forward_backward(self, numpy.ndarray sequence_ndarray,
+        int n, int n_jobs):
+        cdef int c, m = self.n_states, p = self.silent_start
+        cdef int n_chunks = min(n_jobs, m)
+        cdef list bounds = [int(c*m/n_chunks) for c in range(n_chunks+1)]
+        cdef double log_sequence_probability
+
+        f_ndarray, _, e_ndarray = self._scan(sequence_ndarray, None, n, n_jobs,
+            0, True)
+        b_ndarray = self._scan(sequence_ndarray, e_ndarray, n, n_jobs, 1, True)[0]
+
+        log_sequence_probability = self._forward_log_probability(
+            <double*> (<numpy.ndarray> f_ndarray).data, n)
+
+        if log_sequence_probability == NEGINF:
+            print("Warning: Sequence is impossible.")
+            return (None, None)
+
+        expected_transitions_ndarray = numpy.zeros((m, m))
+        emission_weights_ndarray = numpy.zeros((n, p))
+
+        # Each thread handles the edges out of its own range of states, so
+        # they write to disjoint parts of both tables.
+        with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+            parallel([delayed(self._scan_expected_counts, check_pickle=False)(
+                e_ndarray, f_ndarray, b_ndarray, n, log_sequence_probability,
+                bounds[c], bounds[c+1], expected_transitions_ndarray,
+                emission_weights_ndarray) for c in range(n_chunks)])
+
+        return expected_transitions_ndarray, emission_weights_ndarray
+
+    def _scan_expected_counts(self, numpy.ndarray e_ndarray,
+        numpy.ndarray f_ndarray, numpy.ndarray b_ndarray, int n,
+        double log_sequence_probability, int k_start, int k_end,
+        numpy.ndarray expected_transitions_ndarray,
+        numpy.ndarray emission_weights_ndarray):
+        """Fill in the expected counts of a range of states without the GIL."""
+
+        cdef double* e = <double*> e_ndarray.data
+        cdef double* f = <double*> f_ndarray.data
+        cdef double* b = <double*> b_ndarray.data
+        cdef double* expected_transitions = <double*> expected_transitions_ndarray.data
+        cdef double* emission_weights = <double*> emission_weights_ndarray.data
+
+        with nogil:
+            self._expected_counts(e, f, b, n, log_sequence_probability,
+                k_start, k_end, expected_transitions, emission_weights)
+
+    cdef tuple _checkpoint_forward_backward_ndarray(self, double* sequence,
+        int n, int c):
+        cdef int k, l, li, m = self.n_states
+        cdef double log_sequence_probability
+
+        cdef numpy.ndarray expected_transitions_ndarray = numpy.zeros((m, m))
+        cdef double* expected_transitions = <double*> expected_transitions_ndarray.data
+
+        cdef numpy.ndarray emission_weights_ndarray = numpy.zeros((n, self.silent_start))
+        cdef double* emission_weights = <double*> emission_weights_ndarray.data
+
+        cdef double* transitions = <double*> calloc(self.n_edges, sizeof(double))
+        cdef int* out_edges = self.out_edge_count
+
+        with nogil:
+            log_sequence_probability = self._checkpoint_forward_backward(
+                sequence, n, c, transitions, emission_weights, NULL)
+
+            for k in range(m):
+                for l in range(out_edges[k], out_edges[k+1]):
+                    li = self.out_transitions[l]
+                    expected_transitions[k*m + li] = transitions[l]
+
+        free(transitions)
+
+        if log_sequence_probability == NEGINF:
+            print("Warning: Sequence is impossible.")
+            return (None, None)
+
+        return expected_transitions_ndarray, emission_weights_ndarray
+
     cdef tuple _forward_backward(self, double* sequence, int n):
         cdef int i, k, j, l, ki, li
         cdef int m=len(self.states)
@@ -1804,16 +4186,11 @@ cdef class HiddenMarkovModel(GraphModel):
         cdef double* emission_weights = <double*> emission_weights_ndarray.data
 
         cdef double log_sequence_probability, log_probability
-        cdef double log_transition_emission_probability_sum
 
-        cdef int* out_edges = self.out_edge_count
         cdef int* tied_states = self.tied_state_count
 
         # Calculate the emissions table
-        for l in range(self.silent_start):
-            for i in range(n):
-                (<Model> distributions[l])._log_probability(sequence+i*dim, e+l*n+i, 1)
-                e[l*n + i] += self.state_weights[l]
+        self._emissions(sequence, e, n, 1, n)
 
         f = self._forward(sequence, n, e)
         b = self._backward(sequence, n, e)
@@ -1831,7 +4208,27 @@ cdef class HiddenMarkovModel(GraphModel):
             print("Warning: Sequence is impossible.")
             return (None, None)
 
-        for k in range(m):
+        self._expected_counts(e, f, b, n, log_sequence_probability, 0, m,
+            expected_transitions, emission_weights)
+
+        free(e)
+        free(b)
+        free(f)
+
+        return expected_transitions_ndarray, emission_weights_ndarray
+
+    cdef void _expected_counts(self, double* e, double* f, double* b, int n,
+        double log_sequence_probability, int k_start, int k_end,
+        double* expected_transitions, double* emission_weights) nogil:
+        """Fill in the expected transitions out of, and the emission weights
+        of, the states from k_start to k_end given the emission, forward and
+        backward matrices of a sequence."""
+
+        cdef int i, k, l, li, m = self.n_states
+        cdef int* out_edges = self.out_edge_count
+        cdef double log_transition_emission_probability_sum
+
+        for k in range(k_start, k_end):
             # For each state we could have come from
             for l in range(out_edges[k], out_edges[k+1]):
                 li = self.out_transitions[l]
@@ -1894,7 +4291,7 @@ cdef class HiddenMarkovModel(GraphModel):
             if k < self.silent_start:
                 # Now think about emission probabilities from this state
 
-                for i in xrange(n):
+                for i in range(n):
                     # For each symbol that came out
 
                     # What's the weight of this symbol for that state?
@@ -1907,17 +4304,198 @@ cdef class HiddenMarkovModel(GraphModel):
                     # docs/HTKBook/node7_mn.html, we really should divide by
                     # sequence probability.
 
-                    emission_weights[i*self.silent_start + k] = f[(i+1)*m + k] + b[(i+1)*m + k] - \
-                        log_sequence_probability
+                    emission_weights[i*self.silent_start + k] = f[(i+1)*m + k] + b[(i+1)*m + k] - \
+                        log_sequence_probability
+
+    def _checkpoint_interval(self, n, memory_budget):
+        """Return the spacing of stored forward rows for a sequence of length
+        n under the given memory budget, in bytes, or 0 if the full dynamic
+        programming matrices fit within the budget."""
+
+        m, p = self.n_states, self.silent_start
+
+        if memory_budget is None or (2*(n+1)*m + n*p) * 8 <= memory_budget:
+            return 0
+
+        # Storing every c-th row costs (n/c)*m cells for the checkpoints plus
+        # about c*(m+2p) cells for a recomputed segment, minimized at
+        # c = sqrt(n*m / (m+2p)).
+        return max(1, int(math.sqrt(n * m / (m + 2.*p))))
+
+    cdef void _emission_block(self, double* sequence, double* e, int n) nogil:
+        """Fill in the emission table of n symbols laid out row by row, so
+        that the emission of symbol i under state l is e[i*silent_start + l]."""
+
+        self._emissions(sequence, e, n, self.silent_start, 1)
+
+    cdef double _checkpoint_forward_backward(self, double* sequence, int n,
+        int c, double* transitions, double* r, double* weight, 
+        PosteriorSink* sink=NULL) nogil:
+        """Run the forward-backward algorithm in O(sqrt(n)) memory.
+
+        The forward pass only stores every c-th row of the forward matrix.
+        The backward pass then moves over the sequence one segment of c
+        symbols at a time from the end, recomputing the forward rows and
+        emissions of that segment from its checkpoint, and only ever holds
+        two rows of the backward matrix.
+
+        The expected number of transitions across each edge is written to
+        transitions. If r is not NULL, the posterior log probability of
+        each symbol under each non-silent state is written to it, and if
+        sink is not NULL they are passed to it one symbol at a time. If
+        weight is not NULL, the emission distributions are summarized one
+        segment at a time using the posteriors multiplied by the weight.
+        """
+
+        cdef int i, il, j, k, l, li, s, t
+        cdef int p = self.silent_start, m = self.n_states, dim = self.d
+        cdef int n_checkpoints = n / c + 1
+        cdef int* out_edges = self.out_edge_count
+        cdef void** distributions = self.distributions_ptr
+
+        cdef double log_sequence_probability, log_probability, log_transition
+
+        cdef double* checkpoints = <double*> calloc(n_checkpoints*m, sizeof(double))
+        cdef double* f = <double*> calloc((c+1)*m, sizeof(double))
+        cdef double* e = <double*> calloc(c*p, sizeof(double))
+        cdef double* b = <double*> calloc(2*m, sizeof(double))
+        cdef double* log_transitions = <double*> calloc(self.n_edges, sizeof(double))
+        cdef double* weights = NULL
+        cdef double* posteriors = NULL
+        cdef double* bc = b
+        cdef double* bn = b + m
+        cdef double* fi
+        cdef double* fn
+
+        if weight is not NULL:
+            weights = <double*> calloc(c*p, sizeof(double))
+        if sink is not NULL:
+            posteriors = <double*> calloc(p, sizeof(double))
+
+        # Run the forward pass keeping only the previous row and every c-th
+        # row of the matrix.
+        self._forward_initial(f)
+        memcpy(checkpoints, f, m*sizeof(double))
+
+        for i in range(n):
+            self._emission_block(sequence+i*dim, e, 1)
+            self._forward_step(f + (i%2)*m, f + ((i+1)%2)*m, e, 1)
+
+            if (i+1) % c == 0:
+                memcpy(checkpoints + ((i+1)/c)*m, f + ((i+1)%2)*m, m*sizeof(double))
+
+        fi = f + (n%2)*m
+        if self.finite == 1:
+            log_sequence_probability = fi[self.end_index]
+        else:
+            log_sequence_probability = NEGINF
+            for k in range(p):
+                log_sequence_probability = pair_lse(log_sequence_probability,
+                    fi[k])
+
+        # Is the sequence impossible? If so, we can't train on it, so skip it.
+        if log_sequence_probability == NEGINF and weight is not NULL:
+            free(checkpoints)
+            free(f)
+            free(e)
+            free(b)
+            free(log_transitions)
+            free(weights)
+            free(posteriors)
+            return log_sequence_probability
+
+        for l in range(self.n_edges):
+            log_transitions[l] = NEGINF
+
+        self._backward_initial(bn)
+
+        for j in range(n_checkpoints-1, -1, -1):
+            s = j*c
+            t = min(s+c, n)
+            if s == t:
+                continue
+
+            # Recompute the forward rows of this segment from its checkpoint.
+            memcpy(f, checkpoints + j*m, m*sizeof(double))
+            self._emission_block(sequence+s*dim, e, t-s)
+            for il in range(t-s):
+                self._forward_step(f + il*m, f + (il+1)*m, e + il*p, 1)
+
+            for il in range(t-s-1, -1, -1):
+                i = s + il
+                fi = f + il*m
+                fn = f + (il+1)*m
+
+                self._backward_step(bc, bn, e + il*p, 1)
+
+                for k in range(m):
+                    for l in range(out_edges[k], out_edges[k+1]):
+                        li = self.out_transitions[l]
+                        log_transition = self.out_transition_log_probabilities[l]
+
+                        # Transitions to non-silent states emitting symbol i,
+                        # and transitions to silent states in row i+1.
+                        if li < p:
+                            log_transitions[l] = pair_lse(log_transitions[l],
+                                fi[k] + log_transition + e[il*p + li] + bn[li])
+                        else:
+                            log_transitions[l] = pair_lse(log_transitions[l],
+                                fn[k] + log_transition + bn[li])
+
+                for k in range(p):
+                    log_probability = fn[k] + bn[k] - log_sequence_probability
+
+                    if r is not NULL:
+                        r[i*p + k] = log_probability
+                    if posteriors is not NULL:
+                        posteriors[k] = log_probability
+                    if weights is not NULL:
+                        weights[k*c + il] = cexp(log_probability) * weight[0]
+
+                if sink is not NULL:
+                    _sink_posteriors(sink, i, posteriors, p)
+
+                bc, bn = bn, bc
+
+            if weights is not NULL:
+                for k in range(p):
+                    if self._tied_representative(k) != k:
+                        continue
+
+                    for j in range(self.tied_state_count[k], 
+                        self.tied_state_count[k+1]):
+                        li = self.tied[j]
+                        for il in range(t-s):
+                            weights[k*c + il] += weights[li*c + il]
+
+                    (<Model> distributions[k])._summarize(sequence+s*dim,
+                        weights+k*c, t-s, 0, dim)
 
+        # Transitions to silent states before the first symbol is emitted. The
+        # first segment is the last one recomputed, so f holds row 0.
+        for k in range(m):
+            for l in range(out_edges[k], out_edges[k+1]):
+                li = self.out_transitions[l]
+                if li < p:
+                    continue
 
+                log_transitions[l] = pair_lse(log_transitions[l],
+                    f[k] + self.out_transition_log_probabilities[l] + bn[li])
+
+        for l in range(self.n_edges):
+            transitions[l] = cexp(log_transitions[l] - log_sequence_probability)
+
+        free(checkpoints)
+        free(f)
         free(e)
         free(b)
-        free(f)
-
-        return expected_transitions_ndarray, emission_weights_ndarray
+        free(log_transitions)
+        free(weights)
+        free(posteriors)
+        return log_sequence_probability
 
-    cpdef tuple viterbi(self, sequence):
+    cpdef viterbi(self, sequence, beam=None, beam_size=None, 
+        return_pruned=False, n_jobs=1):
         """Run the Viteri algorithm on the sequence.
 
         Run the Viterbi algorithm on the sequence given the model. This finds
@@ -1931,14 +4509,47 @@ cdef class HiddenMarkovModel(GraphModel):
         silent states in the current step can trace back to other silent states
         in the current step as well as states in the previous step.
 
+        If a beam is given, an approximate beam search is run instead. At each
+        observation only the states whose path score is within `beam` of the
+        best state, and optionally only the `beam_size` best states, are
+        extended to the next observation. Only the states which are reached
+        are scored, and the traceback is stored sparsely, so the time and
+        memory needed depend on the number of states kept rather than the
+        number of states in the model. The path returned may not be the
+        Viterbi path if the Viterbi path falls out of the beam.
+
         See also:
             - Viterbi implementation described well in the wikipedia article
             http://en.wikipedia.org/wiki/Viterbi_algorithm
 
         Parameters
         ----------
-        sequence : array-like
-            An array (or list) of observations.
+        sequence : array-like or RaggedSequences
+            An array (or list) of observations. If a RaggedSequences
+            collection is given, a list with the result for each sequence in
+            it is returned.
+
+        beam : double or None, optional
+            The log probability threshold of the beam. States whose score is
+            more than this below the best score at that observation are
+            pruned. If None and beam_size is None, run exact Viterbi.
+            Default is None.
+
+        beam_size : int or None, optional
+            The maximum number of states to keep at each observation. If None,
+            keep all states within the threshold. Default is None.
+
+        return_pruned : bool, optional
+            Whether to also return the number of (observation, state) cells
+            that were pruned by the beam. Default is False.
+
+        n_jobs : int, optional
+            The number of threads to split the sequence across when running
+            exact Viterbi. Each thread summarizes its part of the sequence
+            starting from every non-silent state, which multiplies the work
+            by the number of non-silent states, so this is only faster for
+            long sequences when n_jobs is well above the number of states.
+            Default is 1.
 
         Returns
         -------
@@ -1948,14 +4559,29 @@ cdef class HiddenMarkovModel(GraphModel):
         path : list of tuples
             Tuples of (state index, state object) of the states along the
             Viterbi path.
+
+        n_pruned : int
+            The number of cells pruned by the beam, only returned if
+            return_pruned is True.
         """
 
         if self.d == 0:
             raise ValueError("must bake model before using Viterbi algorithm")
 
+        if beam_size is not None and beam_size < 1:
+            raise ValueError("beam_size must be at least 1")
+
+        if isinstance(sequence, RaggedSequences):
+            return [self.viterbi(sequence_view, beam, beam_size, return_pruned,
+                n_jobs) for sequence_view in sequence.encode(self)]
+
         cdef numpy.ndarray sequence_ndarray
         cdef double* sequence_data
         cdef double logp
+        cdef double beam_threshold = INF if beam is None else beam
+        cdef int max_states = 0 if beam_size is None else beam_size
+        cdef int n_pruned = 0
+        cdef ScratchArena* arena
         cdef int n = len(sequence), m = len(self.states)
         cdef int mv = self.multivariate
         cdef void** distributions = <void**> self.distributions.data
@@ -1964,7 +4590,20 @@ cdef class HiddenMarkovModel(GraphModel):
 
         sequence_ndarray = _check_input(sequence, self)
         sequence_data = <double*> sequence_ndarray.data
-        logp = self._viterbi(sequence_data, path, n, m)
+
+        if beam is None and beam_size is None and n_jobs > 1 and n > 1:
+            logp = self._parallel_viterbi(sequence_ndarray, path, n, n_jobs)
+        elif beam is None and beam_size is None:
+            arena = self._acquire_scratch()
+            try:
+                with nogil:
+                    logp = self._viterbi(sequence_data, path, n, m, arena)
+            finally:
+                self._release_scratch(arena)
+        else:
+            with nogil:
+                logp = self._beam_viterbi(sequence_data, path, n, m, 
+                    beam_threshold, max_states, &n_pruned)
 
         for i in range(n+m):
             if path[i] == -1:
@@ -1973,20 +4612,363 @@ cdef class HiddenMarkovModel(GraphModel):
             vpath.append((path[i], self.states[path[i]]))
 
         free(path)
+
+        if return_pruned:
+            return logp, vpath if logp > NEGINF else None, n_pruned
         return logp, vpath if logp > NEGINF else None
 
+    def n_best_viterbi(self, sequence, k):
+        """Find the k most likely paths of hidden states for the sequence.
+
+        The Viterbi matrix is filled in once, and the paths are then
+        enumerated lazily in order of decreasing probability using the
+        recursive enumeration algorithm of Jimenez and Marzal. Each cell of
+        the matrix keeps the best paths into it found so far and a heap of
+        the candidates for its next best path, and only the cells along the
+        paths returned are visited, so each path after the first costs time
+        proportional to its length rather than another pass over the matrix.
+
+        Parameters
+        ----------
+        sequence : array-like or RaggedSequences
+            An array (or list) of observations. If a RaggedSequences
+            collection is given, a list with the result for each sequence in
+            it is returned.
+
+        k : int
+            The number of paths to find.
+
+        Returns
+        -------
+        paths : list of tuples
+            Up to k tuples of (logp, path), best first, where path is a list
+            of (state index, state object) tuples as returned by `viterbi`.
+            Fewer than k are returned if the sequence has fewer possible
+            paths.
+        """
+
+        if self.d == 0:
+            raise ValueError("must bake model before using Viterbi algorithm")
+
+        if k < 1:
+            raise ValueError("k must be at least 1")
+
+        if isinstance(sequence, RaggedSequences):
+            return [self.n_best_viterbi(sequence_view, k) 
+                for sequence_view in sequence.encode(self)]
+
+        cdef int i, j, n = len(sequence), n_paths = k
+        cdef numpy.ndarray sequence_ndarray = _check_input(sequence, self)
+        cdef numpy.ndarray logp_ndarray = numpy.empty(k, dtype='float64')
+        cdef double* sequence_data = <double*> sequence_ndarray.data
+        cdef IntBuffer paths
+        cdef int status
+
+        memset(&paths, 0, sizeof(IntBuffer))
+
+        with nogil:
+            status = self._n_best_viterbi(sequence_data, n, &n_paths, 
+                <double*> logp_ndarray.data, &paths)
+
+        path_ndarray = _buffer_array(&paths)
+        if status != 0:
+            raise MemoryError("ran out of memory while finding paths")
+
+        states, indices = self.states, path_ndarray.tolist()
+        ends = numpy.flatnonzero(path_ndarray == -1).tolist()
+
+        results, j = [], 0
+        for i in range(n_paths):
+            results.append((logp_ndarray[i], [(index, states[index]) 
+                for index in indices[j:ends[i]]]))
+            j = ends[i] + 1
+
+        return results
+
+    cdef double _parallel_viterbi(self, numpy.ndarray sequence_ndarray,
+        int* path, int n, int n_jobs):
+        cdef int i, l, ki, m = self.n_states, p = self.silent_start
+        cdef int end_index, length = 0
+        cdef double log_probability
+
+        v_ndarray, tb_ndarray, _ = self._scan(sequence_ndarray, None, n,
+            n_jobs, 2, True)
+
+        cdef double* v = <double*> (<numpy.ndarray> v_ndarray).data
+        cdef int* tb = <int*> (<numpy.ndarray> tb_ndarray).data
+
+        memset(path, -1, (n+m)*sizeof(int))
+
+        if self.finite == 1:
+            log_probability = v[n*m + self.end_index]
+            end_index = self.end_index
+        else:
+            end_index = -1
+            log_probability = NEGINF
+            for l in range(m):
+                if v[n*m + l] > log_probability:
+                    log_probability = v[n*m + l]
+                    end_index = l
+
+        if log_probability == NEGINF:
+            return log_probability
+
+        i, l = n, end_index
+        while i != 0 or l != self.start_index:
+            path[length] = l
+            length += 1
+
+            ki = tb[i*m + l]
+            if l < p:
+                i -= 1
+                l = ki
+            else:
+                l = -1 - ki
+
+        path[length] = l
+
+        for i in range((length + 1) / 2):
+            path[i], path[length-i] = path[length-i], path[i]
+
+        return log_probability
+
+    cdef double _beam_viterbi(self, double* sequence, int* path, int n, int m,
+        double beam, int beam_size, int* n_pruned) nogil:
+        """Run Viterbi keeping only the best states at each observation.
+
+        Scores are pushed along the out edges of the states kept at the
+        previous observation, so states which are not reached are never
+        scored. The traceback is stored as a list of entries, one for each
+        state reached at each observation, each pointing to the entry of
+        its best predecessor.
+        """
+
+        cdef int p = self.silent_start, dim = self.d
+        cdef int i, j, k, l, li, nt, nk, end_entry, length
+        cdef double score, threshold, log_probability
+        cdef void** distributions = self.distributions_ptr
+        cdef int* out_edges = self.out_edge_count
+
+        cdef double* vp = <double*> calloc(m, sizeof(double))
+        cdef double* vc = <double*> calloc(m, sizeof(double))
+        cdef double* scores = <double*> calloc(m, sizeof(double))
+        cdef int* ep = <int*> calloc(m, sizeof(int))
+        cdef int* ec = <int*> calloc(m, sizeof(int))
+        cdef int* bp = <int*> calloc(m, sizeof(int))
+        cdef int* kept = <int*> calloc(m, sizeof(int))
+        cdef int* touched = <int*> calloc(m, sizeof(int))
+        cdef double* tmp_v
+        cdef double* row
+        cdef int* tmp_i
+
+        cdef int capacity = 4*m, n_entries = 0
+        cdef int* entry_state = <int*> calloc(capacity, sizeof(int))
+        cdef int* entry_parent = <int*> calloc(capacity, sizeof(int))
+
+        if self.emission_table != NULL and \
+            self._emission_version() != self.emission_version:
+            self._update_emission_table()
+
+        memset(path, -1, (n+m)*sizeof(int))
+        for l in range(m):
+            vp[l] = NEGINF
+            vc[l] = NEGINF
+            ep[l] = -1
+            ec[l] = -1
+
+        n_pruned[0] = 0
+        nk = 0
+
+        for i in range(n+1):
+            nt = 0
+
+            if i == 0:
+                vc[self.start_index] = 0
+                bp[self.start_index] = -1
+            else:
+                # Extend the states kept at the previous observation to the
+                # non-silent states at this observation.
+                for j in range(nk):
+                    k = kept[j]
+                    for l in range(out_edges[k], out_edges[k+1]):
+                        li = self.out_transitions[l]
+                        if li >= p:
+                            continue
+
+                        score = vp[k] + self.out_transition_log_probabilities[l]
+                        if vc[li] == NEGINF:
+                            touched[nt] = li
+                            nt += 1
+
+                        if score > vc[li]:
+                            vc[li] = score
+                            bp[li] = ep[k]
+
+                    vp[k] = NEGINF
+                    ep[k] = -1
+
+                # Only the states which were reached need an emission.
+                if self.emission_table != NULL:
+                    row = self._emission_row(sequence[i-1])
+                    for j in range(nt):
+                        l = touched[j]
+                        vc[l] += row[l]
+                else:
+                    for j in range(nt):
+                        l = touched[j]
+                        (<Model> distributions[l])._log_probability(sequence+(i-1)*dim,
+                            &score, 1)
+                        vc[l] += score + self.state_weights[l]
+
+                # Push from the non-silent states to the silent states.
+                for j in range(nt):
+                    k = touched[j]
+                    if vc[k] == NEGINF:
+                        continue
+
+                    for l in range(out_edges[k], out_edges[k+1]):
+                        li = self.out_transitions[l]
+                        if li < p:
+                            continue
+
+                        score = vc[k] + self.out_transition_log_probabilities[l]
+                        if score > vc[li]:
+                            vc[li] = score
+                            bp[li] = -2 - k
+
+            # Silent states are topologically sorted, so each one is final
+            # once all silent states before it have been pushed.
+            for k in range(p, m):
+                if vc[k] == NEGINF:
+                    continue
+
+                touched[nt] = k
+                nt += 1
+
+                for l in range(out_edges[k], out_edges[k+1]):
+                    li = self.out_transitions[l]
+                    if li <= k:
+                        continue
+
+                    score = vc[k] + self.out_transition_log_probabilities[l]
+                    if score > vc[li]:
+                        vc[li] = score
+                        bp[li] = -2 - k
+
+            # Record a traceback entry for each state reached. Parents which
+            # are in this observation are stored as -2 - state, and all of
+            # them have smaller entry indices since states are added in order.
+            if n_entries + nt > capacity:
+                capacity = 2 * (n_entries + nt)
+                tmp_i = <int*> calloc(capacity, sizeof(int))
+                memcpy(tmp_i, entry_state, n_entries*sizeof(int))
+                free(entry_state)
+                entry_state = tmp_i
+
+                tmp_i = <int*> calloc(capacity, sizeof(int))
+                memcpy(tmp_i, entry_parent, n_entries*sizeof(int))
+                free(entry_parent)
+                entry_parent = tmp_i
+
+            for j in range(nt):
+                l = touched[j]
+                if vc[l] == NEGINF:
+                    continue
+
+                if bp[l] <= -2:
+                    bp[l] = ec[-2 - bp[l]]
 
-    cdef double _viterbi(self, double* sequence, int* path, int n, int m) nogil:
+                ec[l] = n_entries
+                entry_state[n_entries] = l
+                entry_parent[n_entries] = bp[l]
+                n_entries += 1
+
+            if i == n:
+                break
+
+            # Prune the states that fall out of the beam.
+            threshold = NEGINF
+            nk = 0
+            for j in range(nt):
+                l = touched[j]
+                if vc[l] > threshold:
+                    threshold = vc[l]
+
+                if vc[l] > NEGINF:
+                    scores[nk] = vc[l]
+                    nk += 1
+
+            threshold -= beam
+            if beam_size > 0 and nk > beam_size:
+                score = _kth_largest(scores, nk, beam_size)
+                if score > threshold:
+                    threshold = score
+
+            nk = 0
+            for j in range(nt):
+                l = touched[j]
+                if vc[l] == NEGINF:
+                    continue
+
+                if vc[l] >= threshold and (beam_size == 0 or nk < beam_size):
+                    kept[nk] = l
+                    nk += 1
+                else:
+                    n_pruned[0] += 1
+                    vc[l] = NEGINF
+                    ec[l] = -1
+
+            # The previous row was cleared as it was extended, so it can be
+            # reused for the next observation.
+            tmp_v = vp; vp = vc; vc = tmp_v
+            tmp_i = ep; ep = ec; ec = tmp_i
+
+        if self.finite == 1:
+            log_probability = vc[self.end_index]
+            end_entry = ec[self.end_index]
+        else:
+            log_probability = NEGINF
+            end_entry = -1
+            for j in range(nt):
+                l = touched[j]
+                if vc[l] > log_probability:
+                    log_probability = vc[l]
+                    end_entry = ec[l]
+
+        if log_probability != NEGINF:
+            length = 0
+            while end_entry != -1:
+                path[length] = entry_state[end_entry]
+                end_entry = entry_parent[end_entry]
+                length += 1
+
+            for i in range(length / 2):
+                path[i], path[length-i-1] = path[length-i-1], path[i]
+
+        free(vp)
+        free(vc)
+        free(scores)
+        free(ep)
+        free(ec)
+        free(bp)
+        free(kept)
+        free(touched)
+        free(entry_state)
+        free(entry_parent)
+        return log_probability
+
+    cdef double _viterbi(self, double* sequence, int* path, int n, int m,
+        ScratchArena* arena=NULL) nogil:
         cdef int p = self.silent_start
         cdef int i, l, k, ki
         cdef int dim = self.d
 
         cdef void** distributions = <void**> self.distributions_ptr
 
-        cdef int* tracebackx = <int*> calloc((n+1)*m, sizeof(int))
-        cdef int* tracebacky = <int*> calloc((n+1)*m, sizeof(int))
-        cdef double* v = <double*> calloc((n+1)*m, sizeof(double))
-        cdef double* e = <double*> calloc((n*self.silent_start), sizeof(double))
+        cdef int* tracebackx = <int*> _scratch_alloc(arena, (n+1)*m*sizeof(int))
+        cdef int* tracebacky = <int*> _scratch_alloc(arena, (n+1)*m*sizeof(int))
+        cdef double* v = <double*> _scratch_alloc(arena, (n+1)*m*sizeof(double))
+        cdef double* e = <double*> _scratch_alloc(arena, n*p*sizeof(double))
 
         cdef double state_log_probability
         cdef int end_index
@@ -1996,10 +4978,7 @@ cdef class HiddenMarkovModel(GraphModel):
         memset(path, -1, (n+m)*sizeof(int))
 
         # Fill in the emission table
-        for l in range(self.silent_start):
-            for i in range(n):
-                (<Model> distributions[l])._log_probability(sequence+i*dim, e+l*n+i, 1)
-                e[l*n + i] += self.state_weights[l]
+        self._emissions(sequence, e, n, 1, n)
 
         for i in range(m):
             v[i] = NEGINF
@@ -2102,45 +5081,537 @@ cdef class HiddenMarkovModel(GraphModel):
                     log_probability = v[n*m + i]
                     end_index = i
 
-        if log_probability == NEGINF:
-            free(tracebackx)
-            free(tracebacky)
-            free(v)
-            free(e)
-            return log_probability
+        if log_probability == NEGINF:
+            _scratch_free(arena, tracebackx)
+            _scratch_free(arena, tracebacky)
+            _scratch_free(arena, v)
+            _scratch_free(arena, e)
+            return log_probability
+
+        # Otherwise, do the traceback
+        # This holds the path, which we construct in reverse order
+        cdef int px = n, py = end_index, npx
+        cdef int length = 0
+
+        while px != 0 or py != self.start_index:
+            # Until we've traced back to the start...
+            # Put the position in the path, making sure to look up the state
+            # object to use instead of the state index.
+            path[length] = py
+            length += 1
+
+            # Go backwards
+            npx = tracebackx[px*m + py]
+            py = tracebacky[px*m + py]
+            px = npx
+
+        # We've now reached the start (if we didn't raise an exception because
+        # we messed up the traceback)
+        # Record that we start at the start
+        path[length] = py
+
+        for i in range((length + 1) / 2):
+            path[i], path[length-i] = path[length-i], path[i] 
+
+        _scratch_free(arena, tracebackx)
+        _scratch_free(arena, tracebacky)
+        _scratch_free(arena, v)
+        _scratch_free(arena, e)
+        return log_probability
+
+    cdef void _viterbi_initial(self, double* v, int* tb) nogil:
+        """Fill in the first row of the Viterbi matrix, before any symbol has
+        been emitted. If tb is not NULL the best predecessor of each silent
+        state is stored in it as -1 - state index."""
+
+        cdef int k, ki, l, m = self.n_states
+        cdef int* in_edges = self.in_edge_count
+        cdef double score
+
+        for l in range(m):
+            v[l] = NEGINF
+            if tb != NULL:
+                tb[l] = -1
+        v[self.start_index] = 0
+
+        for l in range(self.silent_start, m):
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                if ki < self.silent_start or ki >= l:
+                    continue
+
+                score = v[ki] + self.in_transition_log_probabilities[k]
+                if score > v[l]:
+                    v[l] = score
+                    if tb != NULL:
+                        tb[l] = -1 - ki
+
+    cdef void _viterbi_step(self, double* vp, double* vc, double* e,
+        int stride, int* tb) nogil:
+        """Calculate one row of the Viterbi matrix, vc, from the previous row,
+        vp. The emission of state l for this symbol is e[l*stride]. If tb is
+        not NULL the best predecessor of each state is stored in it, as the
+        state index for predecessors in the previous row and as -1 - state
+        index for predecessors in the same row, which only silent states
+        have."""
+
+        cdef int k, ki, l, p = self.silent_start
+        cdef int* in_edges = self.in_edge_count
+        cdef double score
+
+        for l in range(p):
+            vc[l] = NEGINF
+            if tb != NULL:
+                tb[l] = -1
+
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                score = vp[ki] + self.in_transition_log_probabilities[k]
+                if score > vc[l]:
+                    vc[l] = score
+                    if tb != NULL:
+                        tb[l] = ki
+
+            vc[l] += e[l*stride]
+
+        self._viterbi_silent(vc, tb)
+
+    cdef void _viterbi_silent(self, double* vc, int* tb) nogil:
+        """Fill in the silent states of a Viterbi row, vc, from the non-silent
+        states of the same row."""
+
+        cdef int k, ki, l, m = self.n_states, p = self.silent_start
+        cdef int* in_edges = self.in_edge_count
+        cdef double score
+
+        for l in range(p, m):
+            vc[l] = NEGINF
+            if tb != NULL:
+                tb[l] = -1
+
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                if ki >= p:
+                    continue
+
+                score = vc[ki] + self.in_transition_log_probabilities[k]
+                if score > vc[l]:
+                    vc[l] = score
+                    if tb != NULL:
+                        tb[l] = -1 - ki
+
+        for l in range(p, m):
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                if ki < p or ki >= l:
+                    continue
+
+                score = vc[ki] + self.in_transition_log_probabilities[k]
+                if score > vc[l]:
+                    vc[l] = score
+                    if tb != NULL:
+                        tb[l] = -1 - ki
+
+    cdef int _n_best_viterbi(self, double* sequence, int n, int* k, 
+        double* logp, IntBuffer* paths) nogil:
+        """Find the k best paths of hidden states for a sequence, writing the
+        log probability of each to logp and appending the states of each to
+        paths followed by -1. k is set to the number of paths found. Returns
+        -1 if memory ran out.
+
+        Cell i*m + l is state l after i symbols, and cell (n+1)*m collects
+        the paths through the whole sequence: from the end state if the
+        model is finite and from any state otherwise.
+        """
+
+        cdef int i, j, r, m = self.n_states, p = self.silent_start
+        cdef int n_cells = (n+1)*m + 1, status = 0, n_paths = 0
+        cdef double* v = <double*> calloc((n+1)*m, sizeof(double))
+        cdef double* e = <double*> calloc(n*p + 1, sizeof(double))
+        cdef KBestCell** cells = <KBestCell**> calloc(n_cells, sizeof(KBestCell*))
+        cdef KBestCell* cell
+        cdef KBestPath path
+        cdef IntBuffer stack
+
+        memset(&stack, 0, sizeof(IntBuffer))
+
+        self._emissions(sequence, e, n, 1, n)
+        self._viterbi_initial(v, NULL)
+        for i in range(n):
+            self._viterbi_step(v + i*m, v + (i+1)*m, e + i, n, NULL)
+
+        for r in range(k[0]):
+            status = self._kbest_next(cells, v, e, n, n_cells-1, r, &stack)
+            if status != 0 or cells[n_cells-1].n_paths <= r:
+                break
+
+            cell = cells[n_cells-1]
+            logp[r] = cell.paths[r].score
+
+            # Follow the path back to the start, then reverse it.
+            j = paths.size
+            path = cell.paths[r]
+            while path.node >= 0 and status == 0:
+                status |= _buffer_append(paths, path.node % m)
+                cell = self._kbest_cell(cells, v, e, n, path.node)
+                if cell == NULL:
+                    status = -1
+                    break
+
+                path = cell.paths[path.rank]
+
+            status |= _buffer_append(paths, -1)
+            if status != 0:
+                break
+
+            for i in range((<int> paths.size - 1 - j) / 2):
+                paths.data[j+i], paths.data[<int> paths.size-2-i] = \
+                    paths.data[<int> paths.size-2-i], paths.data[j+i]
+
+            n_paths += 1
+
+        k[0] = n_paths
+
+        for i in range(n_cells):
+            if cells[i] != NULL:
+                free(cells[i].paths)
+                free(cells[i].heap)
+                free(cells[i])
+
+        free(cells)
+        free(stack.data)
+        free(v)
+        free(e)
+        return status
+
+    cdef KBestCell* _kbest_cell(self, KBestCell** cells, double* v, double* e,
+        int n, int c) nogil:
+        """Return cell c, creating it the first time with its best path and
+        the candidates for its second best, which are the best paths into
+        each of its other predecessors. Returns NULL if memory ran out."""
+
+        cdef int i, k, ki, l, u, m = self.n_states, p = self.silent_start
+        cdef int* in_edges = self.in_edge_count
+        cdef double weight
+        cdef KBestCell* cell = cells[c]
+        cdef KBestPath path
+
+        if cell != NULL:
+            return cell
+
+        cell = <KBestCell*> calloc(1, sizeof(KBestCell))
+        if cell == NULL:
+            return NULL
+
+        cells[c] = cell
+        i, l = c / m, c % m
+
+        if c == self.start_index:
+            path.score, path.weight, path.node, path.rank = 0, 0, -1, 0
+            cell.exhausted = 1
+            if _kbest_append(&cell.paths, &cell.n_paths, &cell.paths_capacity,
+                path) != 0:
+                return NULL
+            return cell
+
+        # The predecessors of each cell are those the Viterbi recurrence
+        # takes the maximum over.
+        if i == n + 1:
+            for ki in range(m):
+                if self.finite == 1 and ki != self.end_index:
+                    continue
+
+                u = n*m + ki
+                path.score, path.weight, path.node, path.rank = v[u], 0, u, 0
+                if v[u] > NEGINF and _kbest_push(cell, path) != 0:
+                    return NULL
+        else:
+            for k in range(in_edges[l], in_edges[l+1]):
+                ki = self.in_transitions[k]
+                weight = self.in_transition_log_probabilities[k]
+
+                if l < p:
+                    if i == 0:
+                        continue
+                    u = (i-1)*m + ki
+                    weight += e[i-1 + l*n]
+                elif ki < p or ki < l:
+                    u = i*m + ki
+                else:
+                    continue
+
+                path.score, path.weight, path.node, path.rank = v[u] + weight, \
+                    weight, u, 0
+                if v[u] > NEGINF and _kbest_push(cell, path) != 0:
+                    return NULL
+
+        if cell.heap_size == 0:
+            cell.exhausted = 1
+        elif _kbest_append(&cell.paths, &cell.n_paths, &cell.paths_capacity,
+            _kbest_pop(cell)) != 0:
+            return NULL
+
+        return cell
+
+    cdef int _kbest_next(self, KBestCell** cells, double* v, double* e, int n,
+        int c, int r, IntBuffer* stack) nogil:
+        """Find the r-th best path into cell c, if there is one, given that
+        the paths before it have been found. The r-th best path follows
+        the same edge as one of the candidates, or as the (r-1)-th best path
+        but continuing the next best path into its predecessor, which is
+        found first using the stack rather than by recursion. Returns -1 if
+        memory ran out."""
+
+        cdef int u, j, top
+        cdef KBestCell* cell
+        cdef KBestCell* previous
+        cdef KBestPath path
+
+        stack.size = 0
+        if _buffer_append(stack, c) != 0 or _buffer_append(stack, r) != 0:
+            return -1
+
+        while stack.size > 0:
+            top = stack.size - 2
+            c, r = stack.data[top], stack.data[top+1]
+
+            cell = self._kbest_cell(cells, v, e, n, c)
+            if cell == NULL:
+                return -1
+
+            if cell.n_paths > r or cell.exhausted:
+                stack.size -= 2
+                continue
+
+            path = cell.paths[r-1]
+            u, j = path.node, path.rank + 1
+
+            if u >= 0:
+                previous = self._kbest_cell(cells, v, e, n, u)
+                if previous == NULL:
+                    return -1
+
+                if previous.n_paths <= j and not previous.exhausted:
+                    if _buffer_append(stack, u) != 0 or \
+                        _buffer_append(stack, j) != 0:
+                        return -1
+                    continue
+
+                if previous.n_paths > j:
+                    path.score = previous.paths[j].score + path.weight
+                    path.rank = j
+                    if _kbest_push(cell, path) != 0:
+                        return -1
+
+            if cell.heap_size == 0:
+                cell.exhausted = 1
+            elif _kbest_append(&cell.paths, &cell.n_paths, 
+                &cell.paths_capacity, _kbest_pop(cell)) != 0:
+                return -1
+
+            stack.size -= 2
+
+        return 0
+
+    cdef tuple _scan(self, numpy.ndarray sequence_ndarray,
+        numpy.ndarray e_ndarray, int n, int n_jobs, int algorithm, bint full):
+        """Run the forward, backward or Viterbi recurrence over a single
+        sequence in parallel-in-time using n_jobs threads.
+
+        The sequence is split into one chunk per thread. Each row of the
+        recurrence is linear, in the log-sum-exp or max-plus semiring, in the
+        non-silent states of the row before it, so each chunk is first
+        summarized by the rows it produces when started from each non-silent
+        state alone. These transfer matrices are then applied in order to get
+        the row at each chunk boundary, and finally, if full is True, the rows
+        inside each chunk are filled in from their true boundary rows. The
+        chunk which touches the start of the recurrence is computed directly.
+
+        Returns the (n+1)*m matrix of rows, the Viterbi traceback if the
+        algorithm is Viterbi, and the emission table, which is calculated if
+        e_ndarray is None.
+        """
+
+        cdef int c, m = self.n_states, p = self.silent_start
+        cdef int n_chunks = max(1, min(n_jobs, n))
+        cdef bint emissions = e_ndarray is None
+        cdef list bounds = [int(c*n/n_chunks) for c in range(n_chunks+1)]
+
+        if emissions:
+            e_ndarray = numpy.empty(n*p, dtype=numpy.float64)
+
+        cdef numpy.ndarray x_ndarray = numpy.empty((n+1)*m, dtype=numpy.float64)
+        cdef numpy.ndarray t_ndarray = numpy.empty((n_chunks, p, m), dtype=numpy.float64)
+        cdef numpy.ndarray tb_ndarray = numpy.empty((n+1)*m if algorithm == 2
+            else 0, dtype=numpy.int32)
+
+        cdef numpy.ndarray bounds_ndarray = numpy.array(bounds, dtype=numpy.int32)
+        cdef int* r = <int*> bounds_ndarray.data
+        cdef double* x = <double*> x_ndarray.data
+        cdef double* t = <double*> t_ndarray.data
+
+        with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+            parallel([delayed(self._scan_transfer, check_pickle=False)(
+                sequence_ndarray, e_ndarray, x_ndarray, t_ndarray[c],
+                tb_ndarray, n, bounds[c], bounds[c+1], algorithm, emissions)
+                for c in range(n_chunks)])
+
+            with nogil:
+                if algorithm == 1:
+                    for c in range(n_chunks-2, -1, -1):
+                        self._scan_combine(x + r[c+1]*m, t + c*p*m,
+                            x + r[c]*m, 0)
+                else:
+                    for c in range(1, n_chunks):
+                        self._scan_combine(x + r[c]*m, t + c*p*m,
+                            x + r[c+1]*m, algorithm == 2)
+
+            if full and n_chunks > 1:
+                if algorithm == 1:
+                    chunks = range(n_chunks-1)
+                else:
+                    chunks = range(1, n_chunks)
+
+                parallel([delayed(self._scan_fill, check_pickle=False)(
+                    e_ndarray, x_ndarray, tb_ndarray, n, bounds[c],
+                    bounds[c+1], algorithm) for c in chunks])
+
+        return x_ndarray, tb_ndarray, e_ndarray
+
+    def _scan_transfer(self, numpy.ndarray sequence_ndarray,
+        numpy.ndarray e_ndarray, numpy.ndarray x_ndarray,
+        numpy.ndarray t_ndarray, numpy.ndarray tb_ndarray, int n, int start,
+        int end, int algorithm, bint emissions):
+        """Summarize the chunk of observations from start to end for a
+        parallel-in-time scan, without the GIL.
+
+        The algorithm is 0 for forward, 1 for backward and 2 for Viterbi. If
+        emissions is True the emission table for the chunk is calculated
+        first. The chunk touching the start of the recurrence fills in its
+        rows of x directly, and every other chunk fills in its transfer
+        matrix t instead.
+        """
+
+        cdef int i, k, l, m = self.n_states, p = self.silent_start
+        cdef int dim = self.d
+        cdef void** distributions = self.distributions_ptr
+        cdef double* sequence = <double*> sequence_ndarray.data
+        cdef double* e = <double*> e_ndarray.data
+        cdef double* x = <double*> x_ndarray.data
+        cdef double* t = <double*> t_ndarray.data
+        cdef int* tb = <int*> tb_ndarray.data
+        cdef double* rows
+        cdef double* xp
+        cdef double* xc
+        cdef double* tmp
+
+        with nogil:
+            if emissions:
+                self._emissions(sequence+start*dim, e+start, end-start, 1, n)
+
+            if algorithm == 0 and start == 0:
+                self._forward_initial(x)
+                for i in range(end):
+                    self._forward_step(x + i*m, x + (i+1)*m, e + i, n)
+
+            elif algorithm == 1 and end == n:
+                self._backward_initial(x + n*m)
+                for i in range(n-1, start-1, -1):
+                    self._backward_step(x + i*m, x + (i+1)*m, e + i, n)
+
+            elif algorithm == 2 and start == 0:
+                self._viterbi_initial(x, tb)
+                for i in range(end):
+                    self._viterbi_step(x + i*m, x + (i+1)*m, e + i, n,
+                        tb + (i+1)*m)
+
+            else:
+                rows = <double*> calloc(2*m, sizeof(double))
+
+                for k in range(p):
+                    xp = rows
+                    xc = rows + m
+                    for l in range(m):
+                        xp[l] = NEGINF
+                    xp[k] = 0
+
+                    if algorithm == 0:
+                        self._forward_silent(xp)
+                        for i in range(start, end):
+                            self._forward_step(xp, xc, e + i, n)
+                            tmp = xp; xp = xc; xc = tmp
+
+                    elif algorithm == 1:
+                        for i in range(end-1, start-1, -1):
+                            self._backward_step(xc, xp, e + i, n)
+                            tmp = xp; xp = xc; xc = tmp
+
+                    else:
+                        self._viterbi_silent(xp, NULL)
+                        for i in range(start, end):
+                            self._viterbi_step(xp, xc, e + i, n, NULL)
+                            tmp = xp; xp = xc; xc = tmp
 
-        # Otherwise, do the traceback
-        # This holds the path, which we construct in reverse order
-        cdef int px = n, py = end_index, npx
-        cdef int length = 0
+                    memcpy(t + k*m, xp, m*sizeof(double))
 
-        while px != 0 or py != self.start_index:
-            # Until we've traced back to the start...
-            # Put the position in the path, making sure to look up the state
-            # object to use instead of the state index.
-            path[length] = py
-            length += 1
+                free(rows)
 
-            # Go backwards
-            npx = tracebackx[px*m + py]
-            py = tracebacky[px*m + py]
-            px = npx
+    def _scan_fill(self, numpy.ndarray e_ndarray, numpy.ndarray x_ndarray,
+        numpy.ndarray tb_ndarray, int n, int start, int end, int algorithm):
+        """Fill in the rows strictly inside a chunk of a parallel-in-time
+        scan from its boundary row, without the GIL. For Viterbi, the
+        traceback of the last row of the chunk is also filled in."""
 
-        # We've now reached the start (if we didn't raise an exception because
-        # we messed up the traceback)
-        # Record that we start at the start
-        path[length] = py
+        cdef int i, m = self.n_states
+        cdef double* e = <double*> e_ndarray.data
+        cdef double* x = <double*> x_ndarray.data
+        cdef int* tb = <int*> tb_ndarray.data
+        cdef double* row
 
-        for i in range((length + 1) / 2):
-            path[i], path[length-i] = path[length-i], path[i] 
+        with nogil:
+            if algorithm == 0:
+                for i in range(start, end-1):
+                    self._forward_step(x + i*m, x + (i+1)*m, e + i, n)
 
-        free(tracebackx)
-        free(tracebacky)
-        free(v)
-        free(e)
-        return log_probability
+            elif algorithm == 1:
+                for i in range(end-1, start, -1):
+                    self._backward_step(x + i*m, x + (i+1)*m, e + i, n)
+
+            else:
+                for i in range(start, end-1):
+                    self._viterbi_step(x + i*m, x + (i+1)*m, e + i, n,
+                        tb + (i+1)*m)
+
+                # The boundary row itself was already found from the transfer
+                # matrices, so only its traceback is kept.
+                row = <double*> calloc(m, sizeof(double))
+                self._viterbi_step(x + (end-1)*m, row, e + end-1, n,
+                    tb + end*m)
+                free(row)
+
+    cdef void _scan_combine(self, double* x, double* t, double* y,
+        bint viterbi) nogil:
+        """Calculate the row y by applying the transfer matrix t to the
+        non-silent states of the row x, in the max-plus semiring if viterbi
+        is True and in the log-sum-exp semiring otherwise."""
+
+        cdef int k, l, m = self.n_states, p = self.silent_start
+        cdef double score, log_probability
+
+        for l in range(m):
+            log_probability = NEGINF
+            for k in range(p):
+                score = x[k] + t[k*m + l]
+                if viterbi:
+                    if score > log_probability:
+                        log_probability = score
+                else:
+                    log_probability = pair_lse(log_probability, score)
 
-    def predict_proba(self, sequence):
+            y[l] = log_probability
+
+    def predict_proba(self, sequence, memory_budget=None, top_k=None, 
+        threshold=None):
         """Calculate the state probabilities for each observation in the sequence.
 
         Run the forward-backward algorithm on the sequence and return the emission
@@ -2157,8 +5628,34 @@ cdef class HiddenMarkovModel(GraphModel):
 
         Parameters
         ----------
-        sequence : array-like
-            An array (or list) of observations.
+        sequence : array-like or RaggedSequences
+            An array (or list) of observations. If a RaggedSequences
+            collection is given, a list with the result for each sequence in
+            it is returned.
+
+        memory_budget : int or None, optional
+            The maximum number of bytes to use for the dynamic programming
+            matrices of a single sequence. If the full forward, backward and
+            emission matrices would exceed this, a checkpointed version of the
+            algorithm is used which stores only every k-th row of the forward
+            matrix and recomputes the rows in between during the backward
+            pass, using O(sqrt(n)) memory at the cost of a second forward
+            pass. If None, the full matrices are always used. Default is None.
+
+        top_k : int or None, optional
+            If given, only the top_k most likely states of each observation
+            are kept as the posteriors are calculated, and a tuple of the
+            indices of those states and their probabilities, each of shape
+            (len(sequence), top_k) and in descending order of probability, is
+            returned instead of the full matrix. Rows are padded with a state
+            of -1 if fewer than top_k states are possible. Default is None.
+
+        threshold : double or None, optional
+            If given, only the probabilities of at least this value are kept
+            as they are calculated, and a scipy.sparse.csr_matrix of shape
+            (len(sequence), n_nonsilent_states) holding them is returned
+            instead of the full matrix. Cannot be used with top_k. Default
+            is None.
 
         Returns
         -------
@@ -2169,9 +5666,27 @@ cdef class HiddenMarkovModel(GraphModel):
         if self.d == 0:
             raise ValueError("must bake model before prediction")
 
-        return numpy.exp(self.predict_log_proba(sequence))
+        if isinstance(sequence, RaggedSequences):
+            return [self.predict_proba(sequence_view, memory_budget, top_k,
+                threshold) for sequence_view in sequence.encode(self)]
+
+        if top_k is not None and threshold is not None:
+            raise ValueError("only one of top_k and threshold can be given")
+
+        if threshold is not None:
+            r = self._sparse_posteriors(sequence, memory_budget, None, 
+                threshold)
+            r.data = numpy.exp(r.data)
+            return r
 
-    def predict_log_proba(self, sequence):
+        if top_k is not None:
+            states, r = self._sparse_posteriors(sequence, memory_budget, top_k,
+                None)
+            return states, numpy.exp(r)
+
+        return numpy.exp(self.predict_log_proba(sequence, memory_budget))
+
+    def predict_log_proba(self, sequence, memory_budget=None, top_k=None):
         """Calculate the state log probabilities for each observation in the sequence.
 
         Run the forward-backward algorithm on the sequence and return the emission
@@ -2188,8 +5703,27 @@ cdef class HiddenMarkovModel(GraphModel):
 
         Parameters
         ----------
-        sequence : array-like
-            An array (or list) of observations.
+        sequence : array-like or RaggedSequences
+            An array (or list) of observations. If a RaggedSequences
+            collection is given, a list with the result for each sequence in
+            it is returned.
+
+        memory_budget : int or None, optional
+            The maximum number of bytes to use for the dynamic programming
+            matrices of a single sequence. If the full forward, backward and
+            emission matrices would exceed this, a checkpointed version of the
+            algorithm is used which stores only every k-th row of the forward
+            matrix and recomputes the rows in between during the backward
+            pass, using O(sqrt(n)) memory at the cost of a second forward
+            pass. If None, the full matrices are always used. Default is None.
+
+        top_k : int or None, optional
+            If given, only the top_k most likely states of each observation
+            are kept as the posteriors are calculated, and a tuple of the
+            indices of those states and their log probabilities, each of
+            shape (len(sequence), top_k) and in descending order, is returned
+            instead of the full matrix. Rows are padded with a state of -1 if
+            fewer than top_k states are possible. Default is None.
 
         Returns
         -------
@@ -2200,43 +5734,138 @@ cdef class HiddenMarkovModel(GraphModel):
         if self.d == 0:
             raise ValueError("must bake model before prediction")
 
+        if isinstance(sequence, RaggedSequences):
+            return [self.predict_log_proba(sequence_view, memory_budget, top_k)
+                for sequence_view in sequence.encode(self)]
+
+        if top_k is not None:
+            return self._sparse_posteriors(sequence, memory_budget, top_k, None)
+
         cdef int n = len(sequence), m = len(self.states)
         cdef int mv = self.multivariate
         cdef numpy.ndarray sequence_ndarray
         cdef numpy.ndarray r_ndarray = numpy.zeros((n, self.silent_start), dtype='float64')
         cdef double* sequence_data
         cdef double* r = <double*> r_ndarray.data
+        cdef double* transitions
+        cdef double log_sequence_probability
+        cdef ScratchArena* arena
+        cdef int checkpoint = self._checkpoint_interval(n, memory_budget)
 
         sequence_ndarray = _check_input(sequence, self)
         sequence_data = <double*> sequence_ndarray.data
 
-        with nogil:
-            self._predict_log_proba(sequence_data, r, n, NULL)
+        if checkpoint > 0:
+            transitions = <double*> calloc(self.n_edges, sizeof(double))
+            with nogil:
+                log_sequence_probability = self._checkpoint_forward_backward(
+                    sequence_data, n, checkpoint, transitions, r, NULL)
+
+            free(transitions)
+            if log_sequence_probability == NEGINF:
+                print("Warning: Sequence is impossible.")
+
+            return r_ndarray
+
+        arena = self._acquire_scratch()
+        try:
+            with nogil:
+                self._predict_log_proba(sequence_data, r, n, NULL, arena)
+        finally:
+            self._release_scratch(arena)
 
         return r_ndarray
 
+    def _sparse_posteriors(self, sequence, memory_budget, top_k, threshold):
+        """Calculate the posterior log probabilities of a sequence, keeping
+        either the top_k most likely states of each observation, returned as
+        a tuple of states and log probabilities, or those with a probability
+        of at least threshold, returned as a scipy.sparse.csr_matrix."""
+
+        cdef int n = len(sequence), p = self.silent_start
+        cdef numpy.ndarray sequence_ndarray = _check_input(sequence, self)
+        cdef numpy.ndarray states_ndarray, values_ndarray
+        cdef double* sequence_data = <double*> sequence_ndarray.data
+        cdef double* transitions
+        cdef double log_sequence_probability
+        cdef ScratchArena* arena
+        cdef PosteriorSink sink
+        cdef int checkpoint = self._checkpoint_interval(n, memory_budget)
+
+        memset(&sink, 0, sizeof(PosteriorSink))
+
+        if top_k is not None:
+            if top_k < 1:
+                raise ValueError("top_k must be at least 1")
+
+            sink.top_k = min(top_k, p)
+            states_ndarray = numpy.empty((n, sink.top_k), dtype='int32')
+            values_ndarray = numpy.empty((n, sink.top_k), dtype='float64')
+            sink.states = <int*> states_ndarray.data
+            sink.values = <double*> values_ndarray.data
+        else:
+            if threshold <= 0:
+                raise ValueError("threshold must be positive")
+
+            sink.log_threshold = _log(threshold)
+
+        if checkpoint > 0:
+            transitions = <double*> calloc(self.n_edges, sizeof(double))
+            with nogil:
+                log_sequence_probability = self._checkpoint_forward_backward(
+                    sequence_data, n, checkpoint, transitions, NULL, NULL, 
+                    &sink)
+
+            free(transitions)
+            if log_sequence_probability == NEGINF:
+                print("Warning: Sequence is impossible.")
+        else:
+            arena = self._acquire_scratch()
+            try:
+                with nogil:
+                    self._predict_log_proba(sequence_data, NULL, n, NULL, arena,
+                        &sink)
+            finally:
+                self._release_scratch(arena)
+
+        if sink.top_k > 0:
+            return states_ndarray, values_ndarray
+
+        rows = _buffer_array(&sink.rows)
+        columns = _buffer_array(&sink.columns)
+        entries = _double_buffer_array(&sink.entries)
+
+        if sink.status != 0:
+            raise MemoryError("ran out of memory while storing posteriors")
+
+        return scipy.sparse.csr_matrix((entries, (rows, columns)), 
+            shape=(n, p))
+
     cdef void _predict_log_proba(self, double* sequence, double* r, int n, 
-        double* emissions) nogil:
+        double* emissions, ScratchArena* arena=NULL, 
+        PosteriorSink* sink=NULL) nogil:
+        """Run the forward-backward algorithm on a sequence and write the
+        posterior log probability of each symbol under each non-silent state
+        to r or, if sink is not NULL, pass them to it one symbol at a time."""
+
         cdef int i, k, l, li
         cdef int m = self.n_states, dim = self.d
         cdef double log_sequence_probability
         cdef double* f
         cdef double* b
         cdef double* e
+        cdef double* posteriors
         cdef void** distributions = self.distributions_ptr
 
         if emissions is NULL:
-            e = <double*> calloc(n*self.silent_start, sizeof(double))
-            for l in range(self.silent_start):
-                for i in range(n):
-                    (<Model> distributions[l])._log_probability(sequence+i*dim, e+l*n+i, 1)
-                    e[l*n + i] += self.state_weights[l]
+            e = <double*> _scratch_alloc(arena, n*self.silent_start*sizeof(double))
+            self._emissions(sequence, e, n, 1, n)
         else:
             e = emissions
 
         # Fill in both the F and B DP matrices.
-        f = self._forward(sequence, n, emissions)
-        b = self._backward(sequence, n, emissions)
+        f = self._forward(sequence, n, e, arena)
+        b = self._backward(sequence, n, e, arena)
 
         # Find out the probability of the sequence
         if self.finite == 1:
@@ -2252,8 +5881,21 @@ cdef class HiddenMarkovModel(GraphModel):
             with gil:
                 print("Warning: Sequence is impossible.")
 
+        if sink is not NULL:
+            posteriors = <double*> _scratch_alloc(arena, 
+                self.silent_start*sizeof(double))
+
+            for i in range(n):
+                for k in range(self.silent_start):
+                    posteriors[k] = f[(i+1)*m + k] + b[(i+1)*m + k] - \
+                        log_sequence_probability
+
+                _sink_posteriors(sink, i, posteriors, self.silent_start)
+
+            _scratch_free(arena, posteriors)
+
         for k in range(m):
-            if k < self.silent_start:
+            if r is not NULL and k < self.silent_start:
                 for i in range(n):
                     # For each symbol that came out
                     # What's the weight of this symbol for that state?
@@ -2268,11 +5910,12 @@ cdef class HiddenMarkovModel(GraphModel):
                     r[i*self.silent_start + k] = f[(i+1)*m + k] + b[(i+1)*m + k] - \
                         log_sequence_probability
 
-        free(f)
-        free(b)
-        free(e)
+        _scratch_free(arena, f)
+        _scratch_free(arena, b)
+        if emissions is NULL:
+            _scratch_free(arena, e)
 
-    def predict(self, sequence, algorithm='map'):
+    def predict(self, sequence, algorithm='map', beam=10.0, beam_size=None):
         """Calculate the most likely state for each observation.
 
         This can be either the Viterbi algorithm or maximum a posteriori. It
@@ -2283,12 +5926,22 @@ cdef class HiddenMarkovModel(GraphModel):
 
         Parameters
         ----------
-        sequence : array-like
-            An array (or list) of observations.
+        sequence : array-like or RaggedSequences
+            An array (or list) of observations. If a RaggedSequences
+            collection is given, a list with the result for each sequence in
+            it is returned.
 
-        algorithm : "map", "viterbi"
+        algorithm : "map", "viterbi", "beam"
             The algorithm with which to decode the sequence
 
+        beam : double, optional
+            The log probability threshold used for beam decoding. Only used if
+            algorithm is 'beam'. Default is 10.
+
+        beam_size : int or None, optional
+            The maximum number of states kept at each observation during beam
+            decoding. Only used if algorithm is 'beam'. Default is None.
+
         Returns
         -------
         path : list of integers
@@ -2298,8 +5951,15 @@ cdef class HiddenMarkovModel(GraphModel):
         if self.d == 0:
             raise ValueError("must bake model before prediction")
 
+        if isinstance(sequence, RaggedSequences):
+            return [self.predict(sequence_view, algorithm, beam, beam_size)
+                for sequence_view in sequence.encode(self)]
+
         if algorithm == 'map':
             return [state_id for state_id, state in self.maximum_a_posteriori(sequence)[1]]
+        elif algorithm == 'beam':
+            return [state_id for state_id, state in self.viterbi(sequence, 
+                beam, beam_size)[1]]
         return [state_id for state_id, state in self.viterbi(sequence)[1]]
 
     def maximum_a_posteriori(self, sequence):
@@ -2331,7 +5991,7 @@ cdef class HiddenMarkovModel(GraphModel):
         if self.d == 0:
             raise ValueError("must bake model before using MAP decoding")
 
-        return self._maximum_a_posteriori(numpy.array(sequence))
+        return self._maximum_a_posteriori(numpy.asanyarray(sequence))
 
 
     cdef tuple _maximum_a_posteriori(self, numpy.ndarray sequence):
@@ -2368,7 +6028,8 @@ cdef class HiddenMarkovModel(GraphModel):
         pseudocount=None, transition_pseudocount=0, emission_pseudocount=0.0, 
         use_pseudocount=False, inertia=None, edge_inertia=0.0, 
         distribution_inertia=0.0, batch_size=None, batches_per_epoch=None, 
-        lr_decay=0.0, verbose=False, n_jobs=1):
+        lr_decay=0.0, verbose=False, n_jobs=1, memory_budget=None,
+        backend='threading'):
         """Fit the model to data using either Baum-Welch, Viterbi, or supervised training.
 
         Given a list of sequences, performs re-estimation on the model
@@ -2386,7 +6047,17 @@ cdef class HiddenMarkovModel(GraphModel):
             An array of some sort (list, numpy.ndarray, tuple..) of sequences,
             where each sequence is a numpy array, which is 1 dimensional if
             the HMM is a one dimensional array, or multidimensional if the HMM
-            supports multiple dimensions.
+            supports multiple dimensions A RaggedSequences
+            collection can also be given, in which case the sequences are
+            used as views into its buffer rather than being copied.
+            Alternatively, a SequenceShards collection or any other iterable
+            without indexing, such as a generator, that yields batches of
+            sequences can be given. The batches are then loaded on a
+            background thread and streamed through at each iteration, so that
+            only a few batches are held in memory at once. A one-shot
+            iterator is only passed over once, so training stops when it is
+            exhausted. Weights, labels and the multiprocessing backend cannot
+            be used with a stream.
 
         weights : array-like or None, optional
             An array of weights, one for each sequence to train on. If None,
@@ -2463,7 +6134,9 @@ cdef class HiddenMarkovModel(GraphModel):
             the size of the set sent to `summarize` and so does not make the
             update any less exact. This is useful when training on a memory
             map and cannot load all the data into memory. If set to None,
-            batch_size is 1 / n_jobs. Default is None.
+            batch_size is 1 / n_jobs. When streaming, each batch from the
+            stream is split into batches of at most batch_size sequences, and
+            if None the batches are used as they are. Default is None.
 
         batches_per_epoch : int or None, optional
             The number of batches in an epoch. This is the number of batches to
@@ -2487,7 +6160,26 @@ cdef class HiddenMarkovModel(GraphModel):
 
         n_jobs : int, optional
             The number of threads to use when performing training. This
-            leads to exact updates. Default is 1.
+            leads to exact updates. Unless batch_size or batches_per_epoch
+            are given, the sequences are split between threads by their total
+            length rather than by their number. Default is 1.
+
+        memory_budget : int or None, optional
+            The maximum number of bytes to use for the dynamic programming
+            matrices of a single sequence in Baum-Welch training. Sequences
+            whose full forward, backward and emission matrices would exceed
+            this are summarized using checkpointed forward-backward, which
+            uses O(sqrt(n)) memory. If None, the full matrices are always
+            used. Default is None.
+
+        backend : 'threading' or 'multiprocessing', optional
+            How to parallelize training when n_jobs is above one. With
+            'multiprocessing' the sequences are written to a temporary file
+            which each of n_jobs processes memory-maps, each process keeps
+            its own copy of the model, and only the parameters and the
+            sufficient statistics are sent between processes at each
+            iteration. Labeled training is only supported with 'threading'.
+            Default is 'threading'.
 
         Returns
         -------
@@ -2498,6 +6190,21 @@ cdef class HiddenMarkovModel(GraphModel):
         if self.d == 0:
             raise ValueError("must bake model before fitting")
 
+        if backend not in ('threading', 'multiprocessing'):
+            raise ValueError("backend must be 'threading' or 'multiprocessing'")
+
+        if backend == 'multiprocessing' and labels is not None:
+            raise ValueError("labeled training requires the threading backend")
+
+        streaming = _is_stream(sequences)
+        if streaming:
+            if weights is not None or labels is not None:
+                raise ValueError("weights and labels cannot be used when "
+                    "streaming batches of sequences")
+            if backend == 'multiprocessing':
+                raise ValueError("streaming batches of sequences requires the "
+                    "threading backend")
+
         cdef int iteration = 0
         cdef int mv = self.multivariate
         cdef double improvement = INF
@@ -2507,13 +6214,15 @@ cdef class HiddenMarkovModel(GraphModel):
         cdef double last_log_probability_sum
         cdef str alg = algorithm.lower()
         cdef bint check_input = alg == 'viterbi'
-        cdef list X = []
+        cdef list X
 
         training_start_time = time.time()
 
-        for sequence in sequences:
-            sequence_ndarray = _check_input(sequence, self)
-            X.append(sequence_ndarray)
+        if streaming:
+            X = []
+            stream = _stream_batches(sequences, self, batch_size)
+        else:
+            X = _check_sequences(sequences, self)
 
         if weights is None:
             weights = numpy.ones(len(X), dtype='float64')
@@ -2536,12 +6245,18 @@ cdef class HiddenMarkovModel(GraphModel):
 
             labels = numpy.array([numpy.array(label) for label in labels])
 
-        if semisupervised:
-            starts_labeled = [int(i*len(X_labeled)/n_jobs) for i in range(n_jobs)]
-            ends_labeled = [int(i*len(X_labeled)/n_jobs) for i in range(1, n_jobs+1)]
+        minibatching = batches_per_epoch is not None
 
-            starts_unlabeled = [int(i*len(X_unlabeled)/n_jobs) for i in range(n_jobs)]
-            ends_unlabeled = [int(i*len(X_unlabeled)/n_jobs) for i in range(1, n_jobs+1)]
+        if streaming:
+            batches = []
+        elif semisupervised:
+            batches_labeled = _balanced_batches([len(x) for x in X_labeled], 
+                n_jobs)
+            batches_unlabeled = _balanced_batches([len(x) for x in X_unlabeled], 
+                n_jobs)
+            batches = batches_unlabeled
+        elif batch_size is None and not minibatching:
+            batches = _balanced_batches([len(x) for x in X], n_jobs)
         else:
             if batch_size is None:
                 starts = [int(i*n/n_jobs) for i in range(n_jobs)]
@@ -2552,76 +6267,115 @@ cdef class HiddenMarkovModel(GraphModel):
                     starts = starts[:-1]
                 ends = list(range(batch_size, n, batch_size)) + [n]
 
-        minibatching = batches_per_epoch is not None
-        batches_per_epoch = batches_per_epoch or len(starts)
-        n_seen_batches = 0
-        epoch_starts, epoch_ends = None, None
-
-        with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
-            while improvement > stop_threshold or iteration < min_iterations + 1:
-                epoch_start_time = time.time()
+            batches = [numpy.arange(start, end) for start, end in zip(starts, ends)]
 
-                if inertia is None:
-                    step_size = None
-                else:
-                    step_size = 1 - ((1 - inertia) * (2 + iteration) ** -lr_decay) 
-                
-                self.from_summaries(step_size, pseudocount, transition_pseudocount,
-                    emission_pseudocount, use_pseudocount,
-                    edge_inertia, distribution_inertia)
+        batches_per_epoch = batches_per_epoch or len(batches)
+        n_seen_batches = 0
+        epoch_batches = None
 
-                if epoch_starts is not None and minibatching:
-                    updated_log_probability_sum = sum(self.log_probability(X[i]) 
-                        for i in range(epoch_starts[0], epoch_ends[-1]))
-                    improvement = updated_log_probability_sum - log_probability_sum
+        pool, directory = None, None
+        if backend == 'multiprocessing' and n_jobs > 1:
+            directory = tempfile.mkdtemp()
+            packed = RaggedSequences.from_sequences(X)
+            packed.keymap = self.keymap if self.discrete else None
+            packed.save(os.path.join(directory, 'sequences'))
 
-                epoch_starts = starts[n_seen_batches:n_seen_batches+batches_per_epoch]
-                epoch_ends = ends[n_seen_batches:n_seen_batches+batches_per_epoch]
+            pool = multiprocessing.Pool(n_jobs, _init_training_worker,
+                (self, directory, self._out_transitions()))
 
-                n_seen_batches += batches_per_epoch
-                if n_seen_batches >= len(starts):
-                    n_seen_batches = 0
+        try:
+            with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+                while improvement > stop_threshold or iteration < min_iterations + 1:
+                    epoch_start_time = time.time()
 
-                if iteration >= max_iterations + 1:
-                    break
+                    if inertia is None:
+                        step_size = None
+                    else:
+                        step_size = 1 - ((1 - inertia) * (2 + iteration) ** -lr_decay) 
+                
+                    self.from_summaries(step_size, pseudocount, transition_pseudocount,
+                        emission_pseudocount, use_pseudocount,
+                        edge_inertia, distribution_inertia)
+
+                    if epoch_batches is not None and minibatching:
+                        if streaming:
+                            updated_log_probability_sum = sum(self.log_probability(x,
+                                check_input=False) for batch in epoch_batches for x in batch)
+                        else:
+                            updated_log_probability_sum = sum(self.log_probability(X[i],
+                                check_input=False) for batch in epoch_batches for i in batch)
+                        improvement = updated_log_probability_sum - log_probability_sum
+
+                    if not streaming:
+                        epoch_batches = batches[n_seen_batches:n_seen_batches+batches_per_epoch]
+
+                        n_seen_batches += batches_per_epoch
+                        if n_seen_batches >= len(batches):
+                            n_seen_batches = 0
+
+                    if iteration >= max_iterations + 1:
+                        break
 
-                if semisupervised:
-                    log_probability_sum = sum(parallel(delayed(self.summarize, 
-                        check_pickle=False)(X_labeled[start:end], 
-                        weights_labeled[start:end], labels[start:end], 
-                        algorithm='labeled', check_input=False) 
-                        for start, end in zip(starts_labeled, ends_labeled)))
-
-                    log_probability_sum += sum(parallel(delayed(self.summarize, 
-                        check_pickle=False)(X_unlabeled[start:end], 
-                        weights_unlabeled[start:end], algorithm=algorithm, 
-                        check_input=False) 
-                        for start, end in zip(starts_unlabeled, ends_unlabeled)))
-
-                elif labels is not None:
-                    log_probability_sum = sum(parallel(delayed(self.summarize, check_pickle=False)(X[start:end], 
-                        weights[start:end], labels[start:end], alg, False) 
-                        for start, end in zip(epoch_starts, epoch_ends)))
-                else:
-                    log_probability_sum = sum(parallel(delayed(self.summarize, check_pickle=False)(X[start:end], 
-                        weights[start:end], None, alg, False) 
-                        for start, end in zip(epoch_starts, epoch_ends)))
+                    if streaming:
+                        epoch_log_probability_sum, epoch_batches = self._summarize_stream(
+                            stream, parallel, n_jobs, batches_per_epoch if minibatching 
+                            else None, alg, memory_budget)
+
+                        if epoch_log_probability_sum is None:
+                            if iteration == 0:
+                                raise ValueError("no sequences to train on")
+                            break
+
+                        log_probability_sum = epoch_log_probability_sum
+                    elif semisupervised:
+                        log_probability_sum = sum(parallel(delayed(self.summarize, 
+                            check_pickle=False)([X_labeled[i] for i in batch], 
+                            weights_labeled[batch], labels[batch], 
+                            algorithm='labeled', check_input=False) 
+                            for batch in batches_labeled))
+
+                        log_probability_sum += sum(parallel(delayed(self.summarize, 
+                            check_pickle=False)([X_unlabeled[i] for i in batch], 
+                            weights_unlabeled[batch], algorithm=algorithm, 
+                            check_input=False, memory_budget=memory_budget) 
+                            for batch in batches_unlabeled))
+
+                    elif labels is not None:
+                        log_probability_sum = sum(parallel(delayed(self.summarize, check_pickle=False)([X[i] for i in batch], 
+                            weights[batch], labels[batch], alg, False) 
+                            for batch in epoch_batches))
+                    elif pool is not None:
+                        log_probability_sum = self._summarize_processes(pool,
+                            directory, iteration, epoch_batches, weights, alg, 
+                            memory_budget)
+                    else:
+                        log_probability_sum = sum(parallel(delayed(self.summarize, check_pickle=False)([X[i] for i in batch], 
+                            weights[batch], None, alg, False, memory_budget) 
+                            for batch in epoch_batches))
 
-                if iteration == 0:
-                    initial_log_probability_sum = log_probability_sum
-                else:
-                    time_spent = time.time() - epoch_start_time
-                    if not minibatching:
-                        improvement = log_probability_sum - last_log_probability_sum
+                    if iteration == 0:
+                        initial_log_probability_sum = log_probability_sum
+                    else:
+                        time_spent = time.time() - epoch_start_time
+                        if not minibatching:
+                            improvement = log_probability_sum - last_log_probability_sum
                     
-                    if verbose:
-                        print("[{}] Improvement: {}\tTime (s): {:.4}".format(
-                            iteration, improvement, time_spent))
+                        if verbose:
+                            print("[{}] Improvement: {}\tTime (s): {:.4}".format(
+                                iteration, improvement, time_spent))
+
+                        total_improvement += improvement
 
-                    total_improvement += improvement
+                    iteration += 1
+                    last_log_probability_sum = log_probability_sum
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+                shutil.rmtree(directory)
+            if streaming:
+                stream.close()
 
-                iteration += 1
-                last_log_probability_sum = log_probability_sum
 
         self.clear_summaries()
 
@@ -2639,7 +6393,7 @@ cdef class HiddenMarkovModel(GraphModel):
         return log_probability_sum - initial_log_probability_sum
 
     def summarize(self, sequences, weights=None, labels=None, algorithm='baum-welch', 
-        check_input=True):
+        check_input=True, memory_budget=None):
         """Summarize data into stored sufficient statistics for out-of-core
         training. Only implemented for Baum-Welch training since Viterbi
         is less memory intensive.
@@ -2650,7 +6404,9 @@ cdef class HiddenMarkovModel(GraphModel):
             An array of some sort (list, numpy.ndarray, tuple..) of sequences,
             where each sequence is a numpy array, which is 1 dimensional if
             the HMM is a one dimensional array, or multidimensional if the HMM
-            supports multiple dimensions.
+            supports multiple dimensions A RaggedSequences
+            collection can also be given, in which case the sequences are
+            used as views into its buffer rather than being copied.
 
         weights : array-like or None, optional
             An array of weights, one for each sequence to train on. If None,
@@ -2670,71 +6426,413 @@ cdef class HiddenMarkovModel(GraphModel):
             Default is 'baum-welch'. Labeled training requires that labels
             are provided for each observation in each sequence.
 
-        check_input : bool, optional
-            Check the input. This casts the input sequences as numpy arrays,
-            and converts non-numeric inputs into numeric inputs for faster
-            processing later. Default is True.
+        check_input : bool, optional
+            Check the input. This casts the input sequences as numpy arrays,
+            and converts non-numeric inputs into numeric inputs for faster
+            processing later. Default is True.
+
+        memory_budget : int or None, optional
+            The maximum number of bytes to use for the dynamic programming
+            matrices of a single sequence in Baum-Welch summarization. Longer
+            sequences are summarized using checkpointed forward-backward,
+            which uses O(sqrt(n)) memory. Default is None.
+
+        Returns
+        -------
+        logp : double
+            The log probability of the sequences.
+        """
+
+        cdef int mv = self.multivariate
+        cdef list X = []
+
+        if self.d == 0:
+            raise ValueError("must bake model before summarizing data")
+
+        if check_input:
+            if weights is None:
+                weights_ndarray = numpy.ones(len(sequences), dtype='float64')
+            else:
+                weights_ndarray = numpy.array(weights, dtype='float64')
+        
+            if labels is not None:
+                labels = numpy.array(labels)
+
+            X = _check_sequences(sequences, self)
+
+            weights = weights_ndarray
+        else:
+            X = sequences
+
+        if algorithm == 'baum-welch':
+            log_probability_sum = 0
+
+            if memory_budget is not None:
+                checkpoints = [self._checkpoint_interval(len(sequence), 
+                    memory_budget) for sequence in X]
+
+                log_probability_sum = sum([self._baum_welch_summarize(sequence,
+                    weight, c) for sequence, weight, c in zip(X, weights, 
+                    checkpoints) if c > 0])
+
+                X = [sequence for sequence, c in zip(X, checkpoints) if c == 0]
+                weights = [weight for weight, c in zip(weights, checkpoints) if c == 0]
+
+            if len(X) > 1 and not self.dense and not self.scaled:
+                return log_probability_sum + self._baum_welch_summarize_batch(X, weights)
+
+            return log_probability_sum + sum([self._baum_welch_summarize(
+                sequence, weight) for sequence, weight in zip(X, weights)])
+        elif algorithm == 'viterbi':
+            return sum([self._viterbi_summarize(sequence, weight) 
+                for sequence, weight in zip(X, weights)])
+        elif algorithm == 'labeled':
+            return sum([self._labeled_summarize(sequence, label, weight) 
+                for sequence, label, weight in zip(X, labels, weights)])
+
+    cpdef double _baum_welch_summarize(self, numpy.ndarray sequence_ndarray, 
+        double weight, int checkpoint=0):
+        """Python wrapper for the summarization step.
+
+        This is done to ensure compatibility with joblib's multithreading
+        API. It just calls the cython update, but provides a Python wrapper
+        which joblib can easily wrap. If checkpoint is positive, use the
+        checkpointed forward-backward algorithm storing every checkpoint-th
+        row of the forward matrix.
+        """
+
+        cdef double* sequence = <double*> sequence_ndarray.data
+        cdef int n = sequence_ndarray.shape[0]
+        cdef double log_sequence_probability
+        cdef ScratchArena* arena = self._acquire_scratch()
+
+        try:
+            with nogil:
+                if checkpoint > 0:
+                    log_sequence_probability = self._summarize_checkpoint(
+                        sequence, &weight, n, checkpoint)
+                else:
+                    log_sequence_probability = self._summarize(sequence, 
+                        &weight, n, 0, self.d, arena)
+        finally:
+            self._release_scratch(arena)
+
+        return log_sequence_probability
+
+    cdef double _summarize_checkpoint(self, double* sequence, double* weight,
+        int n, int c) nogil:
+        """Collect sufficient statistics on a single sequence using the
+        checkpointed forward-backward algorithm."""
+
+        cdef int i
+        cdef double log_sequence_probability
+        cdef double* expected_transitions = <double*> calloc(self.n_edges, sizeof(double))
+
+        log_sequence_probability = self._checkpoint_forward_backward(sequence,
+            n, c, expected_transitions, NULL, weight)
+
+        if log_sequence_probability != NEGINF:
+            # Update the master expected transitions vector representing the sparse matrix.
+            with gil:
+                for i in range(self.n_edges):
+                    self.expected_transitions[i] += expected_transitions[i] * weight[0]
+
+        self.summaries += 1
+
+        free(expected_transitions)
+        return log_sequence_probability * weight[0]
+
+    cdef double _summarize(self, double* sequence, double* weight, int n,
+        int column_idx, int d, ScratchArena* arena=NULL) nogil:
+        """Collect sufficient statistics on a single sequence."""
+
+        cdef int i, l
+        cdef void** distributions = self.distributions_ptr
+        cdef double log_sequence_probability
+        cdef double* f
+        cdef double* b
+        cdef double* e
+
+        e = <double*> _scratch_alloc(arena, n*self.silent_start*sizeof(double))
+        self._emissions(sequence, e, n, 1, n)
+
+        if self.dense and n > 0:
+            log_sequence_probability = self._summarize_dense(sequence, weight,
+                n, e)
+            _scratch_free(arena, e)
+            return log_sequence_probability
+
+        if self.scaled and n > 0 and self._summarize_scaled(sequence, weight,
+            n, e, &log_sequence_probability):
+            _scratch_free(arena, e)
+            return log_sequence_probability
+
+        f = self._forward(sequence, n, e, arena)
+        b = self._backward(sequence, n, e, arena)
+
+        log_sequence_probability = self._summarize_tables(sequence, weight, n,
+            f, b, e, arena)
+
+        _scratch_free(arena, e)
+        _scratch_free(arena, f)
+        _scratch_free(arena, b)
+        return log_sequence_probability
+
+    cdef bint _summarize_scaled(self, double* sequence, double* weight, int n,
+        double* e, double* log_probability) nogil:
+        """Collect sufficient statistics on a single sequence using the scaled
+        kernels.
+
+        The posterior of each transition at each position is the product of
+        the scaled forward value, the transition probability, the scaled
+        emission and the scaled backward value, times a factor which depends
+        only on the position. Returns False without collecting anything if
+        the scaled kernels underflow.
+        """
+
+        cdef int i, j, k, l, li, m = self.n_states, p = self.silent_start
+        cdef int* out_edges = self.out_edge_count
+        cdef void** distributions = self.distributions_ptr
+        cdef double* probabilities = self.out_transition_probabilities
+        cdef double log_sequence_probability, probability
+        cdef bint success
+
+        cdef double* f = <double*> calloc((n+1)*m, sizeof(double))
+        cdef double* b = <double*> calloc((n+1)*m, sizeof(double))
+        cdef double* f_scale = <double*> calloc(n+1, sizeof(double))
+        cdef double* b_scale = <double*> calloc(n+1, sizeof(double))
+        cdef double* emission_max = <double*> calloc(n, sizeof(double))
+        cdef double* emission_factor = <double*> calloc(n, sizeof(double))
+        cdef double* silent_factor = <double*> calloc(n+1, sizeof(double))
+        cdef double* w = self._scaled_emissions(e, n, emission_max)
+        cdef double* expected_transitions
+        cdef double* weights
+
+        success = self._scaled_forward(w, emission_max, n, f, f_scale) and \
+            self._scaled_backward(w, emission_max, n, b, b_scale)
+
+        if success:
+            if self.finite == 1:
+                log_sequence_probability = _log(f[n*m + self.end_index]) + \
+                    f_scale[n]
+            else:
+                log_sequence_probability = f_scale[n]
+
+            success = log_sequence_probability != NEGINF
+
+        if success:
+            for i in range(n+1):
+                silent_factor[i] = cexp(f_scale[i] + b_scale[i] - 
+                    log_sequence_probability)
+                success = success and silent_factor[i] < INF
+
+                if i < n:
+                    emission_factor[i] = cexp(f_scale[i] + b_scale[i+1] + 
+                        emission_max[i] - log_sequence_probability)
+                    success = success and emission_factor[i] < INF
+
+        if success:
+            expected_transitions = <double*> calloc(self.n_edges, sizeof(double))
+            weights = <double*> calloc(n, sizeof(double))
+
+            for i in range(n+1):
+                for k in range(m):
+                    if f[i*m + k] == 0:
+                        continue
+
+                    for l in range(out_edges[k], out_edges[k+1]):
+                        li = self.out_transitions[l]
+
+                        if li >= p:
+                            probability = f[i*m + k] * silent_factor[i] * \
+                                probabilities[l] * b[i*m + li]
+                        elif i < n:
+                            probability = f[i*m + k] * emission_factor[i] * \
+                                probabilities[l] * w[i*p + li] * b[(i+1)*m + li]
+                        else:
+                            continue
+
+                        expected_transitions[l] += probability
+
+            for k in range(p):
+                if self._tied_representative(k) != k:
+                    continue
+
+                for i in range(n):
+                    weights[i] = f[(i+1)*m + k] * b[(i+1)*m + k] * \
+                        silent_factor[i+1] * weight[0]
+
+                for j in range(self.tied_state_count[k], 
+                    self.tied_state_count[k+1]):
+                    li = self.tied[j]
+                    for i in range(n):
+                        weights[i] += f[(i+1)*m + li] * b[(i+1)*m + li] * \
+                            silent_factor[i+1] * weight[0]
+
+                (<Model> distributions[k])._summarize(sequence, weights, n, 0, 
+                    self.d)
+
+            with gil:
+                for i in range(self.n_edges):
+                    self.expected_transitions[i] += expected_transitions[i] * weight[0]
+
+            self.summaries += 1
+            log_probability[0] = log_sequence_probability * weight[0]
+
+            free(expected_transitions)
+            free(weights)
+
+        free(f)
+        free(b)
+        free(f_scale)
+        free(b_scale)
+        free(emission_max)
+        free(emission_factor)
+        free(silent_factor)
+        free(w)
+        return success
+
+    cdef double _summarize_dense(self, double* sequence, double* weight, int n,
+        double* e) nogil:
+        """Collect sufficient statistics on a single sequence using the dense
+        kernels.
+
+        The expected number of transitions between each pair of non-silent
+        states is the product of the scaled forward values at each position
+        and the scaled backward values and emissions at the next position,
+        summed over positions, which is a single matrix multiplication.
+        """
+
+        cdef int i, j, k, l, li, p = self.silent_start, n_rows = n-1
+        cdef int* out_edges = self.out_edge_count
+        cdef void** distributions = self.distributions_ptr
+        cdef double log_sequence_probability, norm
+        cdef double one = 1, zero = 0
+
+        cdef double* alpha = <double*> calloc(n*p, sizeof(double))
+        cdef double* beta = <double*> calloc(n*p, sizeof(double))
+        cdef double* scale = <double*> calloc(n, sizeof(double))
+        cdef double* w = <double*> calloc(n*p, sizeof(double))
+        cdef double* transitions = <double*> calloc(p*p, sizeof(double))
+        cdef double* expected_transitions = <double*> calloc(self.n_edges, sizeof(double))
+        cdef double* weights = <double*> calloc(n, sizeof(double))
+
+        log_sequence_probability = self._dense_forward(e, n, alpha, scale)
+
+        if log_sequence_probability != NEGINF:
+            self._dense_backward(e, n, scale, beta)
+
+            # The probability of the sequence relative to the scales.
+            norm = 1.
+            if self.finite == 1:
+                norm = 0.
+                for l in range(p):
+                    norm += alpha[(n-1)*p + l] * self.dense_ends[l]
+
+            for i in range(1, n):
+                for l in range(p):
+                    w[(i-1)*p + l] = cexp(e[l*n + i] - scale[i]) * \
+                        beta[i*p + l]
+
+            if n_rows > 0:
+                dgemm('N', 'T', &p, &p, &n_rows, &one, w, &p, alpha, &p, &zero, 
+                    transitions, &p)
+
+            for k in range(self.n_states):
+                for l in range(out_edges[k], out_edges[k+1]):
+                    li = self.out_transitions[l]
+
+                    if k == self.start_index:
+                        expected_transitions[l] = alpha[li] * beta[li] / norm
+                    elif li == self.end_index:
+                        expected_transitions[l] = alpha[(n-1)*p + k] * \
+                            self.dense_ends[k] / norm
+                    else:
+                        expected_transitions[l] = transitions[k*p + li] * \
+                            self.dense_transitions[k*p + li] / norm
 
-        Returns
-        -------
-        logp : double
-            The log probability of the sequences.
-        """
+            for k in range(p):
+                if self._tied_representative(k) != k:
+                    continue
 
-        cdef int mv = self.multivariate
-        cdef list X = []
+                for i in range(n):
+                    weights[i] = alpha[i*p + k] * beta[i*p + k] / norm * weight[0]
 
-        if self.d == 0:
-            raise ValueError("must bake model before summarizing data")
+                for j in range(self.tied_state_count[k], 
+                    self.tied_state_count[k+1]):
+                    li = self.tied[j]
+                    for i in range(n):
+                        weights[i] += alpha[i*p + li] * beta[i*p + li] / norm * \
+                            weight[0]
 
-        if check_input:
-            if weights is None:
-                weights_ndarray = numpy.ones(len(sequences), dtype='float64')
-            else:
-                weights_ndarray = numpy.array(weights, dtype='float64')
-        
-            if labels is not None:
-                labels = numpy.array(labels)
+                (<Model> distributions[k])._summarize(sequence, weights, n, 0, 
+                    self.d)
 
-            for sequence in sequences:
-                sequence_ndarray = _check_input(sequence, self)
-                X.append(sequence_ndarray)
-        else:
-            X = sequences
+            with gil:
+                for i in range(self.n_edges):
+                    self.expected_transitions[i] += expected_transitions[i] * weight[0]
 
-        if algorithm == 'baum-welch':
-            return sum([self._baum_welch_summarize(sequence, weight) 
-                for sequence, weight in zip(X, weights)])
-        elif algorithm == 'viterbi':
-            return sum([self._viterbi_summarize(sequence, weight) 
-                for sequence, weight in zip(X, weights)])
-        elif algorithm == 'labeled':
-            return sum([self._labeled_summarize(sequence, label, weight) 
-                for sequence, label, weight in zip(X, labels, weights)])
+        self.summaries += 1
 
-    cpdef double _baum_welch_summarize(self, numpy.ndarray sequence_ndarray, double weight):
-        """Python wrapper for the summarization step.
+        free(alpha)
+        free(beta)
+        free(scale)
+        free(w)
+        free(transitions)
+        free(expected_transitions)
+        free(weights)
+        return log_sequence_probability * weight[0]
 
-        This is done to ensure compatibility with joblib's multithreading
-        API. It just calls the cython update, but provides a Python wrapper
-        which joblib can easily wrap.
+    cdef double _summarize_batch(self, double* X, double* weights, int* lengths,
+        int b, int n) nogil:
+        """Collect sufficient statistics on a padded batch of sequences.
+
+        The forward and backward matrices are calculated for the whole batch
+        at once and then unpacked one sequence at a time into the layout used
+        by `_summarize_tables`.
         """
 
-        cdef double* sequence = <double*> sequence_ndarray.data
-        cdef int n = sequence_ndarray.shape[0]
-        cdef double log_sequence_probability
+        cdef int i, j, l, n_j
+        cdef int p = self.silent_start, m = self.n_states, dim = self.d
+        cdef double log_probability_sum = 0
 
-        with nogil:
-            log_sequence_probability = self._summarize(sequence, &weight, n, 
-                0, self.d)
+        cdef double* e = self._batch_emissions(X, lengths, b, n)
+        cdef double* f = self._forward_batch(e, lengths, b, n)
+        cdef double* bw = self._backward_batch(e, lengths, b, n)
 
-        return log_sequence_probability
+        cdef double* e_j = <double*> calloc(n*p, sizeof(double))
+        cdef double* f_j = <double*> calloc((n+1)*m, sizeof(double))
+        cdef double* b_j = <double*> calloc((n+1)*m, sizeof(double))
 
-    cdef double _summarize(self, double* sequence, double* weight, int n,
-        int column_idx, int d) nogil:
-        """Collect sufficient statistics on a single sequence."""
+        for j in range(b):
+            n_j = lengths[j]
 
-        cdef int i, k, l, li
+            for i in range(n_j+1):
+                for l in range(m):
+                    f_j[i*m + l] = f[(i*m + l)*b + j]
+                    b_j[i*m + l] = bw[(i*m + l)*b + j]
+
+            for i in range(n_j):
+                for l in range(p):
+                    e_j[l*n_j + i] = e[(i*p + l)*b + j]
+
+            log_probability_sum += self._summarize_tables(X+j*n*dim, weights+j,
+                n_j, f_j, b_j, e_j)
+
+        free(e_j)
+        free(f_j)
+        free(b_j)
+        free(e)
+        free(f)
+        free(bw)
+        return log_probability_sum
+
+    cdef double _summarize_tables(self, double* sequence, double* weight, int n,
+        double* f, double* b, double* e, ScratchArena* arena=NULL) nogil:
+        """Collect sufficient statistics on a single sequence given its
+        emission table and forward and backward matrices."""
+
+        cdef int i, j, k, l, li
         cdef int m = self.n_states
 
         cdef void** distributions = self.distributions_ptr
@@ -2742,25 +6840,14 @@ cdef class HiddenMarkovModel(GraphModel):
         cdef double log_sequence_probability
         cdef double log_transition_emission_probability_sum
 
-        cdef double* expected_transitions = <double*> calloc(self.n_edges, sizeof(double))
-        cdef double* f
-        cdef double* b
-        cdef double* e
+        cdef double* expected_transitions = <double*> _scratch_alloc(arena,
+            self.n_edges*sizeof(double))
 
         cdef int* tied_edges = self.tied_edge_group_size
         cdef int* tied_states = self.tied_state_count
         cdef int* out_edges = self.out_edge_count
 
-        cdef double* weights = <double*> calloc(n, sizeof(double))
-
-        e = <double*> calloc(n*self.silent_start, sizeof(double))
-        for l in range(self.silent_start):
-            for i in range(n):
-                (<Model> distributions[l])._log_probability(sequence+i*d, e+l*n+i, 1)
-                e[l*n + i] += self.state_weights[l]
-
-        f = self._forward(sequence, n, e)
-        b = self._backward(sequence, n, e)
+        cdef double* weights = <double*> _scratch_alloc(arena, n*sizeof(double))
 
         if self.finite == 1:
             log_sequence_probability = f[n*m + self.end_index]
@@ -2831,7 +6918,7 @@ cdef class HiddenMarkovModel(GraphModel):
                         log_transition_emission_probability_sum -
                         log_sequence_probability)
 
-                if k < self.silent_start:
+                if k < self.silent_start and self._tied_representative(k) == k:
                     for i in range(n):
                         # For each symbol that came out
                         # What's the weight of this symbol for that state?
@@ -2846,6 +6933,14 @@ cdef class HiddenMarkovModel(GraphModel):
                         weights[i] = cexp(f[(i+1)*m + k] + b[(i+1)*m + k] -
                             log_sequence_probability) * weight[0]
 
+                    # States tied to this one share its distribution, so
+                    # their weights are added in and it is summarized once.
+                    for j in range(tied_states[k], tied_states[k+1]):
+                        li = self.tied[j]
+                        for i in range(n):
+                            weights[i] += cexp(f[(i+1)*m + li] + b[(i+1)*m + li]
+                                - log_sequence_probability) * weight[0]
+
                     (<Model>distributions[k])._summarize(sequence, weights, n, 0, self.d)
 
             # Update the master expected transitions vector representing the sparse matrix.
@@ -2855,11 +6950,8 @@ cdef class HiddenMarkovModel(GraphModel):
 
         self.summaries += 1
 
-        free(expected_transitions)
-        free(e)
-        free(weights)
-        free(f)
-        free(b)
+        _scratch_free(arena, expected_transitions)
+        _scratch_free(arena, weights)
         return log_sequence_probability * weight[0]
 
     cpdef double _viterbi_summarize(self, numpy.ndarray sequence_ndarray, double weight):
@@ -2873,13 +6965,19 @@ cdef class HiddenMarkovModel(GraphModel):
         cdef double* sequence = <double*> sequence_ndarray.data
         cdef int n = sequence_ndarray.shape[0], m = len(self.states)
         cdef double log_sequence_probability
+        cdef ScratchArena* arena = self._acquire_scratch()
 
-        with nogil:
-            log_sequence_probability = self.__viterbi_summarize(sequence, weight, n, m)
+        try:
+            with nogil:
+                log_sequence_probability = self.__viterbi_summarize(sequence, 
+                    weight, n, m, arena)
+        finally:
+            self._release_scratch(arena)
 
         return self.log_probability(sequence_ndarray, check_input=False)
 
-    cdef double __viterbi_summarize(self, double* sequence, double weight, int n, int m) nogil:
+    cdef double __viterbi_summarize(self, double* sequence, double weight, int n, 
+        int m, ScratchArena* arena=NULL) nogil:
         """Perform Viterbi re-estimation on the model parameters.
 
         The sequence is tagged using the viterbi algorithm, and both
@@ -2890,7 +6988,7 @@ cdef class HiddenMarkovModel(GraphModel):
         cdef int* path = <int*> calloc(n+m+1, sizeof(int))
         memset(path, -1, (n+m+1)*sizeof(int))
 
-        cdef double log_probability = self._viterbi(sequence, path, n, m)
+        cdef double log_probability = self._viterbi(sequence, path, n, m, arena)
         self.__labeled_summarize(sequence, path, weight, n, m)
 
         free(path)
@@ -3137,6 +7235,9 @@ cdef class HiddenMarkovModel(GraphModel):
                         self.states[k].distribution.from_summaries(
                             distribution_inertia)
 
+            self._update_transition_probabilities()
+            self._update_emission_table()
+
         free(norm)
         free(expected_transitions)
 
@@ -3158,6 +7259,157 @@ cdef class HiddenMarkovModel(GraphModel):
         for state in self.states[:self.silent_start]:
             state.distribution.clear_summaries()
 
+    def _out_transitions(self):
+        """Return the target state of each edge in the order they are stored."""
+
+        return numpy.array([self.out_transitions[l] for l in range(self.n_edges)],
+            dtype='int32')
+
+    def _get_parameters(self):
+        """Return the transition log probabilities and a list of the distinct
+        emission distributions, which can be given to `_set_parameters` on a
+        copy of the model in another process."""
+
+        cdef int k, l
+
+        in_log_probabilities = numpy.array([self.in_transition_log_probabilities[l]
+            for l in range(self.n_edges)])
+        out_log_probabilities = numpy.array([self.out_transition_log_probabilities[l]
+            for l in range(self.n_edges)])
+
+        distributions = [self.distributions[k] for k in range(self.silent_start)
+            if self._tied_representative(k) == k]
+
+        return in_log_probabilities, out_log_probabilities, distributions
+
+    def _set_parameters(self, parameters):
+        """Replace the transition log probabilities and the emission
+        distributions with those returned by `_get_parameters`."""
+
+        cdef int k, l, j = 0
+        in_log_probabilities, out_log_probabilities, distributions = parameters
+
+        for l in range(self.n_edges):
+            self.in_transition_log_probabilities[l] = in_log_probabilities[l]
+            self.out_transition_log_probabilities[l] = out_log_probabilities[l]
+
+        if self.discrete:
+            keys = [tuple(sorted(keymap, key=keymap.get)) for keymap in self.keymap]
+
+        for k in range(self.silent_start):
+            if self._tied_representative(k) == k:
+                distribution = distributions[j]
+                j += 1
+
+                if isinstance(distribution, DiscreteDistribution):
+                    distribution.bake(keys[0])
+                elif isinstance(distribution, IndependentComponentsDistribution):
+                    distribution.bake(keys)
+            else:
+                distribution = self.distributions[self._tied_representative(k)]
+
+            self.distributions[k] = distribution
+            self.states[k].distribution = distribution
+
+        self._update_transition_probabilities()
+        self._update_emission_table()
+
+    def _get_summaries(self):
+        """Return the expected transitions and the sufficient statistics of
+        each distinct distribution, which can be added to those of a copy of
+        the model using `_merge_summaries`."""
+
+        cdef int k, l
+
+        expected_transitions = numpy.array([self.expected_transitions[l]
+            for l in range(self.n_edges)])
+        distributions = [self.distributions[k]._get_summaries()
+            for k in range(self.silent_start)
+            if self._tied_representative(k) == k]
+
+        return self.summaries, expected_transitions, distributions
+
+    def _merge_summaries(self, summaries):
+        """Add the summaries returned by `_get_summaries` to those stored."""
+
+        cdef int k, l, j = 0
+        n_summaries, expected_transitions, distributions = summaries
+
+        self.summaries += n_summaries
+        for l in range(self.n_edges):
+            self.expected_transitions[l] += expected_transitions[l]
+
+        for k in range(self.silent_start):
+            if self._tied_representative(k) == k:
+                self.distributions[k]._merge_summaries(distributions[j])
+                j += 1
+
+    def _summarize_processes(self, pool, directory, iteration, batches, 
+        weights, algorithm, memory_budget):
+        """Summarize batches of sequences in worker processes and add the
+        sufficient statistics they return to those of this model.
+
+        The parameters are written to the directory shared with the workers
+        once, rather than being pickled into every batch. Every batch of the
+        previous iteration has returned by now, so no worker is reading the
+        file while it is replaced.
+        """
+
+        with open(os.path.join(directory, 'parameters'), 'wb') as outfile:
+            pickle.dump(self._get_parameters(), outfile, 
+                pickle.HIGHEST_PROTOCOL)
+
+        results = [pool.apply_async(_summarize_training_batch, (batch,
+            weights[batch], iteration, algorithm, memory_budget))
+            for batch in batches]
+
+        log_probability_sum = 0
+        for result in results:
+            logp, summaries = result.get()
+            log_probability_sum += logp
+            self._merge_summaries(summaries)
+
+        return log_probability_sum
+
+    def _summarize_stream(self, stream, parallel, n_jobs, n_batches, algorithm,
+        memory_budget):
+        """Summarize the next epoch of a stream of batches of sequences.
+
+        If n_batches is None the epoch is the rest of the current pass over
+        the stream and each batch is dropped once summarized. Otherwise the
+        epoch is the next n_batches batches, which are returned so that the
+        improvement can be measured on them after the update. Returns None in
+        place of the log probability if the stream is exhausted before any
+        batch is summarized.
+        """
+
+        log_probability_sum = 0
+        epoch_batches = []
+        n_summarized = 0
+
+        for X in stream:
+            if X is None:
+                if n_batches is None and n_summarized > 0:
+                    return log_probability_sum, epoch_batches
+                continue
+
+            weights = numpy.ones(len(X), dtype='float64')
+            log_probability_sum += sum(parallel(delayed(self.summarize, 
+                check_pickle=False)([X[i] for i in batch], weights[batch], 
+                None, algorithm, False, memory_budget) 
+                for batch in _balanced_batches([len(x) for x in X], n_jobs)))
+            n_summarized += 1
+
+            if n_batches is not None:
+                epoch_batches.append(X)
+                if len(epoch_batches) == n_batches:
+                    return log_probability_sum, epoch_batches
+
+        if n_summarized > 0:
+            return log_probability_sum, epoch_batches
+
+        return None, epoch_batches
+
     def to_json(self, separators=(',', ' : '), indent=4):
         """Serialize the model to a JSON.
 
@@ -3184,7 +7436,10 @@ cdef class HiddenMarkovModel(GraphModel):
                     'states' : [json.loads(state.to_json()) for state in self.states],
                     'end_index' : self.end_index,
                     'start_index' : self.start_index,
-                    'silent_index' : self.silent_start
+                    'silent_index' : self.silent_start,
+                    'dense' : bool(self.dense),
+                    'numerics' : self.numerics,
+                    'scratch_limit' : self.scratch_limit
                 }
 
         indices = { state: i for i, state in enumerate(self.states)}
@@ -3277,10 +7532,261 @@ cdef class HiddenMarkovModel(GraphModel):
             model.add_transition(states[start], states[end], probability,
                 pseudocount, group)
 
-        # Bake the model
-        model.bake(verbose=verbose)
+        # Bake the model with the kernels it was baked with before
+        model.numerics = d.get('numerics', 'log')
+        model.scratch_limit = d.get('scratch_limit', None)
+        model.bake(verbose=verbose, dense=d.get('dense', None))
+        return model
+
+    def save(self, filename):
+        """Write the baked model to a binary file.
+
+        Unlike `to_json`, the file holds the edge lists built by bake along
+        with the edges of the graph, the states and the distributions, so
+        that `load` restores a baked model without calling bake. The arrays
+        are stored uncompressed and aligned, so that they can be memory-mapped
+        and shared between processes which load the same file.
+
+        Parameters
+        ----------
+        filename : str
+            The file to write.
+
+        Returns
+        -------
+        None
+        """
+
+        if self.d == 0:
+            raise ValueError("must bake model before saving")
+
+        cdef int m = self.n_edges, n = self.n_states
+
+        indices = {state: i for i, state in enumerate(self.states)}
+        try:
+            nodes = numpy.array([indices[state] for state in self.graph.nodes()], 
+                dtype='int32')
+        except KeyError:
+            raise ValueError("the model has changed since it was baked, "
+                "bake it again before saving")
+
+        # Tied states share one distribution object, so store each once
+        distribution_indices, distributions, states = {}, [], []
+        for state in self.states:
+            k = -1
+            if not state.is_silent():
+                key = id(state.distribution)
+                if key not in distribution_indices:
+                    distribution_indices[key] = len(distributions)
+                    distributions.append(json.loads(state.distribution.to_json()))
+                k = distribution_indices[key]
+
+            states.append([state.name, state.weight, k])
+
+        edges = self.graph.edges(data=True)
+        groups, group_indices = [], {}
+        for a, b, data in edges:
+            group = data['group']
+            if group is not None and group not in group_indices:
+                group_indices[group] = len(groups)
+                groups.append(group)
+
+        keymap = None
+        if self.keymap is not None:
+            keymap = [sorted(keymap, key=keymap.get) for keymap in self.keymap]
+
+        header = {
+            'class' : 'HiddenMarkovModel',
+            'name' : self.name,
+            'states' : states,
+            'distributions' : distributions,
+            'groups' : groups,
+            'keymap' : keymap,
+            'start_index' : self.start_index,
+            'end_index' : self.end_index,
+            'silent_index' : self.silent_start,
+            'd' : self.d,
+            'discrete' : self.discrete,
+            'finite' : self.finite,
+            'dense' : self.dense,
+            'numerics' : self.numerics,
+            'scratch_limit' : self.scratch_limit
+        }
+
+        arrays = {
+            'in_transitions' : _int_array(self.in_transitions, m),
+            'in_edge_count' : _int_array(self.in_edge_count, n+1),
+            'in_transition_log_probabilities' : _double_array(
+                self.in_transition_log_probabilities, m),
+            'in_transition_pseudocounts' : _double_array(
+                self.in_transition_pseudocounts, m),
+            'out_transitions' : _int_array(self.out_transitions, m),
+            'out_edge_count' : _int_array(self.out_edge_count, n+1),
+            'out_transition_log_probabilities' : _double_array(
+                self.out_transition_log_probabilities, m),
+            'out_transition_pseudocounts' : _double_array(
+                self.out_transition_pseudocounts, m),
+            'tied_state_count' : _int_array(self.tied_state_count, 
+                self.silent_start+1),
+            'tied' : _int_array(self.tied, 
+                self.tied_state_count[self.silent_start]),
+            'tied_edge_group_size' : _int_array(self.tied_edge_group_size,
+                self.n_tied_edge_groups),
+            'tied_edges_starts' : _int_array(self.tied_edges_starts,
+                self.tied_edge_group_size[self.n_tied_edge_groups-1]),
+            'tied_edges_ends' : _int_array(self.tied_edges_ends,
+                self.tied_edge_group_size[self.n_tied_edge_groups-1]),
+            'state_weights' : numpy.asarray(self.state_weights),
+            'graph_nodes' : nodes,
+            'graph_edges' : numpy.array([[indices[a], indices[b]] for a, b, data 
+                in edges], dtype='int32').reshape(len(edges), 2),
+            'graph_probabilities' : numpy.array([data['probability'] for a, b, 
+                data in edges], dtype='float64'),
+            'graph_pseudocounts' : numpy.array([data['pseudocount'] for a, b, 
+                data in edges], dtype='float64'),
+            'graph_groups' : numpy.array([group_indices.get(data['group'], -1) 
+                for a, b, data in edges], dtype='int32')
+        }
+
+        _save_arrays(filename, header, arrays)
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        """Load a model written by `save` without baking it again.
+
+        Parameters
+        ----------
+        filename : str
+            The file to read.
+
+        mmap_mode : str or None, optional
+            How to map the arrays of the model into memory. By default they
+            are memory-mapped read-only, so that the edge lists of models
+            loaded from the same file by several processes share memory, and
+            the arrays which training changes are copied. If None, the
+            arrays are read into memory. Default is 'r'.
+
+        Returns
+        -------
+        model : HiddenMarkovModel
+            The baked model.
+        """
+
+        header, arrays = _load_arrays(filename, mmap_mode)
+        if header.get('class') != 'HiddenMarkovModel':
+            raise ValueError("'{}' does not hold a HiddenMarkovModel"
+                .format(filename))
+
+        distributions = [Distribution.from_json(json.dumps(d)) 
+            for d in header['distributions']]
+        states = [State(distributions[k] if k >= 0 else None, str(name), weight)
+            for name, weight, k in header['states']]
+
+        start, end = states[header['start_index']], states[header['end_index']]
+        cdef HiddenMarkovModel model = cls(header['name'], start=start, end=end)
+        model.state_names = set(state.name for state in states 
+            if state is not start and state is not end)
+
+        groups = [_as_key(group) for group in header['groups']]
+        edges = izip(arrays['graph_edges'].tolist(), 
+            arrays['graph_probabilities'].tolist(),
+            arrays['graph_pseudocounts'].tolist(), 
+            arrays['graph_groups'].tolist())
+
+        model.graph = networkx.DiGraph()
+        model.graph.add_nodes_from([states[i] for i in arrays['graph_nodes']])
+        model.graph.add_edges_from((states[a], states[b], {'probability': 
+            probability, 'pseudocount': pseudocount, 'group': groups[group] 
+            if group >= 0 else None}) for (a, b), probability, pseudocount, 
+            group in edges)
+
+        model._restore(header, arrays, states)
         return model
 
+    def _restore(self, header, arrays, states):
+        """Set up the model as bake would have from the arrays written by
+        `save`. The edge lists point into the arrays rather than being
+        copied, except for the transition log probabilities which are
+        changed by training."""
+
+        cdef int m = arrays['in_transitions'].shape[0]
+        cdef list borrowed = []
+        cdef numpy.ndarray array
+
+        self.free_bake_buffers()
+
+        self.states = states
+        self.n_states = len(states)
+        self.n_edges = m
+        self.silent_start = header['silent_index']
+        self.start_index = header['start_index']
+        self.end_index = header['end_index']
+        self.finite = header['finite']
+        self.d = header['d']
+        self.multivariate = self.d > 1
+        self.discrete = header['discrete']
+        self.numerics = header['numerics']
+        self.scratch_limit = header.get('scratch_limit', None)
+        self.state_weights = numpy.array(arrays['state_weights'], dtype='float64')
+
+        if arrays['in_edge_count'].shape[0] != self.n_states + 1 or \
+            arrays['tied_state_count'].shape[0] != self.silent_start + 1:
+            raise ValueError("the arrays do not match the states of the model")
+
+        self.in_transitions = <int*> _borrow(arrays, 'in_transitions', 
+            'int32', borrowed)
+        self.in_edge_count = <int*> _borrow(arrays, 'in_edge_count', 
+            'int32', borrowed)
+        self.in_transition_pseudocounts = <double*> _borrow(arrays, 
+            'in_transition_pseudocounts', 'float64', borrowed)
+        self.out_transitions = <int*> _borrow(arrays, 'out_transitions', 
+            'int32', borrowed)
+        self.out_edge_count = <int*> _borrow(arrays, 'out_edge_count', 
+            'int32', borrowed)
+        self.out_transition_pseudocounts = <double*> _borrow(arrays, 
+            'out_transition_pseudocounts', 'float64', borrowed)
+        self.tied_state_count = <int*> _borrow(arrays, 'tied_state_count', 
+            'int32', borrowed)
+        self.tied = <int*> _borrow(arrays, 'tied', 'int32', borrowed)
+        self.tied_edge_group_size = <int*> _borrow(arrays, 
+            'tied_edge_group_size', 'int32', borrowed)
+        self.tied_edges_starts = <int*> _borrow(arrays, 'tied_edges_starts', 
+            'int32', borrowed)
+        self.tied_edges_ends = <int*> _borrow(arrays, 'tied_edges_ends', 
+            'int32', borrowed)
+        self.n_tied_edge_groups = arrays['tied_edge_group_size'].shape[0]
+
+        self.borrowed = 1
+        self.borrowed_arrays = borrowed
+
+        self.in_transition_log_probabilities = <double*> calloc(m, sizeof(double))
+        self.out_transition_log_probabilities = <double*> calloc(m, sizeof(double))
+        self.expected_transitions = <double*> calloc(m, sizeof(double))
+
+        array = numpy.ascontiguousarray(arrays['in_transition_log_probabilities'],
+            dtype='float64')
+        memcpy(self.in_transition_log_probabilities, array.data, m*sizeof(double))
+        array = numpy.ascontiguousarray(arrays['out_transition_log_probabilities'],
+            dtype='float64')
+        memcpy(self.out_transition_log_probabilities, array.data, m*sizeof(double))
+
+        # The distributions are baked with the saved keymap, so that symbols
+        # are encoded as they were before saving.
+        if header['keymap'] is not None:
+            keys = [tuple(_as_key(key) for key in column) 
+                for column in header['keymap']]
+            self.keymap = [{key: i for i, key in enumerate(column)} 
+                for column in keys]
+
+        if self.discrete:
+            for state in states[:self.silent_start]:
+                if isinstance(state.distribution, DiscreteDistribution):
+                    state.distribution.bake(keys[0])
+                elif isinstance(state.distribution, IndependentComponentsDistribution):
+                    state.distribution.bake(keys)
+
+        self._bake_tables(bool(header['dense']))
+
     @classmethod
     def from_matrix(cls, transition_probabilities, distributions, starts, ends=None,
         state_names=None, name=None, verbose=False, merge='All'):
@@ -3356,21 +7862,24 @@ cdef class HiddenMarkovModel(GraphModel):
             model.add_state(state)
 
         # Connect the start of the model to the appropriate state
-        for i, prob in enumerate(starts):
-            if prob != 0:
-                model.add_transition(model.start, states[i], prob)
+        starts = numpy.asarray(starts, dtype='float64')
+        idxs = numpy.nonzero(starts)[0]
+        model.add_transitions(model.start, [states[i] for i in idxs],
+            starts[idxs].tolist())
 
         # Connect all states to each other if they have a non-zero probability
-        for i in xrange(n):
-            for j, prob in enumerate(transition_probabilities[i]):
-                if prob != 0.:
-                    model.add_transition(states[i], states[j], prob)
+        transition_probabilities = numpy.asarray(transition_probabilities, 
+            dtype='float64')
+        idxs, jdxs = numpy.nonzero(transition_probabilities)
+        model.add_transitions([states[i] for i in idxs], [states[j] for j in jdxs],
+            transition_probabilities[idxs, jdxs].tolist())
 
         if ends is not None:
             # Connect states to the end of the model if a non-zero probability
-            for i, prob in enumerate(ends):
-                if prob != 0:
-                    model.add_transition(states[i], model.end, prob)
+            ends = numpy.asarray(ends, dtype='float64')
+            idxs = numpy.nonzero(ends)[0]
+            model.add_transitions([states[i] for i in idxs], model.end,
+                ends[idxs].tolist())
 
         model.bake(verbose=verbose, merge=merge)
         return model
@@ -3414,7 +7923,12 @@ cdef class HiddenMarkovModel(GraphModel):
             An array of some sort (list, numpy.ndarray, tuple..) of sequences,
             where each sequence is a numpy array, which is 1 dimensional if
             the HMM is a one dimensional array, or multidimensional if the HMM
-            supports multiple dimensions.
+            supports multiple dimensions. A stream of batches of sequences,
+            such as a SequenceShards collection, can also be given, as in
+            `fit`. The emissions are then initialized from the first batch,
+            except that the symbols of a discrete model are gathered from
+            every batch, and the stream must be able to be passed over more
+            than once.
 
         weights : array-like or None, optional
             An array of weights, one for each sequence to train on. If None,
@@ -3546,7 +8060,18 @@ cdef class HiddenMarkovModel(GraphModel):
         """
 
 
-        X_concat = numpy.concatenate(X)
+        if _is_stream(X):
+            if labels is not None:
+                raise ValueError("labels cannot be used when streaming batches "
+                    "of sequences")
+            if iter(X) is X:
+                raise ValueError("a one-shot iterator cannot be used to learn "
+                    "a model, since the sequences are passed over more than once")
+
+            X_concat = _stream_sample(X, distribution is DiscreteDistribution)
+        else:
+            X_concat = numpy.concatenate(X)
+
         if X_concat.ndim == 1:
             X_concat = X_concat.reshape(X_concat.shape[0], 1)
 
@@ -3614,3 +8139,334 @@ cdef class HiddenMarkovModel(GraphModel):
             batches_per_epoch=batches_per_epoch, lr_decay=lr_decay, n_jobs=n_jobs)
 
         return model
+
+
+cdef class HiddenMarkovModelFilter(object):
+    """An online filter for a baked hidden Markov model.
+
+    Observations are given one at a time using `update`, which returns the
+    posterior probability of each non-silent state given all observations
+    seen so far. Each update takes time linear in the number of edges in the
+    model and reuses buffers allocated when the filter is created.
+
+    The filter also keeps a fixed-lag smoother, which gives the posterior of
+    the state `lag` observations ago given all observations seen so far, and
+    an online Viterbi decoder, which keeps the traceback for only the last
+    `window` observations.
+
+    The stream is treated as unending, so the end state of a finite model is
+    ignored. Re-baking the model invalidates any filter built from it.
+
+    Parameters
+    ----------
+    model : HiddenMarkovModel
+        The baked model to filter with.
+
+    lag : int, optional
+        The number of observations to delay the smoothed posterior by. The
+        smoother adds time linear in lag to each update. Default is 0.
+
+    window : int, optional
+        The number of observations for which Viterbi traceback is stored.
+        Default is 100.
+
+    Attributes
+    ----------
+    model : HiddenMarkovModel
+        The model being filtered with.
+
+    n_observations : int
+        The number of observations seen since the last reset.
+
+    log_probability : double
+        The log probability of all observations seen since the last reset.
+
+    Examples
+    --------
+    >>> filter = model.filter(lag=2)
+    >>> for observation in stream:
+    ...     posterior = filter.update(observation)
+    ...     smoothed = filter.smoothed_proba
+    """
+
+    cdef public HiddenMarkovModel model
+    cdef public int lag
+    cdef public int window
+    cdef public int n_observations
+    cdef public double log_probability
+    cdef double viterbi_offset
+    cdef int n_slots
+    cdef double* f
+    cdef double* e
+    cdef double* x
+    cdef double* vp
+    cdef double* vc
+    cdef double* bc
+    cdef double* bn
+    cdef int* tb
+    cdef numpy.ndarray posterior
+    cdef numpy.ndarray smoothed
+    cdef double* smoothed_ptr
+
+    def __cinit__(self):
+        self.f = NULL
+        self.e = NULL
+        self.x = NULL
+        self.vp = NULL
+        self.vc = NULL
+        self.bc = NULL
+        self.bn = NULL
+        self.tb = NULL
+
+    def __init__(self, HiddenMarkovModel model, lag=0, window=100):
+        if model.d == 0:
+            raise ValueError("must bake model before filtering")
+        if lag < 0:
+            raise ValueError("lag must be non-negative")
+        if window < 1:
+            raise ValueError("window must be at least 1")
+
+        cdef int m = model.n_states, p = model.silent_start
+
+        self.model = model
+        self.lag = lag
+        self.window = window
+        self.n_slots = lag + 2
+
+        self.f = <double*> calloc(self.n_slots*m, sizeof(double))
+        self.e = <double*> calloc(self.n_slots*p, sizeof(double))
+        self.x = <double*> calloc(model.d, sizeof(double))
+        self.vp = <double*> calloc(m, sizeof(double))
+        self.vc = <double*> calloc(m, sizeof(double))
+        self.bc = <double*> calloc(m, sizeof(double))
+        self.bn = <double*> calloc(m, sizeof(double))
+        self.tb = <int*> calloc(window*m, sizeof(int))
+
+        self.posterior = numpy.zeros(p, dtype='float64')
+        self.smoothed = numpy.zeros(p, dtype='float64')
+        self.smoothed_ptr = <double*> self.smoothed.data
+        self.reset()
+
+    def __dealloc__(self):
+        free(self.f)
+        free(self.e)
+        free(self.x)
+        free(self.vp)
+        free(self.vc)
+        free(self.bc)
+        free(self.bn)
+        free(self.tb)
+
+    property smoothed_proba:
+        """The posterior of each non-silent state `lag` observations ago,
+        or None if fewer than lag+1 observations have been seen."""
+
+        def __get__(self):
+            if self.n_observations <= self.lag:
+                return None
+            return self.smoothed
+
+    property viterbi_log_probability:
+        """The log probability of the best path through the observations
+        seen since the last reset."""
+
+        def __get__(self):
+            return self.viterbi_offset
+
+    def reset(self):
+        """Forget all observations and start a new stream."""
+
+        cdef HiddenMarkovModel model = self.model
+        cdef int l, m = model.n_states
+
+        self.n_observations = 0
+        self.log_probability = 0.
+        self.viterbi_offset = 0.
+
+        model._forward_initial(self.f)
+        self._viterbi_initial()
+
+        self.posterior[:] = 0
+        self.smoothed[:] = 0
+
+    def update(self, observation):
+        """Add an observation to the stream.
+
+        Parameters
+        ----------
+        observation : object
+            A single observation, either a symbol or a value, or a list of
+            them for multivariate models.
+
+        Returns
+        -------
+        posterior : numpy.ndarray, shape (n_nonsilent_states,)
+            The probability of each non-silent state given all observations
+            so far. This array is overwritten by the next call to update.
+        """
+
+        cdef HiddenMarkovModel model = self.model
+        cdef int i, l, m = model.n_states, p = model.silent_start
+        cdef int t = self.n_observations
+        cdef double* fp = self.f + (t % self.n_slots)*m
+        cdef double* fc = self.f + ((t+1) % self.n_slots)*m
+        cdef double* e = self.e + ((t+1) % self.n_slots)*p
+        cdef double* posterior = <double*> self.posterior.data
+        cdef double log_probability = NEGINF
+
+        self._encode(observation)
+
+        with nogil:
+            model._emissions(self.x, e, 1, p, 1)
+            model._forward_step(fp, fc, e, 1)
+            for l in range(p):
+                log_probability = pair_lse(log_probability, fc[l])
+
+        if log_probability == NEGINF:
+            raise ValueError("Observation is impossible under the model")
+
+        with nogil:
+            for l in range(m):
+                fc[l] -= log_probability
+
+            for l in range(p):
+                posterior[l] = cexp(fc[l])
+
+            self.log_probability += log_probability
+            self.n_observations += 1
+            self._viterbi_step(e)
+
+            if self.n_observations > self.lag:
+                self._smooth()
+
+        return self.posterior
+
+    cdef void _encode(self, observation) except *:
+        """Write the observation into the input buffer."""
+
+        cdef HiddenMarkovModel model = self.model
+        cdef int j
+
+        if model.multivariate:
+            for j in range(model.d):
+                self.x[j] = self._encode_symbol(observation[j], j)
+        else:
+            self.x[0] = self._encode_symbol(observation, 0)
+
+    cdef double _encode_symbol(self, symbol, int j) except? -1:
+        cdef HiddenMarkovModel model = self.model
+
+        if not model.discrete:
+            return symbol
+        elif isinstance(symbol, str) and symbol == 'nan':
+            return numpy.nan
+        elif isinstance(symbol, float) and symbol != symbol:
+            return numpy.nan
+        elif symbol in model.keymap[j]:
+            return model.keymap[j][symbol]
+
+        raise ValueError("Symbol '{}' is not defined in a distribution"
+            .format(symbol))
+
+    cdef void _smooth(self) nogil:
+        """Run the backward algorithm over the last lag observations and
+        combine it with the stored forward rows."""
+
+        cdef int i, l, m = self.model.n_states, p = self.model.silent_start
+        cdef int t = self.n_observations, slot
+        cdef double* bc = self.bc
+        cdef double* bn = self.bn
+        cdef double* f
+        cdef double* smoothed = self.smoothed_ptr
+        cdef double log_probability = NEGINF
+
+        # The stream has not ended, so any non-silent state may be last.
+        for l in range(p):
+            bn[l] = 0.
+        for l in range(p, m):
+            bn[l] = NEGINF
+
+        for i in range(self.lag):
+            slot = (t - i) % self.n_slots
+            self.model._backward_step(bc, bn, self.e + slot*p, 1)
+            bc, bn = bn, bc
+
+        f = self.f + ((t - self.lag) % self.n_slots)*m
+        for l in range(p):
+            smoothed[l] = f[l] + bn[l]
+            log_probability = pair_lse(log_probability, smoothed[l])
+
+        for l in range(p):
+            smoothed[l] = cexp(smoothed[l] - log_probability)
+
+    cdef void _viterbi_initial(self):
+        self.model._viterbi_initial(self.vc, NULL)
+
+    cdef void _viterbi_step(self, double* e) nogil:
+        """Extend the Viterbi row by one observation, recording for each
+        state its best predecessor in the traceback ring."""
+
+        cdef int l, m = self.model.n_states
+        cdef int* tb = self.tb + ((self.n_observations-1) % self.window)*m
+        cdef double* vc
+        cdef double best = NEGINF
+
+        self.vp, self.vc = self.vc, self.vp
+        self.model._viterbi_step(self.vp, self.vc, e, 1, tb)
+        vc = self.vc
+
+        # Keep the scores near zero so long streams do not underflow.
+        for l in range(m):
+            if vc[l] > best:
+                best = vc[l]
+
+        if best != NEGINF:
+            for l in range(m):
+                vc[l] -= best
+            self.viterbi_offset += best
+        else:
+            self.viterbi_offset = NEGINF
+
+    def viterbi(self):
+        """Return the best path through the most recent observations.
+
+        Returns
+        -------
+        logp : double
+            The log probability of the best path through all observations
+            seen since the last reset.
+
+        path : list of ints
+            The index of the non-silent state along the best path for each of
+            the last min(n_observations, window) observations.
+        """
+
+        cdef HiddenMarkovModel model = self.model
+        cdef int l, m = model.n_states, p = model.silent_start
+        cdef int t = self.n_observations
+        cdef int depth = min(t, self.window)
+        cdef int state = -1, ki
+        cdef double best = NEGINF
+        cdef list path = []
+
+        if self.viterbi_offset == NEGINF:
+            return NEGINF, None
+
+        for l in range(m):
+            if self.vc[l] > best:
+                best = self.vc[l]
+                state = l
+
+        while depth > 0:
+            ki = self.tb[((t-1) % self.window)*m + state]
+
+            if state < p:
+                path.append(state)
+                t -= 1
+                depth -= 1
+                state = ki
+            else:
+                state = -1 - ki
+
+        path.reverse()
+        return self.viterbi_offset + best, path
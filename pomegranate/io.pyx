@@ -0,0 +1,592 @@
+# io.pyx
+# Contact: Jacob Schreiber <jmschreiber91@gmail.com>
+
+"""
+Containers for storing large collections of sequences outside of Python
+lists, so that they can be kept in a single buffer or memory-mapped from disk.
+"""
+
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+import numpy
+
+if sys.version_info[0] > 2:
+	from queue import Queue, Full
+else:
+	from Queue import Queue, Full
+
+class EncodedSequence(numpy.ndarray):
+	"""A zero-copy view of one sequence from a ragged collection.
+
+	This is a float64 ndarray which additionally remembers the keymap used
+	to encode its symbols, so that models can use it directly without
+	encoding it again.
+	"""
+
+	def __array_finalize__(self, obj):
+		self.keymap = getattr(obj, 'keymap', None)
+
+	def symbols(self):
+		"""Return the original symbols of the sequence.
+
+		Returns
+		-------
+		sequence : numpy.ndarray
+			The decoded sequence, an object array if the sequence holds
+			encoded discrete symbols and a plain float64 view otherwise.
+		"""
+
+		sequence = self.view(numpy.ndarray)
+		if self.keymap is None:
+			return sequence
+
+		return _decode(sequence, self.keymap)
+
+
+class RaggedSequences(object):
+	"""A collection of variable length sequences stored in one flat buffer.
+
+	All observations are concatenated into a single float64 array and an
+	int64 offsets array marks where each sequence begins, so that sequence i
+	is data[offsets[i]:offsets[i+1]]. Indexing returns views into the buffer
+	rather than copies, which means the buffer can be a numpy.memmap and the
+	collection can be far larger than memory. Discrete symbols are stored
+	encoded as integers together with the keymap used to encode them.
+
+	Parameters
+	----------
+	data : numpy.ndarray, shape (n_observations,) or (n_observations, d)
+		The concatenated observations of every sequence.
+
+	offsets : array-like, shape (n_sequences+1,)
+		The start of each sequence in the data, followed by the end of the
+		last sequence.
+
+	keymap : list of dicts or None, optional
+		For each column, the mapping from each discrete symbol to the
+		integer it has been encoded as, or None if the data are numeric.
+		Default is None.
+
+	Attributes
+	----------
+	data : numpy.ndarray
+		The concatenated observations.
+
+	offsets : numpy.ndarray, dtype int64
+		The sequence boundaries.
+
+	keymap : list of dicts or None
+		The encoding of discrete symbols.
+
+	Examples
+	--------
+	>>> from pomegranate import *
+	>>> X = RaggedSequences.from_sequences([list('ACGT'), list('GGA')], model)
+	>>> X.save('train')
+	>>> X = RaggedSequences.load('train')
+	>>> model.fit(X)
+	"""
+
+	def __init__(self, data, offsets, keymap=None):
+		offsets = numpy.asarray(offsets, dtype='int64')
+
+		if offsets.ndim != 1 or offsets.shape[0] == 0:
+			raise ValueError("offsets must be a non-empty 1D array")
+		if offsets[0] < 0 or offsets[-1] > data.shape[0]:
+			raise ValueError("offsets must lie within the data")
+		if numpy.any(offsets[1:] < offsets[:-1]):
+			raise ValueError("offsets must be non-decreasing")
+
+		if data.dtype != numpy.float64 or not data.flags['C_CONTIGUOUS']:
+			data = numpy.ascontiguousarray(data, dtype='float64')
+
+		self.data = data
+		self.offsets = offsets
+		self.keymap = keymap
+
+	@classmethod
+	def from_sequences(cls, sequences, model=None):
+		"""Pack a list of sequences into a single buffer.
+
+		Parameters
+		----------
+		sequences : list of array-like
+			The sequences to store.
+
+		model : HiddenMarkovModel or None, optional
+			A baked model whose keymap is used to encode discrete symbols. If
+			None, discrete symbols are encoded in sorted order and numeric
+			sequences are stored as they are. Default is None.
+
+		Returns
+		-------
+		X : RaggedSequences
+			The packed collection.
+		"""
+
+		from .hmm import _check_input
+
+		lengths = numpy.array([len(sequence) for sequence in sequences], dtype='int64')
+		offsets = numpy.zeros(lengths.shape[0] + 1, dtype='int64')
+		numpy.cumsum(lengths, out=offsets[1:])
+
+		if model is not None:
+			keymap = model.keymap if model.discrete else None
+			data = [_check_input(sequence, model) for sequence in sequences]
+		else:
+			data = [numpy.asarray(sequence) for sequence in sequences]
+			keymap = None
+
+			if any(sequence.dtype.kind not in 'biuf' for sequence in data):
+				data, keymap = _encode(data)
+
+		if len(data) > 0:
+			data = numpy.concatenate(data).astype('float64')
+		else:
+			data = numpy.zeros(0, dtype='float64')
+
+		return cls(data, offsets, keymap)
+
+	@classmethod
+	def load(cls, prefix, mmap_mode='r'):
+		"""Load a collection written by save.
+
+		Parameters
+		----------
+		prefix : str
+			The path prefix the collection was saved under.
+
+		mmap_mode : str or None, optional
+			Passed to numpy.load. By default the data are memory-mapped
+			read-only rather than read into memory. Default is 'r'.
+
+		Returns
+		-------
+		X : RaggedSequences
+			The stored collection.
+		"""
+
+		data = numpy.load(prefix + '.data.npy', mmap_mode=mmap_mode)
+		offsets = numpy.load(prefix + '.offsets.npy')
+
+		with open(prefix + '.keymap.json', 'r') as infile:
+			keymap = json.load(infile)
+
+		if keymap is not None:
+			keymap = [{_as_key(key): value for key, value in column}
+				for column in keymap]
+
+		return cls(data, offsets, keymap)
+
+	def save(self, prefix):
+		"""Write the collection to disk so that it can be memory-mapped.
+
+		This writes prefix.data.npy, prefix.offsets.npy and prefix.keymap.json.
+
+		Parameters
+		----------
+		prefix : str
+			The path prefix to save under.
+
+		Returns
+		-------
+		None
+		"""
+
+		start, end = self.offsets[0], self.offsets[-1]
+		numpy.save(prefix + '.data.npy', self.data[start:end])
+		numpy.save(prefix + '.offsets.npy', self.offsets - start)
+
+		keymap = self.keymap
+		if keymap is not None:
+			keymap = [sorted(column.items(), key=lambda item: item[1])
+				for column in keymap]
+
+		with open(prefix + '.keymap.json', 'w') as outfile:
+			json.dump(keymap, outfile)
+
+	@property
+	def lengths(self):
+		"""The length of each sequence."""
+
+		return numpy.diff(self.offsets)
+
+	def __len__(self):
+		return self.offsets.shape[0] - 1
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def __getitem__(self, idx):
+		if isinstance(idx, slice):
+			start, stop, step = idx.indices(len(self))
+			if step != 1:
+				raise ValueError("only contiguous slices are supported")
+
+			stop = max(start, stop)
+			return RaggedSequences(self.data, self.offsets[start:stop+1],
+				self.keymap)
+
+		n = len(self)
+		if idx < 0:
+			idx += n
+		if idx < 0 or idx >= n:
+			raise IndexError("sequence index out of range")
+
+		sequence = self.data[self.offsets[idx]:self.offsets[idx+1]]
+		sequence = sequence.view(EncodedSequence)
+		sequence.keymap = self.keymap
+		return sequence
+
+	def symbols(self):
+		"""Return every sequence with its original symbols.
+
+		Returns
+		-------
+		sequences : list of numpy.ndarray
+			The decoded sequences. Numeric collections are returned as views.
+		"""
+
+		return [sequence.symbols() for sequence in self]
+
+	def encode(self, model):
+		"""Return the collection encoded with the keymap of a model.
+
+		Keymaps are built from sets when a model is baked, so the same
+		symbols can be encoded differently by two models. If the keymap of
+		the collection already matches the model this returns the collection
+		itself, otherwise the data are translated once into a new buffer.
+
+		Parameters
+		----------
+		model : HiddenMarkovModel
+			A baked model.
+
+		Returns
+		-------
+		X : RaggedSequences
+			A collection whose views can be used directly by the model.
+		"""
+
+		if not model.discrete:
+			if self.keymap is not None:
+				raise ValueError("discrete sequences cannot be used with a "
+					"continuous model")
+			return self
+
+		if self.keymap is None:
+			raise ValueError("numeric sequences cannot be used with a discrete "
+				"model, pack them using RaggedSequences.from_sequences")
+
+		if self.keymap is model.keymap or self.keymap == model.keymap:
+			return RaggedSequences(self.data, self.offsets, model.keymap)
+
+		if len(self.keymap) != len(model.keymap):
+			raise ValueError("the collection has {} columns but the model has {}"
+				.format(len(self.keymap), len(model.keymap)))
+
+		start, end = self.offsets[0], self.offsets[-1]
+		data = numpy.array(self.data[start:end], dtype='float64')
+		data = data.reshape(end - start, len(self.keymap))
+
+		for j, (keymap, model_keymap) in enumerate(zip(self.keymap, model.keymap)):
+			table = numpy.empty(len(keymap), dtype='float64')
+			for symbol, code in keymap.items():
+				if symbol not in model_keymap:
+					raise ValueError("Symbol '{}' is not defined in a distribution"
+						.format(symbol))
+				table[code] = model_keymap[symbol]
+
+			column = data[:, j]
+			mask = ~numpy.isnan(column)
+			column[mask] = table[column[mask].astype('int64')]
+
+		data = data.reshape(self.data[start:end].shape)
+		return RaggedSequences(data, self.offsets - start, model.keymap)
+
+
+class SequenceShards(object):
+	"""A collection of sequences split into RaggedSequences shards on disk.
+
+	Iterating over the collection loads one shard at a time, memory-mapped,
+	so it can be passed to HiddenMarkovModel.fit to train on more sequences
+	than fit in memory. Each shard is one batch of sequences.
+
+	Parameters
+	----------
+	prefixes : list of str
+		The path prefix of each shard, as given to RaggedSequences.save.
+
+	mmap_mode : str or None, optional
+		Passed to RaggedSequences.load. Default is 'r'.
+
+	Attributes
+	----------
+	prefixes : list of str
+		The path prefix of each shard.
+
+	Examples
+	--------
+	>>> from pomegranate import *
+	>>> X = SequenceShards.from_sequences(sequences, 'train', shard_size=10000)
+	>>> X = SequenceShards.from_directory('train')
+	>>> model.fit(X, batch_size=1000)
+	"""
+
+	def __init__(self, prefixes, mmap_mode='r'):
+		self.prefixes = list(prefixes)
+		self.mmap_mode = mmap_mode
+
+	@classmethod
+	def from_directory(cls, path, mmap_mode='r'):
+		"""Find every shard saved in a directory, in sorted order.
+
+		Parameters
+		----------
+		path : str
+			The directory holding the shards.
+
+		mmap_mode : str or None, optional
+			Passed to RaggedSequences.load. Default is 'r'.
+
+		Returns
+		-------
+		X : SequenceShards
+			The shards in the directory.
+		"""
+
+		suffix = '.offsets.npy'
+		prefixes = sorted(filename[:-len(suffix)] for filename in
+			glob.glob(os.path.join(path, '*' + suffix)))
+
+		if len(prefixes) == 0:
+			raise ValueError("no shards found in '{}'".format(path))
+
+		return cls(prefixes, mmap_mode)
+
+	@classmethod
+	def from_sequences(cls, sequences, path, shard_size, model=None):
+		"""Write sequences to a directory as shards of at most shard_size
+		sequences each.
+
+		Parameters
+		----------
+		sequences : iterable of array-like
+			The sequences to store. They are read one shard at a time, so
+			this can be a generator.
+
+		path : str
+			The directory to write the shards to, created if needed.
+
+		shard_size : int
+			The number of sequences in each shard.
+
+		model : HiddenMarkovModel or None, optional
+			Passed to RaggedSequences.from_sequences. Default is None.
+
+		Returns
+		-------
+		X : SequenceShards
+			The shards written.
+		"""
+
+		if shard_size < 1:
+			raise ValueError("shard_size must be at least 1")
+
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+		prefixes, shard = [], []
+		for sequence in sequences:
+			shard.append(sequence)
+			if len(shard) == shard_size:
+				prefixes.append(cls._write_shard(shard, path, len(prefixes), model))
+				shard = []
+
+		if len(shard) > 0:
+			prefixes.append(cls._write_shard(shard, path, len(prefixes), model))
+
+		return cls(prefixes)
+
+	@staticmethod
+	def _write_shard(shard, path, i, model):
+		prefix = os.path.join(path, 'shard-{:06d}'.format(i))
+		RaggedSequences.from_sequences(shard, model).save(prefix)
+		return prefix
+
+	def __len__(self):
+		return len(self.prefixes)
+
+	def __getitem__(self, idx):
+		return RaggedSequences.load(self.prefixes[idx], self.mmap_mode)
+
+	def __iter__(self):
+		for prefix in self.prefixes:
+			yield RaggedSequences.load(prefix, self.mmap_mode)
+
+
+# The first bytes of a file written by _save_arrays, which are followed by the
+# length of its JSON header as a little-endian uint64, the header, and then the
+# arrays, each starting at a multiple of _ARRAY_ALIGNMENT bytes.
+_ARRAYS_MAGIC = b'\x93PGARRAY'
+_ARRAY_ALIGNMENT = 64
+
+def _aligned(n):
+	return (n + _ARRAY_ALIGNMENT - 1) // _ARRAY_ALIGNMENT * _ARRAY_ALIGNMENT
+
+def _save_arrays(filename, header, arrays):
+	"""Write a JSON header and a dictionary of arrays to a single file, with
+	the arrays stored uncompressed so that _load_arrays can memory-map them."""
+
+	arrays = {name: numpy.ascontiguousarray(array) for name, array in arrays.items()}
+	layout, offset = {}, 0
+
+	for name in sorted(arrays):
+		array = arrays[name]
+		layout[name] = [array.dtype.str, list(array.shape), offset]
+		offset += _aligned(array.nbytes)
+
+	header = dict(header, arrays=layout)
+	encoded = json.dumps(header).encode('utf-8')
+
+	with open(filename, 'wb') as outfile:
+		outfile.write(_ARRAYS_MAGIC)
+		outfile.write(struct.pack('<Q', len(encoded)))
+		outfile.write(encoded)
+		outfile.write(b'\0' * (_aligned(outfile.tell()) - outfile.tell()))
+
+		for name in sorted(arrays):
+			data = arrays[name].tobytes()
+			outfile.write(data)
+			outfile.write(b'\0' * (_aligned(len(data)) - len(data)))
+
+def _load_arrays(filename, mmap_mode='r'):
+	"""Read the header and the arrays written by _save_arrays, memory-mapping
+	the arrays unless mmap_mode is None."""
+
+	with open(filename, 'rb') as infile:
+		if infile.read(len(_ARRAYS_MAGIC)) != _ARRAYS_MAGIC:
+			raise ValueError("'{}' was not written by save".format(filename))
+
+		n = struct.unpack('<Q', infile.read(8))[0]
+		header = json.loads(infile.read(n).decode('utf-8'))
+
+	start = _aligned(len(_ARRAYS_MAGIC) + 8 + n)
+	arrays = {}
+
+	for name, (dtype, shape, offset) in header.pop('arrays').items():
+		shape = tuple(shape)
+		count = int(numpy.prod(shape))
+
+		if count == 0:
+			arrays[name] = numpy.zeros(shape, dtype=dtype)
+		elif mmap_mode is None:
+			arrays[name] = numpy.fromfile(filename, dtype=dtype, count=count,
+				offset=start+offset).reshape(shape)
+		else:
+			arrays[name] = numpy.memmap(filename, dtype=dtype, mode=mmap_mode,
+				offset=start+offset, shape=shape)
+
+	return header, arrays
+
+def _as_key(key):
+	"""JSON turns tuples into lists, so turn them back into hashable keys."""
+
+	return tuple(_as_key(k) for k in key) if isinstance(key, list) else key
+
+def _encode(sequences):
+	"""Encode sequences of discrete symbols using their sorted order."""
+
+	ndim = sequences[0].ndim
+	d = 1 if ndim == 1 else sequences[0].shape[1]
+	columns = [numpy.concatenate([sequence.reshape(-1, d)[:, j]
+		for sequence in sequences]) for j in range(d)]
+
+	keymap, encoded = [], []
+	for column in columns:
+		keys = sorted(set(key for key in column.tolist() if not _is_missing(key)))
+		keymap.append({key: i for i, key in enumerate(keys)})
+		encoded.append(numpy.array([numpy.nan if _is_missing(key)
+			else keymap[-1][key] for key in column.tolist()], dtype='float64'))
+
+	data = numpy.array(encoded).T
+	if ndim == 1:
+		data = data[:, 0]
+
+	return [data], keymap
+
+def _is_missing(symbol):
+	if isinstance(symbol, str):
+		return symbol == 'nan'
+	if isinstance(symbol, float):
+		return numpy.isnan(symbol)
+	return False
+
+def _decode(sequence, keymap):
+	"""Translate an encoded sequence back into its original symbols."""
+
+	d = len(keymap)
+	codes = sequence.reshape(-1, d)
+	symbols = numpy.empty(codes.shape, dtype=object)
+
+	for j in range(d):
+		inverse = numpy.empty(len(keymap[j]), dtype=object)
+		for symbol, code in keymap[j].items():
+			inverse[code] = symbol
+
+		mask = numpy.isnan(codes[:, j])
+		symbols[mask, j] = numpy.nan
+		symbols[~mask, j] = inverse[codes[~mask, j].astype('int64')]
+
+	return symbols[:, 0] if sequence.ndim == 1 else symbols
+
+def _prefetch(items, func, size=1):
+	"""Iterate over func(item) for each item, computing up to size results
+	ahead on a background thread so that loading the next batch overlaps
+	with work on the current one. Errors are raised in the caller."""
+
+	queue = Queue(size)
+	stop = threading.Event()
+	end = object()
+
+	def put(value):
+		while not stop.is_set():
+			try:
+				queue.put(value, timeout=0.1)
+				return True
+			except Full:
+				pass
+
+		return False
+
+	def produce():
+		try:
+			for item in items:
+				if not put((func(item), None)):
+					return
+
+			put((end, None))
+		except BaseException as e:
+			put((None, e))
+
+	thread = threading.Thread(target=produce)
+	thread.daemon = True
+	thread.start()
+
+	try:
+		while True:
+			value, error = queue.get()
+			if error is not None:
+				raise error
+			if value is end:
+				return
+
+			yield value
+	finally:
+		stop.set()
+		thread.join()
@@ -8,6 +8,9 @@ import sys
 
 from .base cimport Model
 from .hmm import HiddenMarkovModel
+from .hmm import _balanced_batches
+from .hmm import _check_sequences
+from .io import RaggedSequences
 from .NaiveBayes import NaiveBayes
 from .distributions import Distribution
 
@@ -31,11 +34,11 @@ def parallelize(model, X, func, n_jobs, backend):
 		backend which releases the GIL and allows for multithreaded
 		parallelization.
 
-	X : numpy.ndarray or list
+	X : numpy.ndarray or list or RaggedSequences
 		The dataset to operate on. For most models this is a numpy array with
 		columns corresponding to features and rows corresponding to samples.
 		For markov chains and HMMs this will be a list of variable length
-		sequences.
+		sequences or a RaggedSequences collection.
 
 	func : <function>
 		The function to parallelize. Typically this is one of the model methods
@@ -56,18 +59,85 @@ def parallelize(model, X, func, n_jobs, backend):
 		The results of the method concatenated together across processes.   
 	"""
 
+	if isinstance(model, HiddenMarkovModel) and func in ('log_probability', 
+		'predict_proba', 'predict_log_proba'):
+		return _parallelize_hmm_batches(model, X, func, n_jobs, backend)
+
+	if isinstance(model, HiddenMarkovModel):
+		return _parallelize_hmm_sequences(model, X, func, n_jobs, backend)
+
 	delay = delayed(getattr(model, func), check_pickle=False)
 	with Parallel(n_jobs=n_jobs, backend=backend) as parallel:
-		if isinstance(model, HiddenMarkovModel):
-			y = parallel(delay(x) for x in X)
-		else:
-			n = len(X)
-			starts = [n/n_jobs*i for i in range(n_jobs)]
-			ends = starts[1:] + [n]
-			y = parallel(delay(X[start:end]) for start, end in zip(starts, ends))
+		n = len(X)
+		starts = [n/n_jobs*i for i in range(n_jobs)]
+		ends = starts[1:] + [n]
+		y = parallel(delay(X[start:end]) for start, end in zip(starts, ends))
 
 	return numpy.concatenate(y) if n_jobs > 1 and n_jobs != len(X) else y
 
+def _apply(func, X):
+	"""Apply a function to each sequence in a task."""
+
+	return [func(x) for x in X]
+
+def _parallelize_hmm_sequences(model, X, func, n_jobs, backend):
+	"""Parallelize a per-sequence hidden Markov model method.
+
+	The sequences are split into tasks of roughly equal total length, rather
+	than sending one task per sequence, and the results are returned in the
+	order of the sequences.
+	"""
+
+	if isinstance(X, RaggedSequences):
+		X = X.encode(model)
+
+	batches = _balanced_batches([len(x) for x in X], n_jobs)
+
+	delay = delayed(_apply, check_pickle=False)
+	with Parallel(n_jobs=n_jobs, backend=backend) as parallel:
+		y = parallel(delay(getattr(model, func), [X[i] for i in batch]) 
+			for batch in batches)
+
+	results = [None for i in range(len(X))]
+	for batch, chunk in zip(batches, y):
+		for i, result in zip(batch, chunk):
+			results[i] = result
+
+	return results
+
+def _parallelize_hmm_batches(model, X, func, n_jobs, backend):
+	"""Parallelize a hidden Markov model method using the batched kernels.
+
+	Rather than sending one task per sequence, the sequences are split into
+	tasks of roughly equal total length and each task is scored by the
+	batched forward and backward algorithms, which process many sequences
+	at once.
+	"""
+
+	X = _check_sequences(X, model)
+	batches = _balanced_batches([len(x) for x in X], n_jobs)
+
+	if func == 'log_probability':
+		delay = delayed(model._log_probability_batch, check_pickle=False)
+	else:
+		delay = delayed(model._predict_log_proba_batch, check_pickle=False)
+
+	with Parallel(n_jobs=n_jobs, backend=backend) as parallel:
+		y = parallel(delay([X[i] for i in batch]) for batch in batches)
+
+	if func == 'log_probability':
+		logp = numpy.empty(len(X), dtype='float64')
+		for batch, chunk in zip(batches, y):
+			logp[batch] = chunk
+		return logp
+
+	results = [None for i in range(len(X))]
+	for batch, chunk in zip(batches, y):
+		for i, r in zip(batch, chunk):
+			results[i] = numpy.exp(r) if func == 'predict_proba' else r
+
+	return results
+
 def predict(model, X, n_jobs=1, backend='threading'):
 	"""Provides for a parallelized predict function.
 
@@ -82,11 +152,11 @@ def predict(model, X, n_jobs=1, backend='threading'):
 		backend which releases the GIL and allows for multithreaded
 		parallelization.
 
-	X : numpy.ndarray or list
+	X : numpy.ndarray or list or RaggedSequences
 		The dataset to operate on. For most models this is a numpy array with
 		columns corresponding to features and rows corresponding to samples.
 		For markov chains and HMMs this will be a list of variable length
-		sequences.
+		sequences or a RaggedSequences collection.
 
 	n_jobs : int
 		The number of jobs to use to parallelize, either the number of threads
@@ -119,11 +189,11 @@ def predict_proba(model, X, n_jobs=1, backend='threading'):
 		backend which releases the GIL and allows for multithreaded
 		parallelization.
 
-	X : numpy.ndarray or list
+	X : numpy.ndarray or list or RaggedSequences
 		The dataset to operate on. For most models this is a numpy array with
 		columns corresponding to features and rows corresponding to samples.
 		For markov chains and HMMs this will be a list of variable length
-		sequences.
+		sequences or a RaggedSequences collection.
 
 	n_jobs : int
 		The number of jobs to use to parallelize, either the number of threads
@@ -156,11 +226,11 @@ def predict_log_proba(model, X, n_jobs=1, backend='threading'):
 		backend which releases the GIL and allows for multithreaded
 		parallelization.
 
-	X : numpy.ndarray or list
+	X : numpy.ndarray or list or RaggedSequences
 		The dataset to operate on. For most models this is a numpy array with
 		columns corresponding to features and rows corresponding to samples.
 		For markov chains and HMMs this will be a list of variable length
-		sequences.
+		sequences or a RaggedSequences collection.
 
 	n_jobs : int
 		The number of jobs to use to parallelize, either the number of threads
@@ -193,11 +263,11 @@ def log_probability(model, X, n_jobs=1, backend='threading'):
 		backend which releases the GIL and allows for multithreaded
 		parallelization.
 
-	X : numpy.ndarray or list
+	X : numpy.ndarray or list or RaggedSequences
 		The dataset to operate on. For most models this is a numpy array with
 		columns corresponding to features and rows corresponding to samples.
 		For markov chains and HMMs this will be a list of variable length
-		sequences.
+		sequences or a RaggedSequences collection.
 
 	n_jobs : int
 		The number of jobs to use to parallelize, either the number of threads
@@ -230,11 +300,11 @@ def probability(model, X, n_jobs=1, backend='threading'):
 		backend which releases the GIL and allows for multithreaded
 		parallelization.
 
-	X : numpy.ndarray or list
+	X : numpy.ndarray or list or RaggedSequences
 		The dataset to operate on. For most models this is a numpy array with
 		columns corresponding to features and rows corresponding to samples.
 		For markov chains and HMMs this will be a list of variable length
-		sequences.
+		sequences or a RaggedSequences collection.
 
 	n_jobs : int
 		The number of jobs to use to parallelize, either the number of threads
@@ -267,11 +337,11 @@ def summarize(model, X, weights=None, y=None, n_jobs=1, backend='threading', par
 		backend which releases the GIL and allows for multithreaded
 		parallelization.
 
-	X : numpy.ndarray or list
+	X : numpy.ndarray or list or RaggedSequences
 		The dataset to operate on. For most models this is a numpy array with
 		columns corresponding to features and rows corresponding to samples.
 		For markov chains and HMMs this will be a list of variable length
-		sequences.
+		sequences or a RaggedSequences collection.
 
 	y : numpy.ndarray or list or None, optional
 		Data labels for supervised training algorithms. Default is None
@@ -296,9 +366,9 @@ def summarize(model, X, weights=None, y=None, n_jobs=1, backend='threading', par
 		The log probability of the dataset being summarized. 
 	"""
 
-	if isinstance(X, list) and isinstance(model, HiddenMarkovModel):
-		n, n_jobs = len(X), len(X)
-	elif isinstance(X, list):
+	if isinstance(X, (list, RaggedSequences)) and isinstance(model, HiddenMarkovModel):
+		return _summarize_hmm(model, X, weights, n_jobs, backend, parallel)
+	elif isinstance(X, (list, RaggedSequences)):
 		n, d = len(X), model.d
 	elif X.ndim == 1 and model.d > 1:
 		n, d = 1, X.shape[0]
@@ -325,6 +395,26 @@ def summarize(model, X, weights=None, y=None, n_jobs=1, backend='threading', par
 	
 	return sum(y)
 
+def _summarize_hmm(model, X, weights, n_jobs, backend, parallel):
+	"""Summarize sequences in tasks of roughly equal total length."""
+
+	X = _check_sequences(X, model)
+
+	if weights is None:
+		weights = numpy.ones(len(X), dtype='float64')
+	else:
+		weights = numpy.array(weights, dtype='float64')
+
+	batches = _balanced_batches([len(x) for x in X], n_jobs)
+
+	parallel = parallel or Parallel(n_jobs=n_jobs, backend=backend)
+	delay = delayed(model.summarize, check_pickle=False)
+
+	y = parallel(delay([X[i] for i in batch], weights[batch], check_input=False) 
+		for batch in batches)
+
+	return sum(y)
+
 def fit(model, X, weights=None, y=None, n_jobs=1, backend='threading', stop_threshold=1e-3, 
 	max_iterations=1e8, inertia=0.0, verbose=False, batch_size=1240, algorithm='exact', **kwargs):
 	"""Provides for a parallelized fit function.
@@ -340,11 +430,11 @@ def fit(model, X, weights=None, y=None, n_jobs=1, backend='threading', stop_thre
 		backend which releases the GIL and allows for multithreaded
 		parallelization.
 
-	X : numpy.ndarray or list
+	X : numpy.ndarray or list or RaggedSequences
 		The dataset to operate on. For most models this is a numpy array with
 		columns corresponding to features and rows corresponding to samples.
 		For markov chains and HMMs this will be a list of variable length
-		sequences.
+		sequences or a RaggedSequences collection.
 
 	y : numpy.ndarray or list or None, optional
 		Data labels for supervised training algorithms. Default is None
@@ -407,8 +497,14 @@ def fit(model, X, weights=None, y=None, n_jobs=1, backend='threading', stop_thre
 		weights = numpy.array(weights, dtype='float64')
 
 	if isinstance(model, HiddenMarkovModel):
+		# The model only knows the threading and multiprocessing backends, so
+		# any other joblib backend leaves it to train with threads as before.
+		if backend in ('threading', 'multiprocessing'):
+			kwargs['backend'] = backend
+
 		return model.fit(X, weights=weights, n_jobs=n_jobs, stop_threshold=stop_threshold, 
-			max_iterations=max_iterations, inertia=inertia, verbose=verbose, **kwargs)
+			max_iterations=max_iterations, inertia=inertia, verbose=verbose, 
+			**kwargs)
 
 	elif isinstance(model, Distribution):
 		summarize(model, X, weights, n_jobs, backend)
@@ -334,6 +334,32 @@ def _check_input(X, keymap):
 
 	return X_ndarray
 
+def check_random_state(seed):
+	"""Turn a seed into a numpy.random.RandomState instance.
+
+	Parameters
+	----------
+	seed : None, int or numpy.random.RandomState
+		If None, return the RandomState used by numpy.random. If an int,
+		return a new RandomState seeded with it. If already a RandomState,
+		return it.
+
+	Returns
+	-------
+	random_state : numpy.random.RandomState
+		The random number generator to draw from.
+	"""
+
+	if seed is None or seed is numpy.random:
+		return numpy.random.mtrand._rand
+	if isinstance(seed, (int, numpy.integer)):
+		return numpy.random.RandomState(seed)
+	if isinstance(seed, numpy.random.RandomState):
+		return seed
+
+	raise ValueError("{} cannot be used to seed a numpy.random.RandomState"
+		.format(seed))
+
 def parallelize_function(X, cls, func, filename, **kwargs):
 	"""Parallelize a function using joblib multiprocessing."""
 
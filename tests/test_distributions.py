@@ -285,6 +285,41 @@ def test_distributions_normal_nan_log_probability():
 	assert_array_almost_equal(d.log_probability([nan, 5]), [0, -1.61208571])
 
 
+def test_distributions_normal_array_log_probability():
+	d = NormalDistribution(5, 2)
+	X = numpy.array([[5., 0.], [nan, 5.]])
+
+	logp = d.log_probability(X)
+	assert_equal(logp.shape, (2, 2))
+	assert_array_almost_equal(logp, [[-1.61208571, -4.73708571], [0, -1.61208571]])
+
+	out = numpy.empty((2, 2))
+	assert_true(d.log_probability(X, out=out) is out)
+	assert_array_almost_equal(out, logp)
+	assert_raises(ValueError, d.log_probability, X, numpy.empty(4))
+
+	d = DiscreteDistribution({'A': 0.25, 'B': 0.75})
+	logp = d.log_probability(numpy.array([['A', 'B'], ['C', 'nan']]))
+	assert_array_almost_equal(logp, [[numpy.log(0.25), numpy.log(0.75)], [-inf, 0]])
+
+
+def test_distributions_discrete_mixed_array_log_probability():
+	d = DiscreteDistribution({'A': 0.5, 1: 0.3, 2.5: 0.2})
+	assert_array_almost_equal(d.log_probability(['A', 1, 2.5]),
+		numpy.log([0.5, 0.3, 0.2]))
+	assert_array_almost_equal(d.log_probability(numpy.array(['A', '1'])),
+		[numpy.log(0.5), -inf])
+	assert_array_almost_equal(d.log_probability(numpy.array([1, 2])),
+		[numpy.log(0.3), -inf])
+
+	d = DiscreteDistribution({1: 0.4, 2: 0.6})
+	assert_array_almost_equal(d.log_probability(['1', 2]), [-inf, numpy.log(0.6)])
+
+	d = DiscreteDistribution({('a', 'b'): 0.4, ('b', 'a'): 0.6})
+	assert_array_almost_equal(d.log_probability([('b', 'a'), ('a', 'a')]),
+		[numpy.log(0.6), -inf])
+
+
 def test_distributions_normal_underflow_log_probability():
 	d = NormalDistribution(5, 1e-10)
 	assert_almost_equal(d.log_probability(1e100), -4.9999999999999987e+219)
@@ -660,6 +695,56 @@ def test_gaussian_kernel():
 	assert_equal(round(f.log_probability(0), 4), -5.1262)
 
 
+@with_setup(setup, teardown)
+def test_gaussian_kernel_tolerance():
+	X = numpy.random.RandomState(0).randn(1000)
+	d = GaussianKernelDensity(X, bandwidth=0.1)
+	e = GaussianKernelDensity(X, bandwidth=0.1, tolerance=1e-6)
+
+	assert_equal(d.tolerance, None)
+	assert_equal(e.tolerance, 1e-6)
+	assert_raises(ValueError, GaussianKernelDensity, X, 0.1, None, False, 0)
+
+	x = numpy.array([-2.5, -0.3, 0, 0.7, 3.1, 25])
+	assert_array_almost_equal(numpy.exp(e.log_probability(x)),
+		numpy.exp(d.log_probability(x)), 6)
+
+	for f in pickle.loads(pickle.dumps(e)), e.copy(), Distribution.from_json(e.to_json()):
+		assert_equal(f.tolerance, 1e-6)
+		assert_array_almost_equal(f.log_probability(x), e.log_probability(x))
+
+
+@with_setup(setup, teardown)
+def test_kernel_summaries():
+	X = numpy.random.RandomState(0).randn(1000)
+
+	d = GaussianKernelDensity()
+	for i in range(0, 1000, 10):
+		d.summarize(X[i:i+10])
+
+	e = GaussianKernelDensity()
+	e.summarize([nan, 2, 3], weights=[1, 0, 1])
+	d._merge_summaries(e._get_summaries())
+	d.from_summaries()
+
+	assert_equal(len(d.parameters[0]), 1001)
+	assert_array_equal(d.parameters[0], numpy.concatenate([X, [3]]))
+	assert_equal(d.summaries, [[], [], [], 0])
+
+	d = UniformKernelDensity(max_points=100)
+	for i in range(0, 1000, 10):
+		d.summarize(X[i:i+10])
+
+	assert_less_equal(d.summaries[3], 200)
+	d.from_summaries()
+
+	assert_equal(len(d.parameters[0]), 100)
+	assert_true(numpy.isin(d.parameters[0], X).all())
+	assert_equal(pickle.loads(pickle.dumps(d)).max_points, 100)
+	assert_equal(d.copy().max_points, 100)
+	assert_equal(Distribution.from_json(d.to_json()).max_points, 100)
+
+
 @with_setup(setup, teardown)
 def test_triangular_kernel():
 	d = TriangleKernelDensity([1, 6, 3, 4, 5, 2])
@@ -1245,6 +1330,44 @@ def test_multivariate_log_probability():
 	for i in range(100):
 		assert_almost_equal(d.log_probability(X[i]), logp[i])
 
+def test_multivariate_missing_log_probability():
+	mu = numpy.array([1., -1., 0.5, 2.])
+	cov = numpy.array([[2.0, 0.3, 0.1, 0.0],
+					   [0.3, 1.5, 0.2, 0.4],
+					   [0.1, 0.2, 1.0, 0.3],
+					   [0.0, 0.4, 0.3, 2.5]])
+
+	d = MultivariateGaussianDistribution(mu, cov)
+	X = numpy.random.RandomState(0).randn(50, 4)
+	X[::2, 1] = nan
+	X[::3, 2] = nan
+	X[7] = nan
+
+	logp = d.log_probability(X)
+	assert_equal(logp[7], 0)
+
+	for i in range(50):
+		if i == 7:
+			continue
+
+		avail = ~numpy.isnan(X[i])
+		e = MultivariateGaussianDistribution(mu[avail], cov[numpy.ix_(avail, avail)])
+		assert_almost_equal(logp[i], e.log_probability(X[i, avail]))
+
+	assert_array_equal(d.log_probability(X), logp)
+
+def test_multivariate_float32_log_probability():
+	X = numpy.random.RandomState(0).randn(500, 5)
+	d = MultivariateGaussianDistribution.from_samples(X)
+
+	X32 = X.astype('float32')
+	X32[::4, 3] = nan
+
+	logp = d.log_probability(X32.astype('float64'))
+	assert_array_almost_equal(d.log_probability(X32), logp)
+	assert_almost_equal(d.log_probability(X32[1]), logp[1])
+	assert_raises(ValueError, d.log_probability, X32[:, :4])
+
 def test_cpd_sampling():
 	d1 = DiscreteDistribution({"A": 0.1, "B": 0.9})
 	d2 = ConditionalProbabilityTable(
@@ -1,7 +1,10 @@
 from __future__ import (division)
 
 from pomegranate import *
+from pomegranate.parallel import fit
 from pomegranate.parallel import log_probability
+from pomegranate.parallel import predict
+from pomegranate.parallel import predict_log_proba
 from nose.tools import with_setup
 from nose.tools import assert_almost_equal
 from nose.tools import assert_equal
@@ -12,6 +15,8 @@ from nose.tools import assert_greater
 from numpy.testing import assert_array_almost_equal
 import pickle
 import random
+import shutil
+import tempfile
 import numpy
 import time
 
@@ -269,6 +274,14 @@ def teardown():
 	pass
 
 
+def teardown_directory():
+	'''
+	Remove the temporary directory which a test wrote its files to.
+	'''
+
+	shutil.rmtree(directory, ignore_errors=True)
+
+
 @with_setup(setup_univariate_discrete_dense)
 def test_hmm_univariate_discrete_dense_forward():
 	f = model.forward(['A', 'B', 'D', 'D', 'C'])
@@ -520,6 +533,353 @@ def test_hmm_multivariate_gaussian_dense_nan_backward():
 	assert_array_almost_equal(f, logp)
 
 
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_forward_batch():
+	X = [['A', 'B', 'D', 'D', 'C'], ['A', 'C'], [], ['D', 'D', 'B']]
+	f = model.forward_batch(X)
+
+	assert_equal(f.shape, (4, 6, 6))
+	for i, sequence in enumerate(X):
+		n = len(sequence)
+		assert_array_almost_equal(f[i, :n+1], model.forward(sequence))
+		assert_array_almost_equal(f[i, n+1:], -inf)
+
+
+@with_setup(setup_multivariate_gaussian_dense)
+def test_hmm_multivariate_gaussian_dense_backward_batch():
+	X = numpy.random.randn(3, 7, 5)
+	lengths = [7, 2, 4]
+	b = model.backward_batch(X, lengths)
+
+	for i, n in enumerate(lengths):
+		assert_array_almost_equal(b[i, :n+1], model.backward(X[i, :n]))
+
+
+@with_setup(setup_multivariate_gaussian_sparse)
+def test_hmm_multivariate_gaussian_sparse_batch():
+	X = [numpy.random.randn(n, 2) * 5 + 5 for n in (3, 9, 1, 6, 6)]
+
+	logp = log_probability(model, X, n_jobs=2)
+	assert_array_almost_equal(logp, [model.log_probability(x) for x in X])
+
+	y = predict_log_proba(model, X, n_jobs=2)
+	for x, y_hat in zip(X, y):
+		assert_array_almost_equal(y_hat, model.predict_log_proba(x))
+
+
+@with_setup(setup_multivariate_gaussian_sparse)
+def test_hmm_multivariate_gaussian_sparse_balanced():
+	X = [numpy.random.randn(n, 2) * 5 + 5 for n in (40, 1, 2, 3, 25, 1, 1, 8, 2)]
+	y = predict(model, X, n_jobs=3)
+
+	for x, y_hat in zip(X, y):
+		assert_equal(y_hat, model.predict(x))
+
+	model2 = model.copy()
+	model.fit(X, max_iterations=3, n_jobs=3)
+	model2.fit(X, max_iterations=3)
+	assert_array_almost_equal(model.dense_transition_matrix(), 
+		model2.dense_transition_matrix())
+
+
+@with_setup(setup_univariate_gaussian_dense)
+def test_hmm_univariate_gaussian_dense_checkpoint():
+	x = numpy.random.randn(40) * 5 + 5
+
+	assert_array_almost_equal(model.predict_log_proba(x, memory_budget=1),
+		model.predict_log_proba(x))
+
+	trans, ems = model.forward_backward(x)
+	trans_c, ems_c = model.forward_backward(x, memory_budget=1)
+	assert_array_almost_equal(trans_c, trans)
+	assert_array_almost_equal(ems_c, ems)
+
+
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_fit_checkpoint():
+	X = [list(numpy.random.choice(list('ABCD'), n)) for n in (3, 30, 1, 12, 25)]
+	model2 = model.copy()
+
+	improvement = model.fit(X, max_iterations=3)
+	improvement2 = model2.fit(X, max_iterations=3, memory_budget=1000)
+
+	assert_almost_equal(improvement2, improvement)
+	assert_array_almost_equal(model2.dense_transition_matrix(), 
+		model.dense_transition_matrix())
+
+
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_fit_multiprocessing():
+	X = [list(numpy.random.choice(list('ABCD'), n)) for n in (3, 30, 1, 12, 25, 7)]
+	model2 = model.copy()
+
+	improvement = model.fit(X, max_iterations=3)
+	improvement2 = model2.fit(X, max_iterations=3, n_jobs=2, 
+		backend='multiprocessing')
+
+	assert_almost_equal(improvement2, improvement)
+	assert_array_almost_equal(model2.dense_transition_matrix(), 
+		model.dense_transition_matrix())
+
+	for state, state2 in zip(model.states, model2.states):
+		if state.distribution is not None:
+			for key, value in state.distribution.parameters[0].items():
+				assert_almost_equal(state2.distribution.parameters[0][key], value)
+
+	assert_raises(ValueError, model.fit, X, labels=X, n_jobs=2, 
+		backend='multiprocessing')
+
+
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_parallel_fit_backend():
+	X = [list(numpy.random.choice(list('ABCD'), n)) for n in (3, 30, 1, 12)]
+	model2, model3 = model.copy(), model.copy()
+
+	improvement = model.fit(X, max_iterations=3)
+	assert_almost_equal(fit(model2, X, backend='loky', stop_threshold=1e-9,
+		max_iterations=3), improvement)
+	assert_almost_equal(fit(model3, X, n_jobs=2, backend='multiprocessing',
+		stop_threshold=1e-9, max_iterations=3), improvement)
+
+
+@with_setup(setup_univariate_discrete_dense, teardown_directory)
+def test_hmm_univariate_discrete_dense_fit_shards():
+	global directory
+
+	X = [list(numpy.random.choice(list('ABCD'), n)) for n in (3, 30, 1, 12, 25, 7, 9)]
+	path = directory = tempfile.mkdtemp()
+	shards = SequenceShards.from_sequences(X, path, shard_size=3)
+	assert_equal(len(SequenceShards.from_directory(path)), 3)
+
+	model2 = model.copy()
+	model3 = model.copy()
+
+	improvement = model.fit(X, max_iterations=3)
+	improvement2 = model2.fit(shards, max_iterations=3, batch_size=2, n_jobs=2)
+	model3.fit((X[i:i+2] for i in range(0, len(X), 2)), max_iterations=3)
+
+	assert_almost_equal(improvement2, improvement)
+	assert_array_almost_equal(model2.dense_transition_matrix(), 
+		model.dense_transition_matrix())
+	assert_raises(ValueError, model.fit, shards, weights=numpy.ones(len(X)))
+	assert_raises(ValueError, model.fit, iter([]))
+
+
+@with_setup(setup_univariate_gaussian_dense)
+def test_hmm_univariate_gaussian_dense_filter():
+	X = [3, 5, 8, 19, 13, 4, 7]
+	filter = model.filter(lag=2, window=4)
+	f = model.forward(X)
+
+	for i, x in enumerate(X):
+		y = filter.update(x)
+		y_hat = numpy.exp(f[i+1, :4] - numpy.logaddexp.reduce(f[i+1, :4]))
+		assert_array_almost_equal(y, y_hat)
+
+	assert_equal(filter.n_observations, 7)
+	assert_array_almost_equal(filter.smoothed_proba.sum(), 1)
+
+	logp, path = filter.viterbi()
+	assert_equal(len(path), 4)
+
+	filter.reset()
+	assert_equal(filter.n_observations, 0)
+	assert_equal(filter.smoothed_proba, None)
+
+
+@with_setup(setup_univariate_gaussian_dense)
+def test_hmm_univariate_gaussian_dense_blas():
+	X = [numpy.random.randn(n) * 5 + 5 for n in (1, 8, 15)]
+	model2 = model.copy()
+	model2.bake(dense=True)
+
+	assert_equal(model.dense, False)
+	assert_equal(model2.dense, True)
+
+	for x in X:
+		assert_almost_equal(model2.log_probability(x), model.log_probability(x))
+		assert_array_almost_equal(model2.predict_proba(x), model.predict_proba(x))
+
+	improvement = model.fit(X, max_iterations=3)
+	improvement2 = model2.fit(X, max_iterations=3)
+
+	assert_almost_equal(improvement2, improvement)
+	assert_array_almost_equal(model2.dense_transition_matrix(), 
+		model.dense_transition_matrix())
+
+
+@with_setup(setup_multivariate_discrete_sparse)
+def test_hmm_multivariate_discrete_sparse_scaled():
+	X = [[['A', 'A'], ['C', 'C'], ['T', 'T']], [['A', 'G'], ['C', 'C'], 
+		['G', 'A'], ['T', 'T']], [['C', 'C'], ['T', 'A']]]
+	model2 = model.copy()
+	model2.numerics = 'scaled'
+
+	assert_equal(model.numerics, 'log')
+	assert_equal(model2.numerics, 'scaled')
+	assert_raises(ValueError, setattr, model2, 'numerics', 'linear')
+
+	for x in X:
+		assert_array_almost_equal(model2.forward(x), model.forward(x))
+		assert_array_almost_equal(model2.backward(x), model.backward(x))
+		assert_almost_equal(model2.log_probability(x), model.log_probability(x))
+
+	improvement = model.fit(X, max_iterations=3)
+	improvement2 = model2.fit(X, max_iterations=3)
+
+	assert_almost_equal(improvement2, improvement)
+	assert_array_almost_equal(model2.dense_transition_matrix(), 
+		model.dense_transition_matrix())
+
+
+@with_setup(setup_univariate_gaussian_dense)
+def test_hmm_univariate_gaussian_dense_tied():
+	d1 = NormalDistribution(5, 2)
+	tied = dense_model(NormalDistribution(1, 1), d1, d1, 
+		NormalDistribution(16, 0.5))
+	untied = dense_model(NormalDistribution(1, 1), d1, d1.copy(), 
+		NormalDistribution(16, 0.5))
+
+	X = [numpy.random.randn(n) * 5 + 5 for n in (10, 6, 12)]
+	for x in X:
+		assert_almost_equal(tied.log_probability(x), untied.log_probability(x))
+		assert_array_almost_equal(tied.predict_proba(x), untied.predict_proba(x))
+
+	tied2 = tied.copy()
+	tied2.numerics = 'scaled'
+
+	improvement = tied.fit(X, max_iterations=3)
+	improvement2 = tied2.fit(X, max_iterations=3, memory_budget=100)
+
+	assert_almost_equal(improvement2, improvement)
+	assert_array_almost_equal(tied2.dense_transition_matrix(), 
+		tied.dense_transition_matrix())
+	assert tied.states[1].distribution is tied.states[2].distribution
+
+
+@with_setup(setup_univariate_gaussian_dense)
+def test_hmm_univariate_gaussian_dense_scratch():
+	X = [numpy.random.randn(n) * 5 + 5 for n in (20, 5, 40, 20)]
+	logp = [model.log_probability(x) for x in X]
+	paths = [model.viterbi(x)[1] for x in X]
+	y = [model.predict_proba(x) for x in X]
+
+	for limit in (0, 1000):
+		model.free_scratch_buffers()
+		model.scratch_limit = limit
+
+		for x, logp_hat, path, y_hat in zip(X, logp, paths, y):
+			assert_almost_equal(model.log_probability(x), logp_hat)
+			assert_equal([i for i, state in model.viterbi(x)[1]], 
+				[i for i, state in path])
+			assert_array_almost_equal(model.predict_proba(x), y_hat)
+
+
+@with_setup(setup_multivariate_discrete_sparse)
+def test_hmm_multivariate_discrete_sparse_n_jobs():
+	X = [['A', 'C'], ['C', 'C'], ['T', 'T'], ['A', 'G'], ['C', 'C'],
+		['G', 'A'], ['T', 'T'], ['C', 'C'], ['T', 'A'], ['A', 'A']]
+
+	logp, path = model.viterbi(X)
+	transitions, emissions = model.forward_backward(X)
+
+	for n_jobs in (2, 3, 20):
+		assert_almost_equal(model.log_probability(X, n_jobs=n_jobs),
+			model.log_probability(X))
+
+		logp2, path2 = model.viterbi(X, n_jobs=n_jobs)
+		assert_almost_equal(logp2, logp)
+		assert_equal([i for i, state in path2], [i for i, state in path])
+
+		transitions2, emissions2 = model.forward_backward(X, n_jobs=n_jobs)
+		assert_array_almost_equal(transitions2, transitions)
+		assert_array_almost_equal(emissions2, emissions)
+
+
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_emission_table():
+	X = [list('ABCDABCDDDCBA'), list('AABBCCDD'), list('DCBA')]
+	model.fit(X, max_iterations=3)
+	model2 = model.copy()
+
+	for x in X + [['A', 'nan', 'D', 'C']]:
+		assert_almost_equal(model.log_probability(x), model2.log_probability(x))
+		assert_almost_equal(model.viterbi(x)[0], model2.viterbi(x)[0])
+		assert_array_almost_equal(model.predict_proba(x), model2.predict_proba(x))
+
+
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_emission_table_update():
+	x = list('ABCDABCDDDCBA')
+	logp = model.log_probability(x)
+
+	model.states[0].distribution.fit(list('AAAAB'))
+	assert_not_equal(model.log_probability(x), logp)
+	assert_almost_equal(model.log_probability(x), model.copy().log_probability(x))
+	assert_almost_equal(model.viterbi(x, beam=5.0)[0], model.copy().viterbi(x)[0])
+
+	model.states[1].distribution.parameters = [{'A': 0.1, 'B': 0.2, 'C': 0.3, 
+		'D': 0.4}]
+	assert_almost_equal(model.log_probability(x), model.copy().log_probability(x))
+
+
+@with_setup(setup_univariate_discrete_dense, teardown_directory)
+def test_hmm_univariate_discrete_dense_ragged():
+	global directory
+
+	X = [list('ABCDABCDDDCBA'), list('AABBCCDD'), ['D', 'nan', 'A']]
+
+	directory = tempfile.mkdtemp()
+	prefix = directory + '/sequences'
+	RaggedSequences.from_sequences(X).save(prefix)
+	X_ragged = RaggedSequences.load(prefix)
+
+	assert_array_almost_equal(model.log_probability(X_ragged),
+		[model.log_probability(x) for x in X])
+	assert_equal(model.predict(X_ragged), [model.predict(x) for x in X])
+
+	for (logp, path), x in zip(model.viterbi(X_ragged), X):
+		assert_almost_equal(logp, model.viterbi(x)[0])
+
+	model2 = model.copy()
+	model.fit(X, max_iterations=3)
+	model2.fit(X_ragged, max_iterations=3)
+	assert_array_almost_equal(model.dense_transition_matrix(),
+		model2.dense_transition_matrix())
+
+
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_encoding():
+	x = list('ABCDABCDDDCBA') + ['nan', nan, 'A']
+
+	logp = model.log_probability(x)
+	assert_almost_equal(model.log_probability(numpy.array(x, dtype=object)), logp)
+	assert_almost_equal(model.log_probability(numpy.array(x, dtype=str)), logp)
+	assert_raises(ValueError, model.log_probability, numpy.array(['A', 'E']))
+
+
+def test_hmm_discrete_mixed_and_tuple_alphabets():
+	for alphabet in (['A', 1, 2.5], [('a', 'b'), ('b', 'a'), ('a', 'a')]):
+		d1 = DiscreteDistribution({alphabet[0]: 0.7, alphabet[1]: 0.2, alphabet[2]: 0.1})
+		d2 = DiscreteDistribution({alphabet[0]: 0.1, alphabet[1]: 0.3, alphabet[2]: 0.6})
+		s1, s2 = State(d1, name="s1"), State(d2, name="s2")
+
+		hmm = HiddenMarkovModel()
+		hmm.add_states(s1, s2)
+		hmm.add_transition(hmm.start, s1, 1.0)
+		hmm.add_transition(s1, s1, 0.8)
+		hmm.add_transition(s1, s2, 0.2)
+		hmm.add_transition(s2, s2, 0.9)
+		hmm.add_transition(s2, hmm.end, 0.1)
+		hmm.bake()
+
+		x = [alphabet[0], alphabet[2], alphabet[1]]
+		logp = numpy.log(0.7*0.8*0.1*0.2*0.3*0.1 + 0.7*0.2*0.6*0.9*0.3*0.1)
+
+		assert_almost_equal(hmm.log_probability(x), logp)
+		assert_equal(len(hmm.viterbi(x)[1]), 5)
+
+
 @with_setup(setup_univariate_discrete_dense)
 def test_hmm_univariate_discrete_dense_predict_log_proba():
 	f = model.predict_log_proba(['A', 'B', 'D', 'D', 'C'])
@@ -659,6 +1019,26 @@ def test_hmm_univariate_gaussian_dense_predict_proba():
 	assert_array_almost_equal(f, logp)
 
 
+@with_setup(setup_univariate_gaussian_dense)
+def test_hmm_univariate_gaussian_dense_predict_proba_sparse():
+	X = [3, 5, 8, 19, 13]
+	f = model.predict_proba(X)
+
+	states, probabilities = model.predict_proba(X, top_k=2)
+	assert_array_almost_equal(states, [[1, 0], [0, 2], [2, 0], [2, 3], [2, 3]])
+	assert_array_almost_equal(probabilities, numpy.sort(f, axis=1)[:, ::-1][:, :2])
+
+	for memory_budget in None, 1:
+		r = model.predict_proba(X, memory_budget=memory_budget, threshold=0.01)
+		assert_array_almost_equal(r.toarray(), numpy.where(f >= 0.01, f, 0))
+
+		states, logp = model.predict_log_proba(X, memory_budget=memory_budget,
+			top_k=1)
+		assert_array_almost_equal(states[:, 0], f.argmax(axis=1))
+
+	assert_raises(ValueError, model.predict_proba, X, top_k=1, threshold=0.1)
+
+
 @with_setup(setup_univariate_poisson_dense)
 def test_hmm_univariate_poisson_dense_predict_proba():
 	f = model.predict_proba([5, 8, 2, 4, 7, 8, 2])
@@ -837,6 +1217,26 @@ def test_hmm_univariate_discrete_dense_predict_viterbi():
 	assert_array_almost_equal(f, path)
 
 
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_n_best_viterbi():
+	X = ['A', 'B', 'D', 'D', 'C']
+	logp, path = model.viterbi(X)
+	paths = model.n_best_viterbi(X, 20)
+
+	assert_equal(len(paths), 20)
+	assert_almost_equal(paths[0][0], logp)
+	assert_equal([i for i, state in paths[0][1]], [i for i, state in path])
+
+	logps = [logp for logp, path in paths]
+	assert_array_almost_equal(logps, sorted(logps, reverse=True))
+	assert_equal(len(set(tuple(i for i, state in path)
+		for logp, path in paths)), 20)
+
+	# Each state can emit each symbol, so there are 4 ** 2 paths
+	assert_equal(len(model.n_best_viterbi(['A', 'B'], 50)), 16)
+	assert_raises(ValueError, model.n_best_viterbi, X, 0)
+
+
 @with_setup(setup_univariate_gaussian_dense)
 def test_hmm_univariate_gaussian_dense_predict_viterbi():
 	f = model.predict([3, 5, 8, 19, 13], algorithm='viterbi')
@@ -870,6 +1270,31 @@ def test_hmm_multivariate_gaussian_dense_predict_viterbi():
 	assert_array_almost_equal(f, path)
 
 
+@with_setup(setup_univariate_gaussian_dense)
+def test_hmm_univariate_gaussian_dense_predict_beam():
+	f = model.predict([3, 5, 8, 19, 13], algorithm='beam')
+	path = [4, 1, 0, 2, 2, 2, 5]
+
+	assert_array_almost_equal(f, path)
+
+
+@with_setup(setup_univariate_discrete_dense)
+def test_hmm_univariate_discrete_dense_beam_viterbi():
+	X = list(numpy.random.choice(['A', 'B', 'C', 'D'], 50))
+	logp, path = model.viterbi(X)
+
+	logp2, path2, n_pruned = model.viterbi(X, beam=float("inf"), 
+		return_pruned=True)
+	assert_almost_equal(logp2, logp)
+	assert_equal([i for i, state in path2], [i for i, state in path])
+	assert_equal(n_pruned, 0)
+
+	logp3, path3, n_pruned = model.viterbi(X, beam_size=1, return_pruned=True)
+	assert_equal(n_pruned, 49 * 4)
+	assert_less_equal(logp3, logp)
+	assert_equal(len(path3), 52)
+
+
 @with_setup(setup_univariate_discrete_dense)
 def test_hmm_univariate_discrete_dense_nan_predict_viterbi():
 	f = model.predict(['A', nan, 'D', nan, 'C'], algorithm='viterbi')
@@ -912,6 +1337,19 @@ def test_hmm_multivariate_gaussian_dense_nan_predict_viterbi():
 	assert_array_almost_equal(f, path)
 
 
+@with_setup(setup, teardown)
+def test_hmm_dense_bake_refused():
+	seq = list('ACT')
+	logp = model.log_probability(seq)
+
+	assert_raises(ValueError, model.bake, dense=True)
+	assert_equal(model.dense, False)
+	assert_almost_equal(model.log_probability(seq), logp)
+
+	seqs = [list(x) for x in ['ACT', 'ACC', 'ACTC', 'CCT', 'AAT', 'CT']]
+	assert_greater(model.fit(seqs, max_iterations=2), 0)
+
+
 @with_setup(setup, teardown)
 def test_hmm_viterbi_fit():
 	seqs = [list(x) for x in ['ACT', 'ACT', 'ACC', 'ACTC', 'ACT', 'ACT', 'CCT', 
@@ -1418,6 +1856,32 @@ def test_hmm_multivariate_initialization():
 	assert_equal(hmmd3.d, 3)
 
 
+def test_hmm_bake_orphans_and_silent_states():
+	d1, d2 = NormalDistribution(0, 1), NormalDistribution(3, 1)
+	s1, s2 = State(d1, "s1"), State(d2, "s2")
+	o1, o2 = State(NormalDistribution(1, 1), "o1"), State(NormalDistribution(1, 1), "o2")
+	i1, i2 = State(None, "i1"), State(None, "i2")
+
+	hmmd1 = HiddenMarkovModel("bake")
+	hmmd1.add_states(s1, s2, o1, o2, i1, i2)
+	hmmd1.add_transitions(hmmd1.start, [s1, i1], [0.5, 0.5])
+	hmmd1.add_transitions([s1, s1, s2, s2, i1, o1, o2], [s1, s2, s2, hmmd1.end, i2, o2, s1], 
+		[2., 2., 0.5, 0.5, 1., 1., 0.5])
+	hmmd1.add_transitions(i2, [s1, s2], [0.3, 0.7])
+	hmmd1.bake()
+
+	assert_equal([state.name for state in hmmd1.states], 
+		["s1", "s2", "bake-start", "i2", "bake-end"])
+	assert_array_almost_equal(hmmd1.dense_transition_matrix(), 
+		[[0.5, 0.5, 0, 0, 0], [0, 0.5, 0, 0, 0.5], [0.5, 0, 0, 0.5, 0], 
+		 [0.3, 0.7, 0, 0, 0], [0, 0, 0, 0, 0]])
+
+	hmmd2 = HiddenMarkovModel()
+	hmmd2.add_states(s1, i1, i2)
+	hmmd2.add_transitions([hmmd2.start, s1, i1, i2], [i1, s1, i2, i1], [1., 1., 0.5, 0.5])
+	assert_raises(ValueError, hmmd2.bake, merge="None")
+
+
 def test_hmm_initialization_error():
 	sbd1 = State(UniformDistribution(0, 10))
 	sbd3 = State(MultivariateGaussianDistribution([1, 4, 3], [[3, 0, 1],[0, 3, 0],[1, 0, 3]]))
@@ -1459,6 +1923,54 @@ def test_hmm_json_univariate():
 		assert_almost_equal(logp1, logp2)
 
 
+@with_setup(setup_univariate_gaussian_dense)
+def test_hmm_serialization_keeps_kernels():
+	model.numerics = 'scaled'
+	model.scratch_limit = 4096
+	model.bake(dense=True)
+
+	models = [pickle.loads(pickle.dumps(model)), model.copy(),
+		HiddenMarkovModel.from_json(model.to_json())]
+
+	for model2 in models:
+		assert_equal(model2.dense, True)
+		assert_equal(model2.numerics, 'scaled')
+		assert_equal(model2.scratch_limit, 4096)
+
+	model.numerics = 'log'
+	model.bake(dense=False)
+
+	for model2 in [pickle.loads(pickle.dumps(model)), model.copy()]:
+		assert_equal(model2.dense, False)
+		assert_equal(model2.numerics, 'log')
+
+
+@with_setup(setup_univariate_discrete_dense, teardown_directory)
+def test_hmm_save_load_univariate_discrete():
+	global directory
+
+	directory = tempfile.mkdtemp()
+	filename = directory + '/model.pgm'
+	model.save(filename)
+	model2 = HiddenMarkovModel.load(filename)
+
+	assert_equal(model2.keymap, model.keymap)
+	assert_array_almost_equal(model2.dense_transition_matrix(),
+		model.dense_transition_matrix())
+
+	X = [list(numpy.random.choice(list('ABCD'), 10)) for i in range(5)]
+	for sequence in X:
+		assert_almost_equal(model.log_probability(sequence),
+			model2.log_probability(sequence))
+
+	improvement = model.fit(X, max_iterations=3)
+	improvement2 = model2.fit(X, max_iterations=3)
+
+	assert_almost_equal(improvement2, improvement)
+	assert_array_almost_equal(model2.dense_transition_matrix(),
+		model.dense_transition_matrix())
+
+
 @with_setup(setup_multivariate_gaussian_dense)
 def test_hmm_pickle_multivariate():
 	model2 = pickle.loads(pickle.dumps(model))
@@ -1485,6 +1997,27 @@ def test_hmm_json_univariate():
 		assert_almost_equal(logp1, logp2)
 
 
+@with_setup(setup_univariate_discrete_dense, teardown)
+def test_hmm_univariate_discrete_sample_many():
+	X, paths = model.sample(n=2000, path=True, random_state=0, n_jobs=2)
+	X2 = model.sample(n=2000, random_state=0)
+
+	assert_equal(len(X), 2000)
+	assert_array_almost_equal(X.data, X2.data)
+	assert_array_almost_equal(X.lengths, paths.lengths - 2)
+
+	path = paths[0].symbols()
+	assert_equal(path[0], model.start.name)
+	assert_equal(path[-1], model.end.name)
+
+	states = paths.data[paths.data < 4]
+	symbols = X.data[states == 0]
+	assert_almost_equal((symbols == model.keymap[0]['A']).mean(), 0.9, 1)
+
+	X = model.sample(n=50, length=5)
+	assert_array_almost_equal(X.lengths, [5] * 50)
+
+
 @with_setup(setup_univariate_discrete_dense, teardown)
 def test_hmm_univariate_discrete_from_samples():
 	X = [model.sample() for i in range(25)]
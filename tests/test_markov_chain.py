@@ -352,3 +352,20 @@ def test_pickling():
 
 	assert_almost_equal( chain1.log_probability( list('BCCCACBDBDBABACD') ),
 	                     chain2.log_probability( list('BCCCACBDBDBABACD') ) )
+
+@with_setup( setup, teardown )
+def test_ragged_sequences():
+	X = RaggedSequences.from_sequences( data[:20] + [ list('A'), list('BD') ] )
+
+	for chain in MarkovChain([ zeroth_dist, first_dist ]), MarkovChain([ zeroth_dist, first_dist, second_dist ]):
+		logp = chain.log_probability( X )
+		for logp1, sequence in zip( logp, data[:20] + [ list('A'), list('BD') ] ):
+			assert_almost_equal( logp1, chain.log_probability( sequence ) )
+
+		chain2 = pickle.loads( pickle.dumps( chain ) )
+		chain.fit( data[:20] + [ list('A'), list('BD') ] )
+		chain2.fit( X )
+
+		for sequence in data[20:]:
+			assert_almost_equal( chain2.log_probability( sequence ),
+			                     chain.log_probability( sequence ) )